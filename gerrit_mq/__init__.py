@@ -2,4 +2,4 @@
 A merge commit serializer for golden branches.
 """
 
-VERSION = '0.3.0'
+VERSION = '0.4.0'
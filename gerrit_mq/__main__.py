@@ -2,8 +2,8 @@
 
 from __future__ import print_function
 import argparse
+import datetime
 import inspect
-import io
 import json
 import logging
 import os
@@ -15,13 +15,31 @@ import gerrit_mq
 from gerrit_mq import common
 from gerrit_mq import daemon
 from gerrit_mq import functions
+from gerrit_mq import migrations
 from gerrit_mq import orm
+from gerrit_mq import simulator
 
 def class_to_cmd(name):
   intermediate = re.sub('(.)([A-Z][a-z]+)', r'\1-\2', name)
   return re.sub('([a-z0-9])([A-Z])', r'\1-\2', intermediate).lower()
 
 
+def add_file_log(logfile_path):
+  """
+  Add a handler which puts log events in an actual file for review as needed.
+  The log file is on a rotation where each log may grow up to 1 megabyte with
+  up to 10 backups
+  """
+  filelog = logging.handlers.RotatingFileHandler(
+      logfile_path, maxBytes=int(1e6), backupCount=10)
+
+  # We'll add a timestamp to the format for this log
+  format_str = ('%(asctime)s %(levelname)-8s %(filename)s [%(lineno)-3s] '
+                ': %(message)s')
+  filelog.setFormatter(logging.Formatter(format_str))
+  logging.getLogger('').addHandler(filelog)
+
+
 class Command(object):
   """
   Base class making it a little easier to set up a complex argparse tree by
@@ -78,7 +96,7 @@ class PollGerrit(Command):
   @classmethod
   def run_args(cls, config, args):
     gerrit = common.GerritRest(**config['gerrit.rest'])
-    sql = orm.init_sql(config['db_url'])()
+    sql = orm.init_sql(config['db_url'], config.get('sqlite'))()
 
     if args.poll_id == 0:
       args.poll_id = functions.get_next_poll_id(sql)
@@ -102,7 +120,7 @@ class GetQueue(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    session_factory = orm.init_sql(config['db_url'])
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
     _, queue = functions.get_queue(session_factory(), args.project_filter,
                                    args.branch_filter, args.offset, args.limit)
     queue = [item.as_dict() for item in queue]
@@ -123,13 +141,92 @@ class GetNext(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    session_factory = orm.init_sql(config['db_url'])
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
     queue = functions.get_queue(session_factory(), args.project_filter,
                                 args.branch_filter, 0, -1)
     json.dump(queue, sys.stdout, indent=2, separators=(',', ': '))
     sys.stdout.write('\n')
 
 
+class GetFlakySteps(Command):
+  """
+  Rank build steps by how often they fail and then pass when retried
+  """
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('-p', '--project-filter', default=None,
+                           help="SQL LIKE expression for projects to select")
+    subparser.add_argument('-q', '--queue-filter', default=None,
+                           help="SQL LIKE expression for queues to select")
+    subparser.add_argument('--limit', type=int, default=25,
+                           help="maximum number of steps to list")
+
+  @classmethod
+  def run_args(cls, config, args):
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
+    result = functions.get_flaky_steps(session_factory(), args.project_filter,
+                                       args.queue_filter, args.limit)
+    json.dump(result, sys.stdout, indent=2, separators=(',', ': '))
+    sys.stdout.write('\n')
+
+
+class Simulate(Command):
+  """
+  Replay the merge history through one or more merge policies and report
+  throughput, latency and build-hours for each
+  """
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('-p', '--project-filter', default=None,
+                           help="SQL LIKE expression for projects to select")
+    subparser.add_argument('-b', '--branch-filter', default=None,
+                           help="SQL LIKE expression for branches to select")
+    subparser.add_argument('--since', default=None,
+                           help="only replay requests made after this date "
+                                "(YYYY-MM-DD)")
+    subparser.add_argument('--policy', nargs='+',
+                           default=list(simulator.POLICIES),
+                           choices=list(simulator.POLICIES),
+                           help="merge policies to simulate")
+    subparser.add_argument('--coalesce-count', type=int, nargs='+',
+                           default=[4],
+                           help="batch sizes to simulate for the coalesced "
+                                "and bisecting policies")
+    subparser.add_argument('--concurrency', type=int, nargs='+', default=[2],
+                           help="number of concurrent builds to simulate for "
+                                "the speculative policy")
+    subparser.add_argument('--poll-period', type=float, nargs='+',
+                           default=None,
+                           help="poll periods (seconds) to simulate, default "
+                                "is daemon.poll_period")
+    subparser.add_argument('--seed', type=int, default=0,
+                           help="seed for sampling build durations")
+    subparser.add_argument('-j', '--jobs', type=int, default=1,
+                           help="number of processes to simulate with")
+
+  @classmethod
+  def run_args(cls, config, args):
+    since = None
+    if args.since is not None:
+      since = datetime.datetime.strptime(args.since, '%Y-%m-%d')
+    poll_periods = args.poll_period
+    if poll_periods is None:
+      poll_periods = [config.get('daemon.poll_period', 60)]
+
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
+    lanes = simulator.load_trace(session_factory(), args.project_filter,
+                                 args.branch_filter, since)
+    logging.info('Loaded %d requests on %d branches',
+                 sum(len(lane.arrivals) for lane in lanes), len(lanes))
+
+    configs = simulator.get_configs(args.policy, args.coalesce_count,
+                                    args.concurrency, poll_periods)
+    result = simulator.sweep(lanes, configs, args.seed, args.jobs)
+    json.dump(result, sys.stdout, indent=2, separators=(',', ': '),
+              sort_keys=True)
+    sys.stdout.write('\n')
+
+
 class Webfront(Command):
   """
   Start the merge-queue master service.
@@ -139,8 +236,8 @@ class Webfront(Command):
 
   @classmethod
   def run_args(cls, config, args):
-    gerrit = common.GerritRest(**config['gerrit.rest'])
-    session_factory = orm.init_sql(config['db_url'])
+    gerrit = common.get_gerrit(config, 'webfront')
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
 
     from gerrit_mq import webfront
     app = webfront.Webfront(config, gerrit, session_factory)
@@ -159,28 +256,15 @@ class Daemon(Command):
     # TODO(josh): implement this
     # common.create_directories(config)
 
-    # We'll add a handler which puts log events in an actual file for review as
-    # needed. We'll put the log file on a rotation where each log may grow up
-    # to 1 megabyte with up to 10 backups
-    filelog = logging.handlers.RotatingFileHandler(
-        '{}/app.log'.format(config['log_path']),
-        maxBytes=int(1e6), backupCount=10)
-
-    # We'll add a timestamp to the format for this log
-    format_str = ('%(asctime)s %(levelname)-8s %(filename)s [%(lineno)-3s] '
-                  ': %(message)s')
-    filelog.setFormatter(logging.Formatter(format_str))
-    logging.getLogger('').addHandler(filelog)
-
-    gerrit = common.GerritRest(**config['gerrit.rest'])
-    session_factory = orm.init_sql(config['db_url'])
-    app = daemon.MergeDaemon(config, gerrit, session_factory())
+    add_file_log('{}/app.log'.format(config['log_path']))
 
+    gerrit = common.get_gerrit(config, 'daemon')
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
+    # The config is not part of the watch manifest, changes to the
+    # config are hot-reloaded by the daemon (see `MergeDaemon.reload_config`)
+    app = daemon.MergeDaemon(config, gerrit, session_factory(),
+                             config_path=os.path.realpath(args.config_path))
     watch_manifest = functions.get_watch_manifest()
-    realpath_config = os.path.realpath(args.config_path)
-    config_manifest = [(realpath_config, os.path.getmtime(realpath_config))]
-
-    watch_manifest = sorted(watch_manifest + config_manifest)
 
     exit_code = 1
     try:
@@ -192,6 +276,49 @@ class Daemon(Command):
     sys.exit(exit_code)
 
 
+class Master(Command):
+  """
+  Start the job dispatcher for a fleet of builders.
+  """
+
+  @classmethod
+  def run_args(cls, config, args):
+    add_file_log('{}/master.log'.format(config['log_path']))
+    gerrit = common.get_gerrit(config, 'master')
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
+
+    from gerrit_mq import master
+    master.main(config, gerrit, session_factory)
+
+
+class Worker(Command):
+  """
+  Execute a builder process which leases merges from the master.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('builder_name',
+                           help='name of this builder in the `builders` '
+                                'config')
+
+  @classmethod
+  def run_args(cls, config, args):
+    add_file_log('{}/worker_{}.log'.format(config['log_path'],
+                                           args.builder_name))
+    gerrit = common.get_gerrit(config, 'worker')
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
+
+    from gerrit_mq import worker
+    app = worker.Worker(config, gerrit, session_factory(), args.builder_name)
+
+    exit_code = 1
+    try:
+      exit_code = app.run()
+    except:  # pylint: disable=bare-except
+      logging.exception('Exiting worker due to uncought exception')
+
+    sys.exit(exit_code)
 
 
 class RenderTemplates(Command):
@@ -224,7 +351,7 @@ class SyncAccountTable(Command):
   @classmethod
   def run_args(cls, config, args):  # pylint: disable=unused-argument
     gerrit = common.GerritRest(**config['gerrit.rest'])
-    session_factory = orm.init_sql(config['db_url'])
+    session_factory = orm.init_sql(config['db_url'], config.get('sqlite'))
     functions.sync_account_db(gerrit, session_factory())
 
 
@@ -235,7 +362,7 @@ class MigrateDatabase(Command):
 
   @staticmethod
   def setup_parser(subparser):
-    db_versions = ['0.1.0', '0.2.0', '0.2.1']
+    db_versions = ['0.1.0', '0.2.0', '0.2.1', '0.3.0', '0.4.0']
     subparser.add_argument('input_path',
                            help='Path to the source database')
     subparser.add_argument('output_path',
@@ -248,8 +375,8 @@ class MigrateDatabase(Command):
   @classmethod
   def run_args(cls, config, args):
     gerrit = common.GerritRest(**config['gerrit.rest'])
-    functions.migrate_db(gerrit, args.input_path, args.from_version,
-                         args.output_path, args.to_version)
+    migrations.migrate_db(gerrit, args.input_path, args.from_version,
+                          args.output_path, args.to_version)
 
 
 class FetchMissingAccountInfo(Command):
@@ -336,16 +463,12 @@ def main(argv):
       "The requested config file {} does not exist".format(args.config_path))
 
   try:
-    globals_ = {}
-    with io.open(args.config_path, 'r', encoding='utf-8') as infile:
-      exec(infile.read(), globals_) # pylint: disable=W0122
-
+    config = common.load_config(args.config_path)
   except:  # pylint: disable=bare-except
     traceback.print_exc()
     sys.stderr.write('Failed to execute config file\n')
     return 1
 
-  config = common.ConfigDict(globals_)
   for command in commands:
     if args.command == command.get_cmd():
       if args.log_level is None:
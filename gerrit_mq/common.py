@@ -1,12 +1,28 @@
 """Provides common functionality for unattended merge tools."""
 
 import datetime
+import io
 import json
 import logging
+import math
+import random
+import re
+import socket
+import threading
+import time
 import urllib
 
 import pygerrit2.rest
 import requests
+import requests.adapters
+
+# Requests < 2.16 vendors its own urllib3
+try:
+  from urllib3 import connection as urllib3_connection
+  from urllib3.util import retry as urllib3_retry
+except ImportError:
+  from requests.packages.urllib3 import connection as urllib3_connection
+  from requests.packages.urllib3.util import retry as urllib3_retry
 
 
 class ConfigDict(dict):
@@ -64,6 +80,18 @@ class ConfigDict(dict):
       return super(ConfigDict, self).get(key, default)
 
 
+def load_config(config_path):
+  """
+  Execute the python config file at `config_path` and return its globals as a
+  `ConfigDict`.
+  """
+
+  globals_ = {}
+  with io.open(config_path, 'r', encoding='utf-8') as infile:
+    exec(infile.read(), globals_) # pylint: disable=W0122
+  return ConfigDict(globals_)
+
+
 def is_valid_changeinfo(json_dict):
   """
   Simple sanity check on a ChangeInfo object. Ensures that it at least
@@ -79,6 +107,67 @@ def is_valid_changeinfo(json_dict):
 GERRIT_TIME_SHORT_FMT = '%Y-%m-%d %H:%M:%S'
 GERRIT_TIME_FMT = '%Y-%m-%d %H:%M:%S.%f'
 
+# Memo of parsed gerrit timestamps, keyed on the raw string. The same label
+# dates are seen on every poll until the change leaves the queue.
+GERRIT_TIME_CACHE = {}
+GERRIT_TIME_CACHE_SIZE = 10000
+
+# Matches a gerrit timestamp, capturing each field and up to six digits of the
+# fractional part
+GERRIT_TIME_REGEX = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d{0,6})\d*)?$')
+
+
+def parse_gerrit_time_slow(time_str):
+  """
+  Parse a gerrit timestamp with `strptime`. Gerrit reports nanoseconds, which
+  `strptime` can't handle, but they are always trailing zeros.
+  """
+
+  if '.' not in time_str:
+    return datetime.datetime.strptime(time_str, GERRIT_TIME_SHORT_FMT)
+
+  # strip trailing zeros so that strptime doesn't complain
+  time_str = time_str.rstrip('0')
+
+  # but if we've stripped all the way to the dot, we've gone too far,
+  # and strptime will complain
+  if time_str.endswith('.'):
+    time_str += '0'
+
+  return datetime.datetime.strptime(time_str, GERRIT_TIME_FMT)
+
+
+def parse_gerrit_time(time_str):
+  """
+  Parse a gerrit timestamp like "2017-01-02 03:04:05.678000000" (the
+  fractional part is optional) into a datetime. Fractions of a microsecond are
+  truncated.
+  """
+
+  result = GERRIT_TIME_CACHE.get(time_str, None)
+  if result is not None:
+    return result
+
+  # The format is fixed so we just match out the fields, which is
+  # much faster than strptime. Anything unexpected goes the slow way.
+  match = GERRIT_TIME_REGEX.match(time_str)
+  if match is not None:
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+      result = datetime.datetime(int(year), int(month), int(day), int(hour),
+                                 int(minute), int(second),
+                                 int((fraction or '').ljust(6, '0')))
+    except ValueError:
+      result = None
+  if result is None:
+    result = parse_gerrit_time_slow(time_str)
+
+  if len(GERRIT_TIME_CACHE) >= GERRIT_TIME_CACHE_SIZE:
+    GERRIT_TIME_CACHE.clear()
+  GERRIT_TIME_CACHE[time_str] = result
+  return result
+
 
 def sort_merge_queue_labels(label_entries):
   """
@@ -87,6 +176,10 @@ def sort_merge_queue_labels(label_entries):
   by date.
 
   Returns a list of (time, score) tuples.
+
+  NOTE: `resolve_merge_queue_labels` does the same job (together with
+  `get_resolved_merge_queue_score`) in a single pass and is what the queue
+  uses. This is the reference implementation.
   """
 
   timestamped_list = []
@@ -98,15 +191,7 @@ def sort_merge_queue_labels(label_entries):
     if 'value' not in label_entry:
       continue
 
-    # strip trailing zeros so that strptime doesn't complain
-    label_date_str = label_entry['date'].rstrip('0')
-
-    # but if we've stripped all the way to the dot, we've gone too far,
-    # and strptime will complain
-    if label_date_str.endswith('.'):
-      label_date_str += '0'
-
-    label_time = datetime.datetime.strptime(label_date_str, GERRIT_TIME_FMT)
+    label_time = parse_gerrit_time_slow(label_entry['date'])
     timestamped_list.append((label_time, label_entry['value']))
 
   return sorted(timestamped_list)
@@ -132,14 +217,70 @@ def get_resolved_merge_queue_score(sorted_labels):
   return resolved_time, resolved_score
 
 
+def resolve_merge_queue_labels(label_entries):
+  """
+  Given a list of Merge-Queue label entries, find the earliest '+1' after the
+  latest '-1', if it exists, and return (time, 1). Otherwise return
+  (now, -1). This is the same as
+  `get_resolved_merge_queue_score(sort_merge_queue_labels(label_entries))`
+  but without sorting, and with memoized timestamp parsing.
+  """
+
+  latest_block = None
+  approvals = []
+  for label_entry in label_entries:
+    # if a user sets the value of the Merge-Queue label to 0 the date is
+    # removed
+    if 'date' not in label_entry:
+      continue
+    value = label_entry.get('value', None)
+    if value == -1:
+      label_time = parse_gerrit_time(label_entry['date'])
+      if latest_block is None or label_time > latest_block:
+        latest_block = label_time
+    elif value == 1:
+      approvals.append(parse_gerrit_time(label_entry['date']))
+
+  # A +1 at the same time as the -1 wins, as in the sorted order
+  earliest = None
+  for label_time in approvals:
+    if latest_block is not None and label_time < latest_block:
+      continue
+    if earliest is None or label_time < earliest:
+      earliest = label_time
+
+  if earliest is None:
+    return datetime.datetime.utcnow(), -1
+  return earliest, 1
+
+
+def percentile(values, pct):
+  """
+  Return the `pct` percentile (0 to 100) of `values` using the nearest-rank
+  method. Returns None if `values` is empty.
+  """
+
+  if not values:
+    return None
+
+  ordered = sorted(values)
+  rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+  return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
 def gerrit_query(filters):
   """
   Format a query string given gerrit query filters. The query string is
   composed of url-encoded space ('+') separated key:value pairs. The value
-  will be quoted if it contains whitespace like key:"value x".
+  will be quoted if it contains whitespace like key:"value x". If the value is
+  a list then the pair matches any of the values, like (key:a OR key:b).
   """
   pairs = []
   for key, value in sorted(filters):
+    if isinstance(value, (list, tuple)):
+      pairs.append('(' + '+OR+'.join(gerrit_query([(key, item)])
+                                     for item in sorted(value)) + ')')
+      continue
     value = urllib.quote_plus(value)
     if '+' in value:
       pairs.append('{}:"{}"'.format(key, value))
@@ -153,6 +294,8 @@ class AccountInfo(object):  # pylint: disable=no-init
   Information about a gerrit user
   """
 
+  __slots__ = ('account_id', 'username', 'name', 'email')
+
   def __init__(self, _account_id, username, name, email,
                rid=None):  # pylint:disable=unused-argument
     self.account_id = _account_id
@@ -160,6 +303,13 @@ class AccountInfo(object):  # pylint: disable=no-init
     self.name = name
     self.email = email
 
+  @classmethod
+  def from_sql(cls, account):
+    """
+    Construct from an `orm.AccountInfo` row
+    """
+    return cls(account.rid, account.username, account.name, account.email)
+
   def as_dict(self):
     result = {key: getattr(self, key) for key
               in ['name', 'email', 'username']}
@@ -172,6 +322,9 @@ class ChangeInfo(object):
   Information about a gerrit change
   """
 
+  __slots__ = ('project', 'branch', 'change_id', 'subject', 'current_revision',
+               'owner', 'message_meta', 'queue_time', 'queue_score')
+
   def __init__(self, project, branch,  # pylint: disable=unused-argument
                change_id, subject, current_revision, owner, queue_time,
                queue_score, message_meta=None, **kwargs):
@@ -180,7 +333,10 @@ class ChangeInfo(object):
     self.change_id = change_id
     self.subject = subject
     self.current_revision = current_revision
-    self.owner = AccountInfo(**owner)
+    if isinstance(owner, AccountInfo):
+      self.owner = owner
+    else:
+      self.owner = AccountInfo(**owner)
     if message_meta is None:
       self.message_meta = {}
     else:
@@ -188,13 +344,30 @@ class ChangeInfo(object):
     if isinstance(queue_time, datetime.datetime):
       self.queue_time = queue_time
     elif isinstance(queue_time, str) or isinstance(queue_time, unicode):
-      self.queue_time = datetime.datetime.strptime(queue_time,
-                                                   GERRIT_TIME_SHORT_FMT)
+      self.queue_time = parse_gerrit_time(queue_time)
     else:
       raise ValueError('Unrecognized queue_time type of {}'
                        .format(type(queue_time)))
     self.queue_score = queue_score
 
+  @classmethod
+  def from_sql(cls, change):
+    """
+    Construct from an `orm.ChangeInfo` row. Load the rows with the owner
+    relationship eagerly (see `functions.get_queue`) or each row will query
+    for its owner.
+    """
+    if change.owner is None:
+      owner = AccountInfo(change.owner_id, None, None, None)
+    else:
+      owner = AccountInfo.from_sql(change.owner)
+    message_meta = None
+    if change.message_meta:
+      message_meta = json.loads(change.message_meta)
+    return cls(change.project, change.branch, change.change_id, change.subject,
+               change.current_revision, owner, change.queue_time,
+               change.queue_score, message_meta)
+
   def as_dict(self):
     result = {key: getattr(self, key) for key
               in ['project', 'branch', 'subject', 'current_revision', 'owner',
@@ -218,23 +391,161 @@ class ChangeInfo(object):
             changeinfo.change_id)
 
 
+# HTTP status codes of failed GETs which are worth retrying
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class SharedDigestAuth(requests.auth.HTTPDigestAuth):
+  """
+  Digest authentication which shares the server's challenge (nonce) between
+  threads. `requests` keeps the challenge per-thread, so every new thread
+  (e.g. every request to the threaded webfront) first pays for a 401 round
+  trip to get a challenge of its own.
+  """
+
+  def __init__(self, username, password):
+    super(SharedDigestAuth, self).__init__(username, password)
+    self.lock = threading.Lock()
+    self.shared_chal = {}
+    self.shared_nonce_count = 0
+
+  def sync_state(self):
+    """
+    Publish the challenge of this thread if it is new, otherwise adopt the
+    shared challenge. Must be called with `lock` held.
+    """
+    local = self._thread_local
+    nonce = local.chal.get('nonce', None)
+    if nonce is not None and nonce != getattr(local, 'synced_nonce', None):
+      # This thread was just challenged by the server
+      self.shared_chal = local.chal
+      self.shared_nonce_count = 0
+
+    if self.shared_chal:
+      local.chal = self.shared_chal
+      local.nonce_count = self.shared_nonce_count
+      local.last_nonce = ''
+      if self.shared_nonce_count:
+        local.last_nonce = self.shared_chal['nonce']
+      local.synced_nonce = self.shared_chal['nonce']
+
+  def build_digest_header(self, method, url):
+    with self.lock:
+      self.sync_state()
+      header = super(SharedDigestAuth, self).build_digest_header(method, url)
+      self.shared_nonce_count = self._thread_local.nonce_count
+    return header
+
+  def __call__(self, request):
+    self.init_per_thread_state()
+    with self.lock:
+      if not self._thread_local.last_nonce and self.shared_nonce_count:
+        self.sync_state()
+    return super(SharedDigestAuth, self).__call__(request)
+
+
+class KeepAliveAdapter(requests.adapters.HTTPAdapter):
+  """
+  Transport adapter which enables TCP keep-alive on pooled connections so that
+  idle connections to gerrit aren't silently dropped by firewalls and NATs.
+  """
+
+  def init_poolmanager(self, connections, maxsize, block=False,
+                       **pool_kwargs):
+    pool_kwargs['socket_options'] = (
+        urllib3_connection.HTTPConnection.default_socket_options
+        + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)])
+    super(KeepAliveAdapter, self).init_poolmanager(connections, maxsize,
+                                                   block=block, **pool_kwargs)
+
+
+def get_endpoint_label(endpoint):
+  """
+  Return the REST endpoint with the query string removed and ids (change ids,
+  revisions, account names, ...) replaced by '*', for labeling metrics.
+  """
+  path = endpoint.split('?', 1)[0].strip('/')
+  return '/'.join(part if re.match('^[a-z_-]+$', part) else '*'
+                  for part in path.split('/'))
+
+
 class GerritRest(pygerrit2.rest.GerritRestAPI):
   """
   Provides a high-level interface to the Gerrit REST API for the few specific
   queries we need. This is shared between the unattende merge daemon and the
   web front-end so that the web front-end see's the same queue as the daemon.
+
+  Connections are pooled and kept alive (`pool_size` connections per host).
+  Every request has a `connect_timeout` and `read_timeout` in seconds. Failed
+  connections are retried for any request, but only GETs are retried after
+  the request was sent: up to `max_retries` times with jittered exponential
+  backoff starting at `retry_backoff` seconds.
   """
 
   def __init__(self, url, username, password,
-               disable_ssl_certificate_validation=False):
-    auth = requests.auth.HTTPDigestAuth(username, password)
+               disable_ssl_certificate_validation=False, pool_size=4,
+               connect_timeout=5.0, read_timeout=30.0, max_retries=3,
+               retry_backoff=0.5):
+    auth = SharedDigestAuth(username, password)
     verify = (not disable_ssl_certificate_validation)
-    super(GerritRest, self).__init__(url=url, auth=auth, verify=verify)
+    adapter = KeepAliveAdapter(
+        pool_connections=1, pool_maxsize=pool_size,
+        max_retries=urllib3_retry.Retry(connect=max_retries, read=0, status=0,
+                                        redirect=5,
+                                        backoff_factor=retry_backoff))
+    super(GerritRest, self).__init__(url=url, auth=auth, verify=verify,
+                                     adapter=adapter)
+    self.kwargs['timeout'] = (connect_timeout, read_timeout)
+    self.max_retries = max_retries
+    self.retry_backoff = retry_backoff
 
     if disable_ssl_certificate_validation:
       from requests.packages import urllib3
       urllib3.disable_warnings()
 
+  def timed_request(self, method, endpoint, **kwargs):
+    """
+    Execute the request, recording its latency in the `gerrit_request_seconds`
+    histogram labeled by method and endpoint.
+    """
+    # Metrics imports this module
+    from gerrit_mq import metrics
+    with metrics.timer('gerrit_request_seconds', method=method.upper(),
+                       endpoint=get_endpoint_label(endpoint)):
+      return getattr(super(GerritRest, self), method)(endpoint, **kwargs)
+
+  def get(self, endpoint, return_response=False, **kwargs):
+    attempt = 0
+    while True:
+      try:
+        return self.timed_request('get', endpoint,
+                                  return_response=return_response, **kwargs)
+      except (requests.ConnectionError, requests.Timeout,
+              requests.HTTPError) as ex:
+        response = getattr(ex, 'response', None)
+        retryable = (response is None
+                     or response.status_code in RETRY_STATUS_CODES)
+        if not retryable or attempt >= self.max_retries:
+          raise
+        delay = (self.retry_backoff * (2 ** attempt)
+                 * random.uniform(0.5, 1.5))
+        logging.warn('GET %s failed (%s), retrying in %.1f seconds',
+                     get_endpoint_label(endpoint), ex, delay)
+        time.sleep(delay)
+        attempt += 1
+
+  def put(self, endpoint, return_response=False, **kwargs):
+    return self.timed_request('put', endpoint,
+                              return_response=return_response, **kwargs)
+
+  def post(self, endpoint, return_response=False, **kwargs):
+    return self.timed_request('post', endpoint,
+                              return_response=return_response, **kwargs)
+
+  def delete(self, endpoint, return_response=False, **kwargs):
+    return self.timed_request('delete', endpoint,
+                              return_response=return_response, **kwargs)
+
   def get_merge_requests(self, offset=0, limit=25, filters=None):
     """
     Call out the gerrit REST API and return a list of all changes that are
@@ -260,9 +571,7 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
     # NOTE(josh): status: 'open' include 'new' and 'submitted', where
     # 'submitted' means that gerrit has not yet merged it. We want to exclude
     # 'submitted'.
-    if filters is None:
-      filters = []
-
+    filters = list(filters or [])
     filters += [('status', 'new'),
                 ('label', 'code-review=+2'),
                 ('label', 'merge-queue=+1')]
@@ -298,8 +607,7 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
                    .get('labels', {})
                    .get('Merge-Queue', {})
                    .get('all', []))
-      sorted_labels = sort_merge_queue_labels(mq_labels)
-      queue_time, queue_score = get_resolved_merge_queue_score(sorted_labels)
+      queue_time, queue_score = resolve_merge_queue_labels(mq_labels)
 
       if queue_score == 1:
         commit_message_meta = self.get_message_meta(
@@ -347,8 +655,7 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
                  .get('labels', {})
                  .get('Merge-Queue', {})
                  .get('all', []))
-    sorted_labels = sort_merge_queue_labels(mq_labels)
-    queue_time, queue_score = get_resolved_merge_queue_score(sorted_labels)
+    queue_time, queue_score = resolve_merge_queue_labels(mq_labels)
 
     json_dict['queue_time'] = queue_time
     json_dict['queue_score'] = queue_score
@@ -375,8 +682,7 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
                    .get('labels', {})
                    .get('Merge-Queue', {})
                    .get('all', []))
-      sorted_labels = sort_merge_queue_labels(mq_labels)
-      _, queue_score = get_resolved_merge_queue_score(sorted_labels)
+      _, queue_score = resolve_merge_queue_labels(mq_labels)
       if queue_score != 1:
         canceled_ids.append(changeinfo['change_id'])
     return canceled_ids
@@ -421,6 +727,11 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
     return result
 
   def submit_change(self, change_id, author_id=None):
+    """
+    Submit a change. Returns the ChangeInfo json of the change, or a
+    dictionary with `status` ERROR and the reason in `message` if gerrit
+    refused to submit it.
+    """
     request_url = 'changes/{}/submit'.format(change_id)
 
     try:
@@ -429,15 +740,40 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
       else:
         return self.post(request_url)
 
+    except requests.RequestException as ex:
+      logging.exception('Failed to submit change %s', change_id)
+      message = str(ex)
+      if getattr(ex, 'response', None) is not None and ex.response.text:
+        message = ex.response.text.strip()
+      return {'status': 'ERROR', 'message': message}
+
+  def set_topic(self, change_id, topic):
+    """
+    Set the topic of a change. Returns true on success.
+    """
+    try:
+      self.put('changes/{}/topic'.format(change_id), json={'topic': topic})
     except requests.RequestException:
-      logging.exception('Failed to set review score for change %s', change_id)
+      logging.exception('Failed to set topic of change %s', change_id)
+      return False
+    return True
+
+  def get_change_status(self, change_id):
+    """
+    Return the status of a change (NEW, MERGED, ABANDONED, ...) or None if it
+    can't be retrieved.
+    """
+    try:
+      return self.get('changes/{}'.format(change_id)).get('status', None)
+    except (requests.RequestException, ValueError, AttributeError):
+      logging.exception('Failed to get the status of change %s', change_id)
       return None
 
   def set_review(self, change_id, current_revision, review_dict):
     """
     Call out to the gerrit REST API to set a review comment on the specified
     change. The format for the review_dict is that of a ReviewInput json
-    object.
+    object. Returns true if the review was posted.
 
     See: https://gerrit-review.googlesource.com/Documentation/
          rest-api-changes.html#review-input.
@@ -448,6 +784,21 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
       self.post(request_url, json=review_dict)
     except requests.RequestException:
       logging.exception('Failed to set review score for change %s', change_id)
+      return False
+    return True
+
+  def has_message(self, change_id, message, since):
+    """
+    Return true if a message containing `message` was posted to the change
+    at or after `since` (a utc datetime). Gerrit prefixes the text of a review
+    with the patch set and votes, so the message is matched as a substring.
+    """
+    json_dict = self.get('changes/{}?o=MESSAGES'.format(change_id))
+    for message_info in json_dict.get('messages', []):
+      if (message in message_info.get('message', '')
+          and parse_gerrit_time(message_info['date']) >= since):
+        return True
+    return False
 
   def get_username_from_email(self, email_address):
     """
@@ -461,3 +812,15 @@ class GerritRest(pygerrit2.rest.GerritRestAPI):
     except requests.RequestException:
       logging.exception('Failed to get username for email %s', email_address)
       return None
+
+
+def get_gerrit(config, component=None):
+  """
+  Return a `GerritRest` for the settings in `gerrit.rest`. Settings in
+  `<component>.gerrit_rest` (e.g. a larger `pool_size` for the webfront)
+  override them.
+  """
+  kwargs = dict(config['gerrit.rest'])
+  if component is not None:
+    kwargs.update(config.get(component + '.gerrit_rest', {}))
+  return GerritRest(**kwargs)
@@ -6,18 +6,31 @@ them in serial order.
 import datetime
 import json
 import logging.handlers
+import multiprocessing.pool
 import os
 import re
+import shutil
 import signal
+import socket
 import subprocess
+import tempfile
+import threading
 import time
 
 import git
 import httplib2
 import requests
+import sqlalchemy
 
+from gerrit_mq import common
 from gerrit_mq import orm
 from gerrit_mq import functions
+from gerrit_mq import metrics
+from gerrit_mq import outbox
+from gerrit_mq import polling
+from gerrit_mq import scheduler
+from gerrit_mq import supervisor
+from gerrit_mq import watcher
 
 # TODO(josh): split this module
 # pylint: disable=too-many-lines
@@ -62,6 +75,36 @@ removal:
 
 """
 
+TIMEOUT_TPL = """
+
+********************************
+Merge timed out on step {stepno} after {elapsed:.0f} seconds ({reason}).
+The following command was killed:
+{command}
+********************************
+
+"""
+
+RETRY_TPL = """
+
+********************************
+Step {stepno} failed with return code {retcode} (attempt {attempt}/{max_attempts}).
+The step is retryable so it will be executed again:
+{command}
+********************************
+
+"""
+
+PREEMPT_TPL = """
+
+********************************
+Merge preempted by the following higher priority changes:
+%s
+The changes of this merge remain queued and will be verified again.
+********************************
+
+"""
+
 WEBFRONT_CANCEL = """
 
 ********************************
@@ -73,6 +116,260 @@ Merge was canceled through the webfront
 """
 
 
+# Key used in the step timing table for the duration of an entire
+# verification (all build steps).
+MERGE_TIMING_KEY = '__merge__'
+
+
+class BuildStep(object):
+  """
+  A single command executed to verify a merge. In the configuration a step
+  may be given either as a list (just the command) or as a dictionary with
+  the following keys:
+
+    * command: the command to execute, as a list
+    * name: [optional] name for the step, used to identify the step in the
+      timing history and in `depends`. Defaults to the index of the step.
+    * timeout: [optional] time budget for this step, overriding the queue's
+      `step_timeout`. See `resolve_time_budget` for the format.
+    * depends: [optional] list of names of steps which must succeed before
+      this step is started. If not specified, the step depends on the step
+      listed before it, so a plain list of steps is executed serially. Steps
+      with ``'depends': []`` may start immediately.
+    * retryable: [optional] if true, a failure of this step is retried
+      according to the queue's `retry_policy` before the merge is failed.
+      Only mark steps which are known to fail transiently (e.g. flaky tests).
+  """
+
+  def __init__(self, command, name=None, timeout=None, depends=None,
+               retryable=False):
+    self.command = list(command)
+    self.name = name
+    self.timeout = timeout
+    self.retryable = retryable
+    if depends is None:
+      self.depends = None
+    else:
+      self.depends = list(depends)
+
+  def get_command_str(self):
+    return ' '.join(self.command)
+
+  def as_dict(self):
+    return {'command': self.command, 'name': self.name,
+            'timeout': self.timeout, 'depends': self.depends,
+            'retryable': self.retryable}
+
+
+def make_build_step(step_idx, step_spec):
+  """
+  Construct a BuildStep from an entry of `build_steps` in the queue
+  configuration.
+  """
+
+  if isinstance(step_spec, dict):
+    step = BuildStep(**step_spec)
+  else:
+    step = BuildStep(step_spec)
+
+  if step.name is None:
+    step.name = '{:d}'.format(step_idx)
+  return step
+
+
+def make_build_steps(step_specs):
+  """
+  Construct the list of BuildSteps for a queue, resolving implicit
+  dependencies and verifying that the dependencies form a DAG. Steps are
+  returned in their configured order, which is also a valid execution order.
+  """
+
+  steps = [make_build_step(step_idx, step_spec)
+           for step_idx, step_spec in enumerate(step_specs)]
+
+  names = set()
+  for step_idx, step in enumerate(steps):
+    if step.name in names:
+      raise ValueError('Duplicate build step name {}'.format(step.name))
+    names.add(step.name)
+
+    if step.depends is None:
+      if step_idx > 0:
+        step.depends = [steps[step_idx - 1].name]
+      else:
+        step.depends = []
+
+  # Require that dependencies are listed before their dependents,
+  # which guarantees that there are no cycles.
+  seen = set()
+  for step in steps:
+    for depname in step.depends:
+      if depname not in names:
+        raise ValueError('Build step {} depends on unknown step {}'
+                         .format(step.name, depname))
+      if depname not in seen:
+        raise ValueError('Build step {} must be listed after its dependency {}'
+                         .format(step.name, depname))
+    seen.add(step.name)
+
+  return steps
+
+
+def resolve_time_budget(budget, durations):
+  """
+  Return an absolute time budget, in seconds, given a budget specification
+  and a list of historical durations for the thing being budgeted. Returns
+  None if there is no budget.
+
+  A budget specification is either a number, which is an absolute budget in
+  seconds, or a dictionary with the following keys:
+
+    * percentile: which percentile of historical durations to use (default 95)
+    * factor: multiply the percentile by this much (default 1.5)
+    * minimum: the budget is never less than this (default 0)
+    * min_samples: how many historical samples are required before the
+      percentile is trusted (default 10)
+    * fallback: the budget to use when there are not enough samples
+      (default None, meaning no budget)
+  """
+
+  if budget is None:
+    return None
+
+  if isinstance(budget, (int, long, float)):
+    return float(budget)
+
+  if len(durations) < budget.get('min_samples', 10):
+    fallback = budget.get('fallback', None)
+    if fallback is None:
+      return None
+    return float(fallback)
+
+  value = (budget.get('factor', 1.5)
+           * common.percentile(durations, budget.get('percentile', 95)))
+  return max(float(value), float(budget.get('minimum', 0)))
+
+
+class TimeBudget(object):
+  """
+  Resolved (absolute) time budgets for one verification, along with the
+  median historical duration of each step which is used to predict whether
+  or not the verification can finish within budget.
+  """
+
+  def __init__(self, merge_budget=None, step_budgets=None,
+               step_estimates=None, predictive_kill=False):
+    self.merge_budget = merge_budget
+    self.step_budgets = dict(step_budgets or {})
+    self.step_estimates = dict(step_estimates or {})
+    self.predictive_kill = predictive_kill
+
+  def get_expected_remaining(self, steps, finished, running_elapsed):
+    """
+    Return the expected time, in seconds, to finish all steps that are not yet
+    `finished`. This is the length of the critical path through the remaining
+    steps, where steps that are running are credited with their elapsed time
+    (given by the `running_elapsed` map of name to seconds). Returns None if
+    any of the remaining steps has no history.
+    """
+
+    finish_time = {}
+    for step in steps:
+      if step.name in finished:
+        finish_time[step.name] = 0.0
+        continue
+
+      estimate = self.step_estimates.get(step.name, None)
+      if estimate is None:
+        return None
+      if step.name in running_elapsed:
+        estimate = max(estimate - running_elapsed[step.name], 0.0)
+
+      start_time = max([finish_time[depname] for depname in step.depends]
+                       + [0.0])
+      finish_time[step.name] = start_time + estimate
+
+    return max(finish_time.values() + [0.0])
+
+  def get_step_expiry_reason(self, step, step_elapsed):
+    """
+    Return a string describing why `step` has exhausted its budget, or None
+    if it is still within budget.
+    """
+
+    step_budget = self.step_budgets.get(step.name, None)
+    if step_budget is not None and step_elapsed > step_budget:
+      return 'step budget of {:.0f} seconds exceeded'.format(step_budget)
+    return None
+
+  def get_merge_expiry_reason(self, merge_elapsed, expected_remaining):
+    """
+    Return a string describing why the verification has exhausted its budget,
+    or None if it is still within budget.
+    """
+
+    if self.merge_budget is None:
+      return None
+
+    if merge_elapsed > self.merge_budget:
+      return 'merge budget of {:.0f} seconds exceeded'.format(
+          self.merge_budget)
+
+    if (self.predictive_kill and expected_remaining is not None
+        and merge_elapsed + expected_remaining > self.merge_budget):
+      return ('predicted to exceed merge budget of {:.0f} seconds, '
+              '{:.0f} seconds of work remaining'
+              .format(self.merge_budget, expected_remaining))
+
+    return None
+
+
+def get_time_budget(sql, queue_spec):
+  """
+  Resolve the time budgets of `queue_spec` against the step timing history
+  stored in the database.
+  """
+
+  def get_durations(step_name):
+    return functions.get_step_durations(sql, queue_spec.project,
+                                        queue_spec.name, step_name)
+
+  step_budgets = {}
+  step_estimates = {}
+  for step in queue_spec.build_steps:
+    durations = get_durations(step.name)
+    step_estimates[step.name] = common.percentile(durations, 50)
+    step_spec = step.timeout
+    if step_spec is None:
+      step_spec = queue_spec.step_timeout
+    step_budgets[step.name] = resolve_time_budget(step_spec, durations)
+
+  merge_budget = None
+  if queue_spec.merge_timeout is not None:
+    merge_budget = resolve_time_budget(queue_spec.merge_timeout,
+                                       get_durations(MERGE_TIMING_KEY))
+
+  return TimeBudget(merge_budget, step_budgets, step_estimates,
+                    queue_spec.predictive_kill)
+
+
+class RetryPolicy(object):
+  """
+  How failures of retryable build steps are retried:
+
+    * max_attempts: total number of times a retryable step is executed before
+      its failure fails the merge (default 1, meaning no retries)
+    * delay: seconds to wait before starting the next attempt (default 0)
+  """
+
+  def __init__(self, max_attempts=1, delay=0):
+    self.max_attempts = max(int(max_attempts), 1)
+    self.delay = delay
+
+  def as_dict(self):
+    return {'max_attempts': self.max_attempts, 'delay': self.delay}
+
+
 class QueueSpec(object):
   """
   Specification of a single queue of serialized merges
@@ -80,18 +377,44 @@ class QueueSpec(object):
 
   def __init__(self, project, branch, build_env, build_steps, name=None,
                merge_build_env=False, submit_with_rest=True, coalesce_count=0,
-               submit_cmd=None):
+               submit_cmd=None, merge_timeout=None, step_timeout=None,
+               predictive_kill=False, max_parallel_steps=1,
+               retry_policy=None, weight=1, submit_strategy='serial'):
     self.project = project
     self.branch = re.compile(branch)
     self.build_env = dict(build_env)
-    self.build_steps = [list(step) for step in build_steps]
+    self.build_steps = make_build_steps(build_steps)
     self.coalesce_count = coalesce_count
 
+    # Relative share of the daemon's time given to this queue when several
+    # queues are backlogged. See `scheduler.FairScheduler`.
+    self.weight = float(weight)
+    assert self.weight > 0, 'Queue weight must be positive'
+
+    # Maximum number of build steps to execute at once. Steps are only
+    # executed in parallel if their dependencies allow it.
+    self.max_parallel_steps = max(int(max_parallel_steps), 1)
+
+    # How to retry failures of steps that are marked `retryable`
+    self.retry_policy = RetryPolicy(**(retry_policy or {}))
+
+    # Time budgets for the whole verification and (default) for each step.
+    # See `resolve_time_budget` for the format. If `predictive_kill` is true
+    # then the verification is killed as soon as the historical step durations
+    # predict that it cannot complete within `merge_timeout`.
+    self.merge_timeout = merge_timeout
+    self.step_timeout = step_timeout
+    self.predictive_kill = predictive_kill
+
     # Changes that were part of a failed coaleced verification. As long as
     # one of these changes is part of the current queue head, changes will
     # be made in serial order.
     self.dirty_changes = set()
 
+    # If the last verification in this queue was preempted, this is the
+    # PreemptedMerge describing the merged state that was kept.
+    self.preempted = None
+
     if name is None:
       assert re.escape(branch) == branch
       self.name = branch
@@ -100,6 +423,12 @@ class QueueSpec(object):
 
     self.merge_build_env = merge_build_env
     self.submit_with_rest = submit_with_rest
+
+    # How verified changes are submitted over REST: 'serial' (one at a time)
+    # or 'topic' (together, see `submit_whole_topic`)
+    assert submit_strategy in ('serial', 'topic'), \
+        'Unknown submit_strategy {}'.format(submit_strategy)
+    self.submit_strategy = submit_strategy
     if submit_cmd is None:
       self.submit_cmd = []
     else:
@@ -115,6 +444,20 @@ class QueueSpec(object):
                                    or isinstance(value, tuple)):
         self.build_env[key] = ':'.join(value)
 
+  def update_dirty_changes(self, change_ids, status):
+    """
+    Update the set of dirty changes given the `status` of a merge which
+    verified the changes `change_ids`.
+    """
+
+    # Preempted and abandoned merges say nothing about the
+    # changes themselves, they will just be verified again.
+    if status == orm.StatusKey.SUCCESS.value:
+      self.dirty_changes.difference_update(change_ids)
+    elif status not in (orm.StatusKey.PREEMPTED.value,
+                        orm.StatusKey.ABANDONED.value):
+      self.dirty_changes.update(change_ids)
+
   def get_workspace(self, base_path):
     """
     Return the repo directory for this queue
@@ -161,6 +504,14 @@ def get_result_message(webfront_url, merge_rid, merge_result):
     result_string = 'successful'
   elif merge_result == orm.StatusKey.CANCELED.value:
     result_string = 'cancelled'
+  elif merge_result == orm.StatusKey.TIMEOUT.value:
+    result_string = 'timed out'
+  elif merge_result == orm.StatusKey.PREEMPTED.value:
+    result_string = ('was preempted by a higher priority change. The change '
+                     'remains queued and will be verified again')
+  elif merge_result == orm.StatusKey.ABANDONED.value:
+    result_string = ('was abandoned by its builder. The change remains queued '
+                     'and will be verified again')
   else:
     result_string = 'failed'
 
@@ -249,6 +600,41 @@ def merge_a_into_b(repo, branch_a, branch_b):
   repo.git.update_environment(**old_env)
 
 
+class PreemptedMerge(object):
+  """
+  The merged state of a verification that was preempted. The branch is kept
+  in the workspace so that if the same changes are verified next, they don't
+  need to be merged together again.
+  """
+
+  def __init__(self, branch, change_queue):
+    self.branch = branch
+    self.target_branch = change_queue[0].branch
+    self.revisions = get_revisions(change_queue)
+
+  def matches(self, change_queue):
+    return (change_queue[0].branch == self.target_branch
+            and get_revisions(change_queue) == self.revisions)
+
+
+def get_revisions(change_queue):
+  return [(changeinfo.change_id, changeinfo.current_revision)
+          for changeinfo in change_queue]
+
+
+def reuse_preempted_merge(repo, merge_branch, preempted):
+  """
+  Create the merge branch from the branch kept for a preempted merge of the
+  same changes, and merge the (possibly updated) target branch into it.
+  """
+  logging.info('Reusing merged state of preempted merge from branch %s',
+               preempted.branch)
+  repo.git.checkout(preempted.branch)
+  new_branch = repo.create_head(merge_branch)
+  new_branch.checkout()
+  merge_a_into_b(repo, preempted.target_branch, merge_branch)
+
+
 def merge_features_together(repo, merge_branch, change_queue):
   """
   Create a new branch, merge all the changes into it the amature way.
@@ -269,6 +655,17 @@ def merge_features_together(repo, merge_branch, change_queue):
     merge_a_into_b(repo, feature_branch, merge_branch)
 
 
+def signal_step(step_proc, signum):
+  """
+  Send `signum` to the process group of a build step. Build steps are started
+  in their own session so this reaches any subprocess the step has spawned.
+  """
+  try:
+    os.killpg(step_proc.pid, signum)
+  except OSError:
+    pass
+
+
 def kill_step(step_proc):
   logging.info('Waiting for build step to die, pid=%d', step_proc.pid)
   start_time = time.time()
@@ -276,7 +673,7 @@ def kill_step(step_proc):
   if step_proc.returncode is None:
     logging.info('Signalling with SIGTERM')
   while step_proc.poll() is None:
-    step_proc.send_signal(signal.SIGTERM)
+    signal_step(step_proc, signal.SIGTERM)
     time.sleep(2)
     if time.time() - start_time > 10:
       break
@@ -285,42 +682,137 @@ def kill_step(step_proc):
     logging.info('Signalling with SIGKILL')
 
   while step_proc.poll() is None:
-    step_proc.send_signal(signal.SIGKILL)
+    signal_step(step_proc, signal.SIGKILL)
     time.sleep(2)
-    if time.time() - start_time > 10:
+    if time.time() - start_time > 20:
       break
 
-  logging.info('Build step appears to be zombified. Hopefully it does not'
-               'affect future merges')
+  # The group leader may exit on SIGTERM while some of its
+  # children ignore it, so make sure that nothing is left in the group.
+  signal_step(step_proc, signal.SIGKILL)
+
+  if step_proc.returncode is None:
+    logging.info('Build step appears to be zombified. Hopefully it does not'
+                 ' affect future merges')
 
 
-def mark_old_changes_as_failed(sql):
+def mark_old_changes_as_failed(sql, keep_ids=()):
   """
   If the daemon was killed during a merge, then mark that merge as failed.
+  Merges listed in `keep_ids` are about to be resumed and are left alone.
   """
 
   query = (sql.query(orm.MergeStatus)
            .filter(orm.MergeStatus.status == orm.StatusKey.IN_PROGRESS.value))
   for merge_status in query:
+    if merge_status.rid in keep_ids:
+      continue
     logging.info('Marking stale merge status %d as failed', merge_status.rid)
     merge_status.status = orm.StatusKey.CANCELED.value
   sql.commit()
 
 
-def submit_changes_with_rest(gerrit, change_queue):
+def get_change_statuses(gerrit, change_ids):
   """
-  Submit the list of changes through the gerrit REST api
+  Return a dictionary mapping each of `change_ids` to its status on gerrit.
+  The statuses are retrieved concurrently.
+  """
+  if not change_ids:
+    return {}
+
+  pool = multiprocessing.pool.ThreadPool(min(len(change_ids), 8))
+  try:
+    statuses = pool.map(gerrit.get_change_status, change_ids)
+  finally:
+    pool.close()
+    pool.join()
+  return dict(zip(change_ids, statuses))
+
+
+def submit_whole_topic(gerrit, change_queue, topic):
+  """
+  Put all of the changes of `change_queue` in `topic` and submit them with a
+  single request. This requires `change.submitWholeTopic` to be enabled on the
+  gerrit server, in which case gerrit merges all of the changes or none of
+  them.
   """
   for changeinfo in change_queue:
-    logging.info('Submitting %s through REST API',
-                 changeinfo.change_id)
+    if not gerrit.set_topic(changeinfo.change_id, topic):
+      return
+  logging.info('Submitting %d changes as topic %s through REST API',
+               len(change_queue), topic)
+  gerrit.submit_change(change_queue[-1].change_id)
+
+
+def submit_changes_with_rest(gerrit, change_queue, strategy='serial',
+                             topic=None):
+  """
+  Submit the list of changes through the gerrit REST api, in order. Returns a
+  dictionary mapping change id to a (`SubmitStatusKey` value, message) pair.
+
+  If `strategy` is 'topic' then all of the changes are first submitted
+  together as `topic` (see `submit_whole_topic`). Any changes which that
+  didn't merge are then submitted one at a time. If gerrit refuses a change,
+  then its status is checked again since the submit may have failed after
+  the change was merged. If it really wasn't merged then the remaining
+  changes are skipped, because they were verified on top of it.
+  """
+  outcomes = dict((changeinfo.change_id, None) for changeinfo in change_queue)
+  if strategy == 'topic' and len(change_queue) > 1:
+    submit_whole_topic(gerrit, change_queue, topic)
+    statuses = get_change_statuses(
+        gerrit, [changeinfo.change_id for changeinfo in change_queue])
+    for change_id, status in statuses.iteritems():
+      if status == 'MERGED':
+        outcomes[change_id] = (orm.SubmitStatusKey.MERGED.value,
+                               'Submitted as topic {}'.format(topic))
+
+  refused_id = None
+  for changeinfo in change_queue:
+    change_id = changeinfo.change_id
+    if outcomes[change_id] is not None:
+      continue
+    if refused_id is not None:
+      outcomes[change_id] = (orm.SubmitStatusKey.SKIPPED.value,
+                             'Not submitted because {} was refused'
+                             .format(refused_id))
+      continue
+
+    logging.info('Submitting %s through REST API', change_id)
     # NOTE(josh): on-behalf-of appears to be restricted with our current
     # configuration. Otherwise use changeinfo.owner.account_id or the
     # account_id of whoever supplied the resolved mergequeue score
-    response = gerrit.submit_change(changeinfo.change_id)
-    if response.get('status') != 'SUBMITTED':
-      logging.warn('Gerrit refused to submit the change over REST')
-      break
+    response = gerrit.submit_change(change_id)
+    status = response.get('status')
+    if status == 'MERGED':
+      outcomes[change_id] = (orm.SubmitStatusKey.MERGED.value, None)
+    elif status == 'SUBMITTED':
+      outcomes[change_id] = (orm.SubmitStatusKey.SUBMITTED.value, None)
+    elif gerrit.get_change_status(change_id) == 'MERGED':
+      outcomes[change_id] = (orm.SubmitStatusKey.MERGED.value,
+                             response.get('message', None))
+    else:
+      message = response.get('message',
+                             'Unexpected change status {}'.format(status))
+      logging.warn('Gerrit refused to submit %s over REST: %s', change_id,
+                   message)
+      outcomes[change_id] = (orm.SubmitStatusKey.REFUSED.value, message)
+      refused_id = change_id
+
+  return outcomes
+
+
+def record_submit_outcomes(sql, merge_id, outcomes):
+  """
+  Store the outcome of submitting each change of merge `merge_id` (as returned
+  by `submit_changes_with_rest`) in the merge_changes table.
+  """
+  query = (sql.query(orm.MergeChange)
+           .filter(orm.MergeChange.merge_id == merge_id))
+  for change in query:
+    if outcomes.get(change.change_id, None) is not None:
+      change.submit_status, change.submit_message = outcomes[change.change_id]
+  sql.commit()
 
 
 def submit_changes_with_cmd(repo, change_queue, submit_cmd, popen_kwargs):
@@ -386,116 +878,578 @@ def create_sql_records(sql, queue_spec, change_queue):
   return merge
 
 
-def run_steps(queue_spec, gerrit, change_queue, sql_session, merge_id,
-              popen_kwargs):
+def write_to_logs(popen_kwargs, message):
   """
-  Performs each build, test step.
+  Write a message into both the stdout and stderr logs of a merge.
   """
+  for stream in ['stdout', 'stderr']:
+    log = popen_kwargs[stream]
+    log.write(message)
+    log.flush()
 
-  logging.info('Performing build/test steps')
 
-  for step_idx, step_cmd in enumerate(queue_spec.build_steps):
-    # Reset every step so we check at least once per step
-    last_gerrit_poll = 0
-    last_db_poll = 0
-    last_timing_print = 0
-    step_start_time = time.time()
-
-    # Write the command that we are running for this step into the log so we
-    # can associate stdout and stderr with the command that was run
-    for stream in ['stdout', 'stderr']:
-      log = popen_kwargs[stream]
-      log.write(STEP_TPL.format(stepno=step_idx, command=' '.join(step_cmd)))
-      log.flush()
+class RunningStep(object):
+  """
+  Bookkeeping for a build step subprocess that is currently executing.
+  """
+
+  def __init__(self, step, step_idx, proc, start_time, stdout=None,
+               stderr=None):
+    self.step = step
+    self.step_idx = step_idx
+    self.proc = proc
+    self.start_time = start_time
+
+    # Identifies the process across pid reuse, so that it may be killed safely
+    # by someone other than the supervisor (see `supervisor.kill_steps`)
+    self.pid_stamp = supervisor.get_process_stamp(proc.pid)
+
+    # If the step output is buffered (because other steps may execute in
+    # parallel) then these are the temporary files containing the output.
+    self.stdout = stdout
+    self.stderr = stderr
+
+
+class StepRunner(object):
+  """
+  Executes the build steps of a queue, starting each step as soon as all of
+  its dependencies have succeeded and up to `max_parallel` steps at a time.
+
+  When steps may run in parallel, the output of each step is buffered in a
+  temporary file and copied into the merge logs as a separate section when
+  the step finishes. Otherwise output is written directly to the merge logs.
+  """
+
+  def __init__(self, steps, max_parallel, popen_kwargs, retry_policy=None):
+    self.steps = steps
+    self.max_parallel = max_parallel
+    self.popen_kwargs = popen_kwargs
+    self.buffered = (max_parallel > 1)
+    if retry_policy is None:
+      retry_policy = RetryPolicy()
+    self.retry_policy = retry_policy
+
+    self.succeeded = set()
+    self.running = {}
+    self.started = set()
+
+    # Number of times each step has been started, and the earliest time at
+    # which a step waiting to be retried may be started again.
+    self.attempts = {}
+    self.retry_time = {}
+
+  def is_complete(self):
+    return len(self.succeeded) == len(self.steps)
+
+  def get_running_elapsed(self, now):
+    return {name: now - running.start_time
+            for name, running in self.running.items()}
+
+  def start_step(self, step_idx, step):
+    """
+    Start the subprocess for one step.
+    """
+
+    command_str = step.get_command_str()
+    popen_kwargs = dict(self.popen_kwargs)
+    stdout = None
+    stderr = None
+    if self.buffered:
+      stdout = tempfile.TemporaryFile()
+      stderr = tempfile.TemporaryFile()
+      popen_kwargs['stdout'] = stdout
+      popen_kwargs['stderr'] = stderr
+    else:
+      # Write the command that we are running for this step into the log so we
+      # can associate stdout and stderr with the command that was run
+      write_to_logs(self.popen_kwargs, STEP_TPL.format(stepno=step_idx,
+                                                       command=command_str))
 
     try:
-      step_proc = subprocess.Popen(step_cmd, **popen_kwargs)
+      # Start each step in a new session so that we can kill the
+      # whole process tree if it needs to be canceled.
+      step_proc = subprocess.Popen(step.command, preexec_fn=os.setsid,
+                                   **popen_kwargs)
     except OSError:
-      logging.exception("Failed to execute %s", ' '.join(step_cmd))
+      logging.exception("Failed to execute %s", command_str)
       raise
 
-    command_str = ' '.join(step_cmd)
     logging.info('{} {}'.format(step_idx, command_str))
+    self.started.add(step.name)
+    self.attempts[step.name] = self.attempts.get(step.name, 0) + 1
+    self.running[step.name] = RunningStep(step, step_idx, step_proc,
+                                          time.time(), stdout, stderr)
 
-    gerrit_poll_count = 0
-    gerrit_poll_failures = 0
+  def start_ready_steps(self):
+    """
+    Start any steps whose dependencies have all succeeded, up to the
+    concurrency limit.
+    """
 
-    if queue_spec.submit_with_rest:
-      should_poll_gerrit = True
-    else:
-      if step_idx < len(queue_spec.build_steps) - 1:
-        should_poll_gerrit = True
+    now = time.time()
+    for step_idx, step in enumerate(self.steps):
+      if len(self.running) >= self.max_parallel:
+        break
+      if step.name in self.started:
+        continue
+      if self.retry_time.get(step.name, 0) > now:
+        continue
+      if all(depname in self.succeeded for depname in step.depends):
+        self.start_step(step_idx, step)
+
+  def finish_step(self, running):
+    """
+    Copy buffered output of a finished step into the merge logs.
+    """
+
+    if not self.buffered:
+      return
+
+    header = STEP_TPL.format(stepno=running.step_idx,
+                             command=running.step.get_command_str())
+    for stream, tmpfile in [('stdout', running.stdout),
+                            ('stderr', running.stderr)]:
+      log = self.popen_kwargs[stream]
+      log.write(header)
+      tmpfile.seek(0)
+      shutil.copyfileobj(tmpfile, log)
+      tmpfile.close()
+      log.flush()
+
+  def poll_finished(self):
+    """
+    Return a list of (`RunningStep`, `duration`) for each step that has
+    finished since the last call.
+    """
+
+    finished = []
+    for name, running in sorted(self.running.items(),
+                                key=lambda item: item[1].step_idx):
+      if running.proc.poll() is None:
+        continue
+      del self.running[name]
+      duration = time.time() - running.start_time
+      logging.info('{} {} [{}] '.format(running.step_idx,
+                                        running.step.get_command_str(),
+                                        running.proc.returncode))
+      self.finish_step(running)
+      if running.proc.returncode == 0:
+        self.succeeded.add(name)
+      finished.append((running, duration))
+    return finished
+
+  def is_running(self, step):
+    return step.name in self.running
+
+  def retry_step(self, running):
+    """
+    If the failed step is retryable and has attempts remaining, schedule it
+    to be started again and return True. Otherwise return False.
+    """
+
+    step = running.step
+    if not step.retryable:
+      return False
+    if self.attempts[step.name] >= self.retry_policy.max_attempts:
+      return False
+
+    self.started.discard(step.name)
+    self.retry_time[step.name] = time.time() + self.retry_policy.delay
+    return True
+
+  def kill_all(self):
+    """
+    Kill all running steps.
+    """
+
+    for _, running in sorted(self.running.items(),
+                             key=lambda item: item[1].step_idx):
+      kill_step(running.proc)
+      self.finish_step(running)
+    self.running = {}
+
+
+class MergeChecks(object):
+  """
+  Callbacks which are polled while the build steps of a merge are running:
+
+    * preempt_check: called every `preempt_period` seconds, returns a list of
+      changes which are urgent enough to preempt the merge (if any)
+    * lease_check: called every `lease_period` seconds, renews the lease on
+      the merge and returns False if the lease has been lost (in which case
+      the merge is abandoned)
+    * restart_check: called every second, may restart (re-exec) the daemon.
+      The build continues in the supervisor.
+  """
+
+  def __init__(self, preempt_check=None, preempt_period=60, lease_check=None,
+               lease_period=10, restart_check=None):
+    self.preempt_check = preempt_check
+    self.preempt_period = preempt_period
+    self.lease_check = lease_check
+    self.lease_period = lease_period
+    self.restart_check = restart_check
+
+
+class BuildMonitor(object):
+  """
+  Follows the state of the build supervisor of one merge on behalf of
+  `run_steps`. Records the events of finished steps, enforces the time budget
+  and polls for the reasons to stop the build early.
+  """
+
+  def __init__(self, queue_spec, gerrit, change_queue, sql_session, merge_id,
+               popen_kwargs, checks):
+    self.queue_spec = queue_spec
+    self.gerrit = gerrit
+    self.change_queue = change_queue
+    self.sql_session = sql_session
+    self.merge_id = merge_id
+    self.popen_kwargs = popen_kwargs
+    self.checks = checks
+    self.budget = get_time_budget(sql_session, queue_spec)
+    self.steps_by_name = {step.name: step for step in queue_spec.build_steps}
+    self.start_time = None
+
+    # If we are reattaching then events up to this point were
+    # already recorded by the previous daemon process.
+    self.recorded = (sql_session.query(orm.StepTiming)
+                     .filter(orm.StepTiming.merge_id == merge_id).count())
+
+    # Time of the last poll for each kind of check
+    now = time.time()
+    self.last_poll = {'gerrit': 0, 'database': 0, 'preempt': now,
+                      'lease': now, 'print': now}
+    self.gerrit_poll_count = 0
+    self.gerrit_poll_failures = 0
+
+  def is_due(self, key, period):
+    """
+    Return True if more than `period` seconds have passed since the last
+    poll of `key`, in which case the poll time is reset.
+    """
+    now = time.time()
+    if now - self.last_poll[key] > period:
+      self.last_poll[key] = now
+      return True
+    return False
+
+  def record_timing(self, step_name, duration, status):
+    functions.record_step_timing(self.sql_session, self.merge_id,
+                                 self.queue_spec.project, self.queue_spec.name,
+                                 step_name, duration, status)
+
+  def record_events(self, state):
+    """
+    Record the timing (and flakiness) of each step which finished since the
+    last call.
+    """
+    for event in state['events'][self.recorded:]:
+      self.recorded += 1
+      step_name = event['step']
+      if event['returncode'] != 0:
+        self.record_timing(step_name, event['duration'],
+                           orm.StatusKey.STEP_FAILED.value)
+        if event['retried']:
+          message = RETRY_TPL.format(
+              stepno=event['stepno'], retcode=event['returncode'],
+              attempt=event['attempts'],
+              max_attempts=self.queue_spec.retry_policy.max_attempts,
+              command=event['command'])
+          logging.info(message)
+          write_to_logs(self.popen_kwargs, message)
+        continue
+
+      self.record_timing(step_name, event['duration'],
+                         orm.StatusKey.SUCCESS.value)
+      if event['attempts'] > 1:
+        # The step failed before but passed on retry, which is a signal that
+        # the step is flaky.
+        functions.record_flake(self.sql_session, self.merge_id,
+                               self.queue_spec.project, self.queue_spec.name,
+                               step_name, event['attempts'])
+
+  def get_expired_steps(self, state, running_elapsed):
+    """
+    Return a list of (step name, reason) for the running steps which have
+    exceeded their time budget, or all running steps if the merge has
+    exceeded (or is predicted to exceed) its budget.
+    """
+    expired = []
+    for name in state['running']:
+      if name not in self.steps_by_name:
+        continue
+      reason = self.budget.get_step_expiry_reason(self.steps_by_name[name],
+                                                  running_elapsed[name])
+      if reason is not None:
+        expired.append((name, reason))
+    if expired:
+      return expired
+
+    expected = None
+    if self.budget.predictive_kill:
+      expected = self.budget.get_expected_remaining(
+          self.queue_spec.build_steps, set(state['succeeded']),
+          running_elapsed)
+    reason = self.budget.get_merge_expiry_reason(
+        time.time() - self.start_time, expected)
+    if reason is not None:
+      return [(name, reason) for name in state['running']]
+    return []
+
+  def check_budget(self, state):
+    """
+    Return TIMEOUT if any of the running steps (or the merge as a whole) has
+    exceeded its time budget, otherwise None.
+    """
+    now = time.time()
+    running_elapsed = {name: now - running['start_time']
+                       for name, running in state['running'].items()}
+
+    # Print a message every five minutes for sanity
+    if self.is_due('print', 5 * 60):
+      for name, step_duration in sorted(running_elapsed.items()):
+        logging.debug('Step %s has been running for %6.2f seconds',
+                      name, step_duration)
+
+    expired = self.get_expired_steps(state, running_elapsed)
+    if not expired:
+      return None
+
+    name, reason = min(expired,
+                       key=lambda item: state['running'][item[0]]['stepno'])
+    running = state['running'][name]
+    message = TIMEOUT_TPL.format(stepno=running['stepno'],
+                                 elapsed=now - self.start_time, reason=reason,
+                                 command=running['command'])
+    logging.info(message)
+    for name in state['running']:
+      self.record_timing(name, running_elapsed[name],
+                         orm.StatusKey.TIMEOUT.value)
+    write_to_logs(self.popen_kwargs, message)
+    return orm.StatusKey.TIMEOUT.value
+
+  def poll_gerrit(self, state):
+    """
+    Return CANCELED if any of the changes was canceled on gerrit, otherwise
+    None.
+    """
+    # NOTE(josh): if the merge queue does not submit through the REST api,
+    # then the last of the build steps must do the actual merge somehow (i.e.
+    # through the gerrit REST api or through the gerrit command line
+    # interface). In this case it may alter the state of the review which may
+    # remove the MQ+1 score which we SHOULD NOT interpret as a merge request
+    # cancellation.
+    if (not self.queue_spec.submit_with_rest
+        and self.queue_spec.build_steps[-1].name in state['running']):
+      return None
+
+    # NOTE(josh): check for cancellation on gerrit every 30 seconds
+    if not self.is_due('gerrit', 30):
+      return None
+
+    canceled_ids = []
+    try:
+      self.gerrit_poll_count += 1
+      canceled_ids = self.gerrit.get_changes_canceled_on_gerrit(
+          self.change_queue)
+    except (requests.RequestException, ValueError):
+      self.gerrit_poll_failures += 1
+      if self.gerrit_poll_failures == 1:
+        logging.exception("Failed to poll gerrit for changes.\n"
+                          " NOTE(josh): This is known to happen from time "
+                          " to time, so don't be too concerned.")
       else:
-        # NOTE(josh): if this is the last of the build steps and the merge queue
-        # does not submit through the REST api, then this step must do the
-        # actual merge somehow (i.e. through the gerrit REST api or through the
-        # gerrit command line interface). In this case it may alter the state
-        # of the review which may remove the MQ+1 score which we SHOULD NOT
-        # interpret as a merge request cancellation.
-        should_poll_gerrit = False
+        logging.warn('Failed to poll gerrit for changes %d/%d',
+                     self.gerrit_poll_failures, self.gerrit_poll_count)
 
-    while step_proc.poll() is None:
-      # Print a message every two minutes for sanity
-      if time.time() - last_timing_print > 5 * 60:
-        last_timing_print = time.time()
-        step_duration = last_timing_print - step_start_time
-        logging.debug('Step %d has been running for %6.2f seconds',
-                      step_idx, step_duration)
-
-      # NOTE(josh): check for cancellation on gerrit every 30 seconds
-      if should_poll_gerrit and (time.time() - last_gerrit_poll > 30):
-        last_gerrit_poll = time.time()
-        canceled_ids = []
-        try:
-          gerrit_poll_count += 1
-          canceled_ids = gerrit.get_changes_canceled_on_gerrit(change_queue)
-        except (requests.RequestException, ValueError):
-          gerrit_poll_failures += 1
-          if gerrit_poll_failures == 1:
-            logging.exception("Failed to poll gerrit for changes.\n"
-                              " NOTE(josh): This is known to happen from time "
-                              " to time, so don't be too concerned.")
-          else:
-            logging.warn('Failed to poll gerrit for changes %d/%d',
-                         gerrit_poll_failures, gerrit_poll_count)
-          continue
+    if canceled_ids:
+      logging.info(GERRIT_CANCEL, '\n  '.join(canceled_ids))
+      return orm.StatusKey.CANCELED.value
+    return None
 
-        if canceled_ids:
-          logging.info(GERRIT_CANCEL, '\n  '.join(canceled_ids))
-          kill_step(step_proc)
-          return orm.StatusKey.CANCELED.value
-
-      # NOTE(josh): check for cancellation on mq database
-      if time.time() - last_db_poll > 10:
-        last_db_poll = time.time()
-
-        query = (sql_session.query(orm.Cancellation)
-                 .filter(orm.Cancellation.rid == merge_id))
-        for record in query:
-          logging.info(WEBFRONT_CANCEL, record.who, record.when)
-          kill_step(step_proc)
-          return orm.StatusKey.CANCELED.value
-
-      # TODO(josh): check for cancellation, update status/heartbeat,
-      # check for timeout, print animation, estimate progess based on lines
-      # of output, etc
-      time.sleep(1)
+  def poll_preempt(self):
+    """
+    Return PREEMPTED if a more urgent change should preempt this merge,
+    otherwise None.
+    """
+    if (self.checks.preempt_check is None
+        or not self.is_due('preempt', self.checks.preempt_period)):
+      return None
 
-    logging.info('{} {} [{}] '.format(step_idx, command_str,
-                                      step_proc.returncode))
-    if step_proc.returncode != 0:
-      message = FAILURE_TPL.format(stepno=step_idx,
-                                   retcode=step_proc.returncode,
-                                   command=command_str)
-      raise RuntimeError(message)
+    preempting = []
+    try:
+      preempting = self.checks.preempt_check()
+    except (httplib2.HttpLib2Error, requests.RequestException, ValueError):
+      logging.exception('Failed to check for preempting changes')
+
+    if not preempting:
+      return None
+    message = PREEMPT_TPL % '\n  '.join(changeinfo.change_id for changeinfo
+                                        in preempting)
+    logging.info(message)
+    write_to_logs(self.popen_kwargs, message)
+    return orm.StatusKey.PREEMPTED.value
+
+  def poll_lease(self):
+    """
+    Return ABANDONED if the lease on this merge has been lost, otherwise None.
+    """
+    if (self.checks.lease_check is None
+        or not self.is_due('lease', self.checks.lease_period)):
+      return None
+    if self.checks.lease_check():
+      return None
+    logging.warn('Lost the lease on merge %d, abandoning it', self.merge_id)
+    return orm.StatusKey.ABANDONED.value
+
+  def poll_database(self):
+    """
+    Return CANCELED if the merge was canceled through the webfront, otherwise
+    None.
+    """
+    # NOTE(josh): check for cancellation on mq database
+    if not self.is_due('database', 10):
+      return None
+
+    query = (self.sql_session.query(orm.Cancellation)
+             .filter(orm.Cancellation.rid == self.merge_id))
+    for record in query:
+      logging.info(WEBFRONT_CANCEL, record.who, record.when)
+      return orm.StatusKey.CANCELED.value
+    return None
+
+  def poll(self, state):
+    """
+    Run each of the checks for the running build, returning the status to
+    stop the merge with or None if the build should continue.
+    """
+    status = self.check_budget(state)
+    if status is None:
+      status = self.poll_gerrit(state)
+    if status is None:
+      status = self.poll_preempt()
+    if status is None:
+      status = self.poll_lease()
+    if status is None:
+      status = self.poll_database()
+    return status
+
+
+def get_runner_spec(queue_spec, popen_kwargs):
+  """
+  Return a json-serializable description of the `StepRunner` which executes
+  the build steps of `queue_spec`, see `make_step_runner`. The build logs in
+  `popen_kwargs` are given by name.
+  """
+  return {'steps': [step.as_dict() for step in queue_spec.build_steps],
+          'max_parallel': queue_spec.max_parallel_steps,
+          'retry_policy': queue_spec.retry_policy.as_dict(),
+          'env': popen_kwargs.get('env', None),
+          'cwd': popen_kwargs.get('cwd', None),
+          'stdout': popen_kwargs['stdout'].name,
+          'stderr': popen_kwargs['stderr'].name}
 
+
+def make_step_runner(runner_spec):
+  """
+  Construct the `StepRunner` described by `runner_spec` (see
+  `get_runner_spec`), appending to its build logs.
+  """
+  steps = [BuildStep(**step_spec) for step_spec in runner_spec['steps']]
+  popen_kwargs = {
+      'env': runner_spec['env'],
+      'cwd': runner_spec['cwd'],
+      'stdout': open_step_log(runner_spec['stdout'], 'a'),
+      'stderr': open_step_log(runner_spec['stderr'], 'a'),
+  }
+  return StepRunner(steps, runner_spec['max_parallel'], popen_kwargs,
+                    RetryPolicy(**runner_spec['retry_policy']))
+
+
+def run_steps(queue_spec, gerrit, change_queue, sql_session, merge_id,
+              popen_kwargs, state_path, job=None, checks=None):
+  """
+  Performs each build, test step.
+
+  The steps are executed by a detached supervisor process (see `supervisor`)
+  which reports its progress through `state_path`. If `job` is None then the
+  supervisor is already running (i.e. the daemon was restarted during the
+  build) and we reattach to it. Otherwise a new supervisor is started and
+  `job` is stored in its state so that a restarted daemon can resume the
+  merge.
+
+  `checks` is a `MergeChecks` with the callbacks which are polled while the
+  build is running.
+  """
+
+  logging.info('Performing build/test steps')
+  if checks is None:
+    checks = MergeChecks()
+  monitor = BuildMonitor(queue_spec, gerrit, change_queue, sql_session,
+                         merge_id, popen_kwargs, checks)
+
+  if job is None:
+    state = supervisor.read_state(state_path)
+    if state is None:
+      raise RuntimeError('Build supervisor state {} is gone'
+                         .format(state_path))
+    logging.info('Reattaching to build supervisor %d', state['pid'])
+  else:
+    # Flush the build logs so that anything which is still buffered is
+    # written before the output of the supervisor.
+    for key in ('stdout', 'stderr'):
+      popen_kwargs[key].flush()
+    state = supervisor.launch(state_path, job,
+                              get_runner_spec(queue_spec, popen_kwargs))
+  monitor.start_time = state['start_time']
+
+  while True:
+    state = supervisor.read_state(state_path)
+    if state is None:
+      # The supervisor writes its state file atomically, so if
+      # we can't read it then it is gone, and so is the build.
+      raise RuntimeError('Build supervisor state {} is gone'
+                         .format(state_path))
+    monitor.record_events(state)
+
+    if state['status'] == supervisor.FINISHED:
+      if state['result'] == supervisor.SUCCESS:
+        break
+      elif state['result'] == supervisor.FAILED:
+        raise RuntimeError(FAILURE_TPL.format(**state['failure']))
+      else:
+        raise RuntimeError('Build supervisor {} was killed'
+                           .format(state['pid']))
+
+    if not supervisor.is_alive(state['pid']):
+      raise RuntimeError('Build supervisor {} died'.format(state['pid']))
+
+    status = monitor.poll(state)
+    if status is not None:
+      supervisor.stop(state_path)
+      return status
+
+    if checks.restart_check is not None:
+      checks.restart_check()
+
+    # TODO(josh): update status/heartbeat, print animation, estimate progess
+    # based on lines of output, etc
+    time.sleep(1)
+
+  monitor.record_timing(MERGE_TIMING_KEY, time.time() - monitor.start_time,
+                        orm.StatusKey.SUCCESS.value)
   return orm.StatusKey.SUCCESS.value
 
 
-def cleanup_repo(repo):
+def cleanup_repo(repo, keep_branches=None):
   """
-  Cleanup branches and working tree after merge
+  Cleanup branches and working tree after merge. All branches except master
+  and those listed in `keep_branches` are deleted.
   """
+  if keep_branches is None:
+    keep_branches = []
+
   # clean up repo in case anything failed
   repo.git.reset('--hard')
   # -f is 'force', -d is 'remove whole directories'
@@ -505,7 +1459,8 @@ def cleanup_repo(repo):
 
   # delete all branches except master
   for branch in repo.git.branch().split():
-    if branch != '*' and branch.strip() != 'master':
+    if (branch != '*' and branch.strip() != 'master'
+        and branch.strip() not in keep_branches):
       logging.info('Deleting left-over branch %s', branch)
       try:
         repo.git.branch('-D', branch)
@@ -527,11 +1482,14 @@ def get_or_clone_repo(config, repo_path, project):
     pass
 
   # clone the repository if needed
-  repository_url = 'ssh://{}@{}:{}/{}.git'.format(
-      config['gerrit.ssh.username'],
-      config['gerrit.ssh.host'],
-      config['gerrit.ssh.port'],
-      project)
+  if config.get('gerrit.clone_url', None):
+    repository_url = config['gerrit.clone_url'].format(project=project)
+  else:
+    repository_url = 'ssh://{}@{}:{}/{}.git'.format(
+        config['gerrit.ssh.username'],
+        config['gerrit.ssh.host'],
+        config['gerrit.ssh.port'],
+        project)
   logging.info('attemping to clone %s', repository_url)
 
   # TODO(josh): replace with subprocess call, gitpython appears to supress
@@ -540,7 +1498,10 @@ def get_or_clone_repo(config, repo_path, project):
 
   # if this is a fresh clone we need to run git-fat init, so do it every time
   # anyway
-  subprocess.call(['git-fat', 'init'], cwd=repo_path)
+  try:
+    subprocess.call(['git-fat', 'init'], cwd=repo_path)
+  except OSError:
+    logging.warn('git-fat is not installed, skipping git-fat init')
 
   # create a git repository object for this working repository
   return git.Repo(repo_path)
@@ -581,29 +1542,46 @@ def handle_pid_file(pidfile_path):
     pidfile.write('{}\n'.format(os.getpid()))
 
 
-def get_requests_matching(request_queue, project, branch):
+def get_coalition(queue_spec, request_queue):
   """
-  Filter request_queue returning a list of only those requests matching the
-  given branch and project
+  Return the changes from the head of `request_queue` which may be verified
+  together, up to `queue_spec.coalesce_count` of them.
   """
 
-  return [cinfo for cinfo in request_queue
-          if cinfo.project == project and cinfo.branch == branch]
+  # NOTE(josh): Only coalesce changes that have never failed verification
+  # before.
+  coalesce_queue = []
+  for changeinfo in request_queue:
+    if changeinfo.change_id in queue_spec.dirty_changes:
+      logging.info('ceasing merge colation since %s is dirty',
+                   changeinfo.change_id)
+      break
+    else:
+      coalesce_queue.append(changeinfo)
+    if len(coalesce_queue) >= queue_spec.coalesce_count:
+      break
+  return coalesce_queue
 
 
-def get_requests_from_single_queue(request_queue, queue_specs):
+def setup_ccache(config):
   """
-  Find the first merge request in `request_queue` that matches a specification
-  in `queue_specs`. Then, given that `queue_spec`, build and return a list of
-  all outstanding changes to that (`project`, `branch`).
+  Create the shared ccache directory and set its maximum size, if ccache is
+  configured.
   """
-  for cinfo in request_queue:
-    if cinfo.project in queue_specs:
-      for spec in queue_specs[cinfo.project]:
-        if spec.branch.match(cinfo.branch):
-          return spec, get_requests_matching(request_queue, cinfo.project,
-                                             cinfo.branch)
-  return None, []
+
+  if 'daemon.ccache' not in config:
+    return
+
+  sub_env = os.environ.copy()
+  sub_env['CCACHE_DIR'] = config['daemon.ccache.path']
+
+  try:
+    os.makedirs(config['daemon.ccache.path'])
+  except OSError:
+    pass
+
+  subprocess.check_call(['ccache', '-M', config['daemon.ccache.size']],
+                        env=sub_env, cwd=config['daemon.workspace_path'])
 
 
 class LogInfo(object):
@@ -617,24 +1595,37 @@ class LogInfo(object):
     self.stderr = None
 
 
-def setup_logs(log_path, merge_id):
+def open_step_log(logpath, mode='w'):
   """
-  Open three log files for app, stdout, and stderr.
+  Open a log file for the output of build steps. The file is always opened
+  for appending, because the build supervisor and a resumed daemon open it
+  again, and each writer must not overwrite the other. `mode='w'` truncates
+  the file first.
+  """
+  if mode == 'w':
+    open(logpath, 'w').close()
+  return open(logpath, 'a')
+
+
+def setup_logs(log_path, merge_id, mode='w'):
+  """
+  Open three log files for app, stdout, and stderr. Use `mode='a'` to append
+  to the logs of a merge which is being resumed.
   """
 
   # Create a temporary logging handler which copies log events to the named
   # log file for this merge
   app_logpath = '{}/{:06d}.log'.format(log_path, merge_id)
-  log_handler = logging.FileHandler(app_logpath, 'w')
+  log_handler = logging.FileHandler(app_logpath, mode)
   log_handler.setLevel(logging.DEBUG)
   logging.getLogger('').addHandler(log_handler)
 
   # Create log files for stdout and stderr of build steps
   stdout_logpath = '{}/{:06d}.stdout'.format(log_path, merge_id)
-  stdout_log = open(stdout_logpath, 'w')
+  stdout_log = open_step_log(stdout_logpath, mode)
 
   stderr_logpath = '{}/{:06d}.stderr'.format(log_path, merge_id)
-  stderr_log = open(stderr_logpath, 'w')
+  stderr_log = open_step_log(stderr_logpath, mode)
 
   out = LogInfo()
   out.app_logpath = app_logpath
@@ -647,9 +1638,288 @@ def setup_logs(log_path, merge_id):
   return out
 
 
+def get_review_dedup_keys(merge_id, change_queue):
+  """
+  Return the dedup keys of the reviews which merge `merge_id` puts in the
+  outbox for the changes of `change_queue` (see `prepare_merge` and
+  `enqueue_result_reviews`).
+  """
+  return ['{}:{}:{}'.format(merge_id, kind, changeinfo.change_id)
+          for kind in ('start', 'result') for changeinfo in change_queue]
+
+
+def enqueue_reviews(sql_session, change_queue, review_dict, dedup_prefix):
+  """
+  Put `review_dict` in the outbox for each change of `change_queue`. The dedup
+  key of each review is `dedup_prefix` followed by the change id.
+  """
+  for changeinfo in change_queue:
+    dedup_key = '{}:{}'.format(dedup_prefix, changeinfo.change_id)
+    outbox.enqueue_review(sql_session, changeinfo.change_id,
+                          changeinfo.current_revision, review_dict,
+                          dedup_key=dedup_key)
+
+
+def enqueue_result_reviews(config, sql_session, change_queue, merge_id,
+                           status):
+  """
+  Put the review which reports the result of merge `merge_id` in the outbox
+  for each change of `change_queue`.
+  """
+  message = get_result_message(config['webfront.url'], merge_id, status)
+
+  # NOTE(josh): if this is the second pass, then we want the label to
+  # be -1: on failure
+  review_score = 0
+  if (len(change_queue) == 1
+      and status not in (orm.StatusKey.SUCCESS.value,
+                         orm.StatusKey.PREEMPTED.value,
+                         orm.StatusKey.ABANDONED.value)):
+    review_score = -1
+
+  review_dict = {'message': message,
+                 'labels': {'Merge-Queue': review_score}}
+
+  # If the merge succeeds the user will already get an email from gerrit
+  # so there's no need to email again.
+  if status == orm.StatusKey.SUCCESS.value:
+    review_dict['notify'] = 'NONE'
+
+  enqueue_reviews(sql_session, change_queue, review_dict,
+                  '{}:result'.format(merge_id))
+
+
+def prepare_merge(config, sql_session, repo, merge_id, merge_branch,
+                  change_queue, preempted):
+  """
+  Notify gerrit (through the outbox) that `change_queue` is in submission and
+  merge the changes together into `merge_branch`, reusing the merge from a
+  `preempted` verification of the same changes if possible.
+  """
+
+  silent = config.get('daemon.silent', False)
+  if not silent:
+    message = IN_SUBMISSION_TPL.format(config['webfront.url'], merge_id)
+    review_dict = {'message': message,
+                   'labels': {'Merge-Queue': 0},
+                   'notify': 'NONE'}  # don't email on merge started
+    enqueue_reviews(sql_session, change_queue, review_dict,
+                    '{}:start'.format(merge_id))
+
+  with metrics.timer('merge_phase_seconds', phase='fetch'):
+    fetch_branches_from_origin(repo)
+  with metrics.timer('merge_phase_seconds', phase='merge'):
+    if preempted is not None and preempted.matches(change_queue):
+      reuse_preempted_merge(repo, merge_branch, preempted)
+    else:
+      merge_features_together(repo, merge_branch, change_queue)
+
+  if not silent:
+    # Push the updated feature branch back to origin so its state there is
+    # up to date.
+    with metrics.timer('merge_phase_seconds', phase='push'):
+      repo.git.push('origin', '{0}:{0}'.format(merge_branch), force=True)
+
+
+def verify_and_submit(config, gerrit, sql_session, queue_spec, change_queue,
+                      merge_id, workspace_path, checks=None, resume=False):
+  """
+  Merge all changes from `change_queue` together, verify the build and, if
+  it passes, then submit all of the changes through gerrit. Build logs are
+  written for merge `merge_id` and the repository is checked out under
+  `workspace_path`. Returns the status of the merge (see `orm.StatusKey`).
+  `checks` is a `MergeChecks` polled while the build is running.
+
+  If `resume` is true then the build steps of this merge are already running
+  in a supervisor (from before a restart of the daemon) so we skip the merge
+  and reattach to the build.
+  """
+
+  silent = config.get('daemon.silent', False)
+  logctx = setup_logs(config['log_path'], merge_id, 'a' if resume else 'w')
+  state_path = supervisor.get_state_path(config['log_path'], merge_id)
+  merge_branch = 'mergequeue_{:06d}'.format(merge_id)
+
+  logging.info('%s verification of the following changes: \n  %s',
+               'Resuming' if resume else 'Starting',
+               '\n  '.join([changeinfo.change_id for changeinfo
+                            in change_queue]))
+  repo = None
+  keep_branches = []
+  preempted = queue_spec.preempted
+  if preempted is not None and preempted.matches(change_queue):
+    queue_spec.preempted = None
+  elif preempted is not None:
+    # This merge is for a different batch (e.g. the change which
+    # preempted it), so keep the preempted state around for later.
+    keep_branches.append(preempted.branch)
+    preempted = None
+  try:
+    repo_path = queue_spec.get_workspace(workspace_path)
+    with metrics.timer('merge_phase_seconds', phase='clone'):
+      repo = get_or_clone_repo(config, repo_path=repo_path,
+                               project=queue_spec.project)
+
+    job = None
+    if not resume:
+      job = {'project': queue_spec.project,
+             'queue': queue_spec.name,
+             'branch': change_queue[0].branch,
+             'host': socket.gethostname(),
+             'changes': [changeinfo.as_dict() for changeinfo in change_queue]}
+      prepare_merge(config, sql_session, repo, merge_id, merge_branch,
+                    change_queue, preempted)
+
+    popen_kwargs = {
+        'env': queue_spec.get_environment(config),
+        'cwd': queue_spec.get_workspace(workspace_path),
+        'stdout': logctx.stdout,
+        'stderr': logctx.stderr,
+    }
+
+    with metrics.timer('merge_phase_seconds', phase='build'):
+      status = run_steps(
+          queue_spec, gerrit, change_queue, sql_session, merge_id,
+          popen_kwargs, state_path, job=job, checks=checks)
+
+    if not silent:
+      with metrics.timer('merge_phase_seconds', phase='push'):
+        repo.git.push('origin', ':{}'.format(merge_branch))
+
+    if status == orm.StatusKey.PREEMPTED.value:
+      # Keep the merged state around so that it may be reused when these
+      # changes are verified again after the preempting change.
+      preempted_branch = 'preempted_{:06d}'.format(merge_id)
+      repo.git.branch('-m', merge_branch, preempted_branch)
+      keep_branches.append(preempted_branch)
+      queue_spec.preempted = PreemptedMerge(preempted_branch, change_queue)
+
+  except (OSError, RuntimeError, KeyError, git.exc.GitCommandError):
+    status = orm.StatusKey.STEP_FAILED.value
+    logging.exception('Exception caught during merge')
+
+  # The result of the supervisor has been consumed, so the merge can no longer
+  # be resumed
+  if os.path.exists(state_path):
+    os.remove(state_path)
+
+  if repo is not None:
+    with metrics.timer('merge_phase_seconds', phase='cleanup'):
+      cleanup_repo(repo, keep_branches)
+
+  if status == orm.StatusKey.SUCCESS.value:
+    if queue_spec.submit_with_rest:
+      with metrics.timer('merge_phase_seconds', phase='submit'):
+        outcomes = submit_changes_with_rest(
+            gerrit, change_queue, queue_spec.submit_strategy, merge_branch)
+      record_submit_outcomes(sql_session, merge_id, outcomes)
+    else:
+      cleanup_repo(repo, keep_branches)
+      submit_changes_with_cmd(repo, change_queue, queue_spec.submit_cmd,
+                              popen_kwargs)
+
+  # Add a comment to gerrit indicating success or failure, and setting a
+  # review score for the Merge-Queue label.
+  if not silent:
+    enqueue_result_reviews(config, sql_session, change_queue, merge_id,
+                           status)
+
+  # remove the the handler that is logging messages to the file for this merge
+  logging.getLogger('').removeHandler(logctx.log_handler)
+  logctx.log_handler.close()
+  logctx.stdout.close()
+  logctx.stderr.close()
+
+  # compress the logs
+  with metrics.timer('merge_phase_seconds', phase='logs'):
+    for logpath in [logctx.app_logpath, logctx.stdout_logpath,
+                    logctx.stderr_logpath]:
+      subprocess.call(['gzip', '--force', logpath])
+
+      # NOTE(josh): the nginx gzip_static module wants the original files
+      # around or it wont serve the compressed ones. It's not great to rely on
+      # nginx behavior but for now we touch the file to make nginx happy and
+      # then hope that it wont be served.
+      with open(logpath, 'w') as _:
+        pass
+
+  return status
+
+
+class LeaderElection(threading.Thread):
+  """
+  Lease-based leader election through the shared database. The thread keeps
+  trying to acquire the lease named `name` and, once it has it, renews it every
+  `ttl / 3` seconds. Only the leader verifies merges, the other daemons are
+  hot standbys which take over when the leader's lease expires.
+  """
+
+  def __init__(self, session_factory, name, ttl):
+    super(LeaderElection, self).__init__(name='leader-election')
+    self.daemon = True
+    self.sql_session = session_factory()
+    self.lease_name = name
+    self.ttl = ttl
+    self.holder = '{}:{}'.format(socket.gethostname(), os.getpid())
+    self.leader = False
+    self.last_renewal = 0
+    self.stop_event = threading.Event()
+
+  def run(self):
+    while not self.stop_event.is_set():
+      attempt_time = time.time()
+      try:
+        held = functions.acquire_leader_lease(
+            self.sql_session, self.lease_name, self.holder, self.ttl)
+      except sqlalchemy.exc.SQLAlchemyError:
+        logging.exception('Failed to renew leader lease %s', self.lease_name)
+        self.sql_session.rollback()
+        held = None
+
+      if held:
+        if not self.leader:
+          logging.info('Acquired leader lease %s as %s', self.lease_name,
+                       self.holder)
+        self.leader = True
+        self.last_renewal = attempt_time
+      elif held is not None or attempt_time - self.last_renewal > self.ttl:
+        if self.leader:
+          logging.warn('Lost leader lease %s', self.lease_name)
+        self.leader = False
+
+      self.stop_event.wait(self.ttl / 3.0)
+
+  def is_leader(self):
+    """
+    Return true if this daemon holds the lease. This is conservative: the
+    lease is considered lost once `ttl` seconds have passed since the last
+    successful renewal.
+    """
+    return self.leader and time.time() - self.last_renewal < self.ttl
+
+  def stop(self):
+    """
+    Stop renewing and release the lease so that a standby may take over
+    immediately.
+    """
+    self.stop_event.set()
+    self.join()
+    if self.leader:
+      functions.release_leader_lease(self.sql_session, self.lease_name,
+                                     self.holder)
+      self.leader = False
+
+
+# Configuration which is only read when the daemon starts. Changes to these
+# are not applied by a config reload.
+RESTART_CONFIG_KEYS = ('db_url', 'log_path', 'gerrit.rest', 'daemon.ccache',
+                       'daemon.leader_election', 'daemon.pidfile_path',
+                       'daemon.workspace_path')
+
+
 class MergeDaemon(object):
 
-  def __init__(self, config, gerrit, sql_session):
+  def __init__(self, config, gerrit, sql_session, config_path=None):
     self.config = config
     self.gerrit = gerrit
     self.sql_session = sql_session
@@ -659,249 +1929,499 @@ class MergeDaemon(object):
     except OSError:
       pass
 
+    # If `config_path` is given then the config is reloaded whenever that file
+    # is modified, or when the daemon receives SIGHUP.
+    self.config_path = config_path
+    self.config_mtime = None
+    if config_path is not None:
+      self.config_mtime = os.path.getmtime(config_path)
+    self.reload_requested = False
+
+    self.queue_dicts = {}
+    self.queues = scheduler.RoutingIndex()
+    self.update_queues(config)
+
+    setup_ccache(config)
+
+    self.watcher = None
+    self.outbox_sender = None
+    self.pidfile_path = config.get('daemon.pidfile_path', './pid')
+    self.scheduler = scheduler.FairScheduler(
+        age_boost=config.get('daemon.age_boost', None))
+    self.poller = polling.PollController()
+    self.poller.configure(config)
+
+    self.election = None
+    election_config = config.get('daemon.leader_election', None)
+    if election_config is not None:
+      self.election = LeaderElection(
+          sqlalchemy.orm.sessionmaker(bind=sql_session.get_bind()),
+          election_config.get('name', 'gerrit_mq'),
+          election_config.get('ttl', 15))
+
+  def update_queues(self, config):
+    """
+    Rebuild the queue specs served by this daemon from `config`. Specs whose
+    configuration did not change are kept as they are, and rebuilt specs
+    inherit the state (dirty changes, preempted merge) of the spec they
+    replace.
+    """
+
+    old_specs = {}
+    for spec_list in self.queues.itervalues():
+      for spec in spec_list:
+        old_specs[scheduler.get_queue_key(spec)] = spec
+
+    queue_dicts = {}
     queue_index = {}
-    for spec_dict in self.config['queues']:
+    for spec_dict in config['queues']:
       spec = QueueSpec(**spec_dict)
-      queue_index[(spec.project, spec.name)] = spec
+      key = scheduler.get_queue_key(spec)
+      queue_dicts[key] = spec_dict
 
-    self.queues = {}
-    for project, name in self.config['daemon.queues']:
+      old_spec = old_specs.get(key, None)
+      if old_spec is not None:
+        if self.queue_dicts.get(key, None) == spec_dict:
+          spec = old_spec
+        else:
+          logging.info('Configuration of queue %s/%s changed', *key)
+          spec.dirty_changes = old_spec.dirty_changes
+          spec.preempted = old_spec.preempted
+      queue_index[key] = spec
+
+    queues = scheduler.RoutingIndex()
+    for project, name in config['daemon.queues']:
       spec = queue_index.get((project, name), None)
       if spec is None:
         logging.warn('daemon queue not listed in queue index: %s/%s',
                      project, name)
         continue
-      if project not in self.queues:
-        self.queues[project] = []
-      self.queues[project].append(spec)
+      if (project, name) not in old_specs and old_specs:
+        logging.info('Now serving queue %s/%s', project, name)
+      if project not in queues:
+        queues[project] = []
+      queues[project].append(spec)
 
-    # increase ccache size
-    sub_env = os.environ.copy()
-    sub_env['CCACHE_DIR'] = self.config['daemon.ccache.path']
+    for key in old_specs:
+      if queue_index.get(key, None) not in queues.get(key[0], []):
+        logging.info('No longer serving queue %s/%s', *key)
 
-    try:
-      os.makedirs(config['daemon.ccache.path'])
-    except OSError:
-      pass
-
-    subprocess.check_call(['ccache', '-M', config['daemon.ccache.size']],
-                          env=sub_env, cwd=config['daemon.workspace_path'])
+    self.queue_dicts = queue_dicts
+    self.queues = queues
 
-  def coalesce_merge(self, queue_spec, change_queue):
+  def poll_gerrit(self):
     """
-    Merge all changes from `change_queue` together, verify the build and, if
-    it passes, then submit all of the changes through gerrit.
+    Update the local cache of the merge queue from gerrit. Unless
+    `daemon.query_all_projects` is set, only changes to the projects served by
+    this daemon are requested from gerrit.
     """
+    projects = None
+    if not self.config.get('daemon.query_all_projects', False):
+      projects = sorted(self.queues)
+    poll_id = functions.get_next_poll_id(self.sql_session)
+    functions.poll_gerrit(self.gerrit, self.sql_session, poll_id, projects)
 
-    # Take this opportunity to to update the AccountInfo table with any new
-    # owner info contained in this change
-    for changeinfo in change_queue:
-      functions.add_or_update_account_info(self.sql_session,
-                                           changeinfo.owner)
-      self.sql_session.commit()
+  def handle_sighup(self, signum, frame):  # pylint: disable=unused-argument
+    self.reload_requested = True
 
-    # Create a log entry for this merge attempt. Note that the id will be
-    # assigned by sqlalchemy after we 'commit' to the database.
-    merge = create_sql_records(self.sql_session, queue_spec, change_queue)
+  def reload_config(self):
+    """
+    Reload the config if it was modified or if a reload was requested through
+    SIGHUP. Only called between merges, so the new config applies to the next
+    merge. If the new config is broken then the current one is kept.
+    """
 
-    silent = self.config.get('daemon.silent', False)
-    logctx = setup_logs(self.config['log_path'], merge.rid)
+    if self.config_path is None:
+      return
 
-    logging.info('Starting verification of the following changes: \n  %s',
-                 '\n  '.join([changeinfo.change_id for changeinfo
-                              in change_queue]))
-    repo = None
     try:
-      repo_path = queue_spec.get_workspace(self.config['daemon.workspace_path'])
-      repo = get_or_clone_repo(self.config, repo_path=repo_path,
-                               project=queue_spec.project)
+      mtime = os.path.getmtime(self.config_path)
+    except OSError:
+      logging.warn('Config file %s is missing', self.config_path)
+      return
 
-      if not silent:
-        message = IN_SUBMISSION_TPL.format(self.config['webfront.url'],
-                                           merge.rid)
-        review_dict = {'message': message,
-                       'labels': {'Merge-Queue': 0},
-                       'notify': 'NONE'}  # don't email on merge started
-        for changeinfo in change_queue:
-          self.gerrit.set_review(changeinfo.change_id,
-                                 changeinfo.current_revision, review_dict)
-
-      fetch_branches_from_origin(repo)
-      merge_branch = 'mergequeue_{:06d}'.format(merge.rid)
-      merge_features_together(repo, merge_branch, change_queue)
+    if not self.reload_requested and mtime == self.config_mtime:
+      return
+    self.reload_requested = False
+    self.config_mtime = mtime
 
-      if not silent:
-        # Push the updated feature branch back to origin so its state there is
-        # up to date.
-        repo.git.push('origin', '{0}:{0}'.format(merge_branch), force=True)
+    logging.info('Reloading config from %s', self.config_path)
+    try:
+      config = common.load_config(self.config_path)
+      self.update_queues(config)
+    except:  # pylint: disable=bare-except
+      logging.exception('Failed to reload config, keeping the current config')
+      return
 
-      popen_kwargs = {
-          'env': queue_spec.get_environment(self.config),
-          'cwd': queue_spec.get_workspace(self.config['daemon.workspace_path']),
-          'stdout': logctx.stdout,
-          'stderr': logctx.stderr,
-      }
+    for key in RESTART_CONFIG_KEYS:
+      if config.get(key, None) != self.config.get(key, None):
+        logging.warn('Config %s changed, it will take effect when the daemon'
+                     ' is restarted', key)
 
-      merge.status = run_steps(queue_spec, self.gerrit, change_queue,
-                               self.sql_session, merge.rid, popen_kwargs)
+    self.config = config
+    self.scheduler.age_boost = config.get('daemon.age_boost', None)
+    self.poller.configure(config)
 
-      if not silent:
-        repo.git.push('origin', ':{}'.format(merge_branch))
+  def set_leader_merge(self, merge_id):
+    """
+    Record the merge that this daemon is working on in its leader lease
+    """
+    if self.election is not None:
+      functions.set_leader_merge(self.sql_session, self.election.lease_name,
+                                 self.election.holder, merge_id)
 
-    except (OSError, RuntimeError, KeyError, git.exc.GitCommandError):
-      merge.status = orm.StatusKey.STEP_FAILED.value
-      logging.exception('Exception caught during merge')
+  def take_over(self):
+    """
+    Called when this daemon becomes the leader. Marks the merge that the
+    previous leader was working on (if any) as abandoned, and restores the
+    set of dirty changes from the merge history. If the previous leader was
+    this daemon (before a restart) then its merge is resumed instead.
+    """
+    self.sql_session.expire_all()
+    lease = (self.sql_session.query(orm.LeaderLease)
+             .get(self.election.lease_name))
+    resumable = []
+    if lease is not None and lease.merge_id is not None:
+      merge = self.sql_session.query(orm.MergeStatus).get(lease.merge_id)
+      if (merge is not None
+          and merge.status == orm.StatusKey.IN_PROGRESS.value):
+        state = self.get_resumable_state(merge)
+        if state is not None:
+          # The previous leader was this daemon, before a restart
+          resumable.append((merge, state))
+        else:
+          logging.warn('Merge %d was interrupted by a change of leader, '
+                       'marking it as abandoned', merge.rid)
+          merge.status = orm.StatusKey.ABANDONED.value
+          merge.end_time = datetime.datetime.utcnow()
+      self.sql_session.commit()
+      self.set_leader_merge(None)
 
-    if repo is not None:
-      cleanup_repo(repo)
+    self.poll_gerrit()
+    _, global_queue = functions.get_queue(self.sql_session)
+    dirty_ids = functions.get_dirty_change_ids(
+        self.sql_session, [changeinfo.change_id for changeinfo in global_queue])
+    for changeinfo in global_queue:
+      spec = scheduler.get_matching_spec(self.queues, changeinfo)
+      if spec is not None and changeinfo.change_id in dirty_ids:
+        spec.dirty_changes.add(changeinfo.change_id)
 
-    if merge.status == orm.StatusKey.SUCCESS.value:
-      if queue_spec.submit_with_rest:
-        submit_changes_with_rest(self.gerrit, change_queue)
-      else:
-        cleanup_repo(repo)
-        submit_changes_with_cmd(repo, change_queue, queue_spec.submit_cmd,
-                                popen_kwargs)
+    for merge, state in resumable:
+      self.resume_merge(merge, state)
 
-    # Add a comment to gerrit indicating success or failure, and setting a
-    # review score for the Merge-Queue label.
-    if not silent:
-      message = get_result_message(self.config['webfront.url'], merge.rid,
-                                   merge.status)
+  def get_resumable_state(self, merge):
+    """
+    Return the supervisor state of `merge` if its build was started by a
+    previous incarnation of this daemon and can be reattached to, otherwise
+    return None.
+    """
+    state = supervisor.read_state(
+        supervisor.get_state_path(self.config['log_path'], merge.rid))
+    if not supervisor.is_resumable(state):
+      return None
+    # The pid in the state file is only meaningful on the host
+    # which started the supervisor
+    if state['job'].get('host') != socket.gethostname():
+      return None
+    if self.get_queue_spec(state['job']) is None:
+      return None
+    return state
+
+  def get_queue_spec(self, job):
+    for spec in self.queues.get(job['project'], []):
+      if spec.name == job['queue']:
+        return spec
+    return None
+
+  def resume_merge(self, merge, state):
+    """
+    Reattach to the build supervisor of `merge` (described by `state`) and see
+    the merge through to the end.
+    """
+    job = state['job']
+    logging.info('Resuming merge %d of %s/%s', merge.rid, job['project'],
+                 job['branch'])
+    change_queue = [common.ChangeInfo(queue_score=None, **changeinfo)
+                    for changeinfo in job['changes']]
+    return self.coalesce_merge(self.get_queue_spec(job), change_queue, merge)
+
+  def resume_stale_merges(self):
+    """
+    If the daemon was restarted during a merge, reattach to the build of that
+    merge. Stale merges which can't be resumed are marked as canceled.
+    """
+    resumable = []
+    query = (self.sql_session.query(orm.MergeStatus)
+             .filter(orm.MergeStatus.status
+                     == orm.StatusKey.IN_PROGRESS.value))
+    for merge in query:
+      state = self.get_resumable_state(merge)
+      if state is not None:
+        resumable.append((merge, state))
+
+    mark_old_changes_as_failed(self.sql_session,
+                               [merge.rid for merge, _ in resumable])
+    for merge, state in resumable:
+      self.resume_merge(merge, state)
+
+  def check_restart(self):
+    """
+    Restart (re-exec) the daemon if the source watcher saw a change
+    """
+    if self.watcher is not None and self.watcher.changed.is_set():
+      functions.restart_process(self.watcher.changelist, self.pidfile_path)
 
-      # NOTE(josh): if this is the second pass, then we want the label to
-      # be -1: on failure
-      review_score = 0
-      if (len(change_queue) == 1
-          and merge.status != orm.StatusKey.SUCCESS.value):
-        review_score = -1
+  def write_metrics(self):
+    """
+    Write a snapshot of the metrics registry to `daemon.metrics_path`, if
+    configured.
+    """
+    metrics_path = self.config.get('daemon.metrics_path', None)
+    if metrics_path is None:
+      return
+    try:
+      metrics.write(metrics_path)
+    except (IOError, OSError):
+      logging.exception('Failed to write metrics to %s', metrics_path)
 
-      review_dict = {'message': message,
-                     'labels': {'Merge-Queue': review_score}}
+  def coalesce_merge(self, queue_spec, change_queue, merge=None):
+    """
+    Merge all changes from `change_queue` together, verify the build and, if
+    it passes, then submit all of the changes through gerrit. Returns the
+    status of the merge (see `orm.StatusKey`). If `merge` is not None then it
+    is an in-progress merge whose build is resumed.
+    """
+
+    resume = merge is not None
+    if not resume:
+      # Take this opportunity to to update the AccountInfo table with any new
+      # owner info contained in this change
+      for changeinfo in change_queue:
+        functions.add_or_update_account_info(self.sql_session,
+                                             changeinfo.owner)
+        self.sql_session.commit()
 
-      # If the merge succeeds the user will already get an email from gerrit
-      # so there's no need to email again.
-      if merge.status == orm.StatusKey.SUCCESS.value:
-        review_dict['notify'] = 'NONE'
+      # Create a log entry for this merge attempt. Note that the id will be
+      # assigned by sqlalchemy after we 'commit' to the database.
+      merge = create_sql_records(self.sql_session, queue_spec, change_queue)
 
+      now = datetime.datetime.utcnow()
       for changeinfo in change_queue:
-        self.gerrit.set_review(changeinfo.change_id,
-                               changeinfo.current_revision, review_dict)
+        metrics.observe('queue_wait_seconds',
+                        scheduler.get_wait_time(changeinfo, now),
+                        project=queue_spec.project, queue=queue_spec.name)
+    self.set_leader_merge(merge.rid)
+
+    checks = MergeChecks(
+        preempt_check=lambda: self.get_preempting_changes(change_queue),
+        preempt_period=self.config.get('daemon.poll_period', 60),
+        restart_check=self.check_restart)
+    if self.election is not None:
+      checks.lease_check = self.election.is_leader
+
+    merge.status = verify_and_submit(
+        self.config, self.gerrit, self.sql_session, queue_spec, change_queue,
+        merge.rid, self.config['daemon.workspace_path'], checks=checks,
+        resume=resume)
 
     # mark the time when the merge was completed / failed
     merge.end_time = datetime.datetime.utcnow()
+    metrics.observe('merge_duration_seconds',
+                    (merge.end_time - merge.start_time).total_seconds(),
+                    project=queue_spec.project, queue=queue_spec.name)
 
     # commit change to history database
     self.sql_session.commit()
+    self.set_leader_merge(None)
 
-    # remove the the handler that is logging messages to the file for this merge
-    logging.getLogger('').removeHandler(logctx.log_handler)
-    logctx.log_handler.close()
-    logctx.stdout.close()
-    logctx.stderr.close()
+    queue_spec.update_dirty_changes(
+        [changeinfo.change_id for changeinfo in change_queue], merge.status)
+    self.poller.on_merge()
+    self.write_metrics()
+    return merge.status
 
-    # compress the logs
-    for logpath in [logctx.app_logpath, logctx.stdout_logpath,
-                    logctx.stderr_logpath]:
-      subprocess.call(['gzip', '--force', logpath])
+  def get_preempting_changes(self, change_queue):
+    """
+    Poll gerrit and return a list of queued changes which should preempt the
+    verification of `change_queue`. A change preempts the verification if it
+    is handled by this daemon and its priority is both more urgent than
+    `daemon.preempt_priority` and more urgent than every change in
+    `change_queue`.
+    """
 
-      # NOTE(josh): the nginx gzip_static module wants the original files around
-      # or it wont serve the compressed ones. It's not great to rely on nginx
-      # behavior but for now we touch the file to make nginx happy and then
-      # hope that it wont be served.
-      with open(logpath, 'w') as _:
-        pass
+    threshold = self.config.get('daemon.preempt_priority', None)
+    if threshold is None:
+      return []
 
-    if merge.status == orm.StatusKey.SUCCESS.value:
-      for changeinfo in change_queue:
-        queue_spec.dirty_changes.discard(changeinfo.change_id)
-      return 0
+    batch_priority = min(changeinfo.message_meta.get('Priority', 100)
+                         for changeinfo in change_queue)
+    batch_ids = set(changeinfo.change_id for changeinfo in change_queue)
+
+    self.poll_gerrit()
+    _, global_queue = functions.get_queue(self.sql_session)
+
+    preempting = []
+    for changeinfo in global_queue:
+      priority = changeinfo.message_meta.get('Priority', 100)
+      if priority >= threshold or priority >= batch_priority:
+        continue
+      if changeinfo.change_id in batch_ids:
+        continue
+      if scheduler.get_matching_spec(self.queues, changeinfo) is None:
+        continue
+      preempting.append(changeinfo)
+    return preempting
+
+  def merge_next(self):
+    """
+    Poll gerrit and verify the next batch of changes from the queues served by
+    this daemon. Returns the status of the merge, or None if there was nothing
+    to merge.
+    """
+    self.poll_gerrit()
+    _, global_queue = functions.get_queue(self.sql_session)
+
+    # Changes with reviews still in the outbox may not yet
+    # show the result of their last merge (e.g. Merge-Queue -1) on gerrit
+    pending_ids = outbox.get_pending_change_ids(self.sql_session)
+    global_queue = [changeinfo for changeinfo in global_queue
+                    if changeinfo.change_id not in pending_ids]
+
+    # The poll makes one request for the queue and one for the
+    # commit message of each change in it
+    self.poller.on_poll(
+        [changeinfo.change_id for changeinfo in global_queue
+         if scheduler.get_matching_spec(self.queues, changeinfo)],
+        cost=1 + len(global_queue))
+    queue_spec, request_queue = \
+        self.scheduler.select(global_queue, self.queues)
+    self.write_metrics()
+
+    if queue_spec is None or not request_queue:
+      # If there are no changes to any of the queues that this daemon is
+      # monitoring then we have nothing to do here.
+      return None
+
+    if queue_spec.coalesce_count > 0 and len(request_queue) > 1:
+      coalesce_queue = get_coalition(queue_spec, request_queue)
+      if len(coalesce_queue) > 1:
+        result = self.coalesce_merge(queue_spec, coalesce_queue)
+        if result == orm.StatusKey.SUCCESS.value:
+          # The coalition of changes was verified together, they have all
+          # been merged so we can poll gerrit and move on to more changes.
+          return result
+        elif result in (orm.StatusKey.PREEMPTED.value,
+                        orm.StatusKey.ABANDONED.value):
+          # The coalition will be verified again after the preempting
+          # change (or by the new leader), so it isn't dirty.
+          return result
+        else:
+          for changeinfo in coalesce_queue:
+            queue_spec.dirty_changes.add(changeinfo.change_id)
+      else:
+        logging.info('falling back to single-merge since coalition '
+                     'contains only one clean change')
     else:
-      for changeinfo in change_queue:
-        queue_spec.dirty_changes.add(changeinfo.change_id)
-      return -1
+      logging.info('skipping merge coalition, coalesce_count: %d, '
+                   'len(request_queue): %d', queue_spec.coalesce_count,
+                   len(request_queue))
+
+    if self.election is not None and not self.election.is_leader():
+      logging.info('No longer the leader, skipping the single-merge')
+      return None
+
+    # NOTE(josh): only do one merge per request to gerrit so that
+    # any changes to the queue (i.e. gerrit state through review
+    # updates or priority changes) are reflected in the merge order,
+    # as well as allowing us to pick-up on the pause sentinel
+    result = self.coalesce_merge(queue_spec, request_queue[:1])
+    if result not in (orm.StatusKey.PREEMPTED.value,
+                      orm.StatusKey.ABANDONED.value):
+      queue_spec.dirty_changes.discard(request_queue[0].change_id)
+    return result
+
+  def start_outbox(self):
+    """
+    Start the background sender which posts the reviews in the outbox
+    """
+    session_factory = sqlalchemy.orm.sessionmaker(
+        bind=self.sql_session.get_bind())
+    self.outbox_sender = outbox.OutboxSender(
+        self.gerrit, session_factory, **self.config.get('daemon.outbox', {}))
+    self.outbox_sender.start()
+
+  def stop_outbox(self):
+    """
+    Stop the background sender, if it is running
+    """
+    if self.outbox_sender is not None:
+      self.outbox_sender.stop()
+      self.outbox_sender = None
 
   def run(self, watch_manifest):
     pidfile_path = self.config.get('daemon.pidfile_path', './pid')
     handle_pid_file(pidfile_path)
-    poll_period = self.config.get('daemon.poll_period', 60)
-    offline_sentinel_path = self.config.get('daemon.offline_sentinel_path',
-                                            './pause')
-
-    mark_old_changes_as_failed(self.sql_session)
+    self.pidfile_path = pidfile_path
+    self.watcher = watcher.SourceWatcher(
+        watch_manifest, debounce=self.config.get('daemon.watch_debounce', 2.0))
+    self.watcher.start()
+    signal.signal(signal.SIGHUP, self.handle_sighup)
+    # Restart system calls interrupted by SIGHUP rather than
+    # failing them, the reload happens at the next iteration of the loop.
+    signal.siginterrupt(signal.SIGHUP, False)
+
+    if self.election is None:
+      self.start_outbox()
+      self.resume_stale_merges()
+    else:
+      # With leader election, stale merges are marked when the
+      # lease is taken over. Other daemons may be working right now.
+      self.election.start()
+    is_leader = False
     last_poll_time = 0
 
     while True:
-      functions.restart_if_modified(watch_manifest, pidfile_path)
+      self.check_restart()
+      self.reload_config()
+      offline_sentinel_path = self.config.get('daemon.offline_sentinel_path',
+                                              './pause')
 
       try:
+        if self.election is not None:
+          if not self.election.is_leader():
+            if is_leader:
+              logging.warn('No longer the leader, standing by')
+              self.stop_outbox()
+            is_leader = False
+            time.sleep(1)
+            continue
+
+          if not is_leader:
+            logging.info('Became the leader, taking over')
+            self.take_over()
+            self.start_outbox()
+            is_leader = True
+
         if os.path.exists(offline_sentinel_path):
           logging.info('Offline sentinal exists, bypassing merges')
           while os.path.exists(offline_sentinel_path):
-            functions.restart_if_modified(watch_manifest, pidfile_path)
-            time.sleep(1)
+            self.check_restart()
+            self.reload_config()
+            self.watcher.changed.wait(1)
           logging.info('Offline sentinel removed, continuing')
           continue
 
-        # If the loop was faster than poll period, then wait for
-        # the remainder of the period to prevent spamming gerrit
+        # If the loop was faster than the poll interval, then wait for
+        # the remainder of the interval to prevent spamming gerrit
         loop_duration = time.time() - last_poll_time
-        backoff_duration = poll_period - loop_duration
+        backoff_duration = self.poller.get_interval() - loop_duration
         if backoff_duration > 0:
           logging.info('Loop was very fast, waiting for '
                        '%6.2f seconds', backoff_duration)
-          time.sleep(backoff_duration)
+          self.watcher.changed.wait(backoff_duration)
 
         last_poll_time = time.time()
-        poll_id = functions.get_next_poll_id(self.sql_session)
-        functions.poll_gerrit(self.gerrit, self.sql_session, poll_id)
-        _, global_queue = functions.get_queue(self.sql_session)
-
-        queue_spec, request_queue = \
-            get_requests_from_single_queue(global_queue, self.queues)
-
-        if queue_spec is None or not request_queue:
-          # If there are no changes to any of the queues that this daemon is
-          # monitoring then we have nothing to do here.
-          continue
-
-        if queue_spec.coalesce_count > 0 and len(request_queue) > 1:
-          # NOTE(josh): Only coalesce changes that have never failed
-          # verification before.
-          coalesce_queue = []
-          for changeinfo in request_queue:
-            if changeinfo.change_id in queue_spec.dirty_changes:
-              logging.info('ceasing merge colation since %s is dirty',
-                           changeinfo.change_id)
-              break
-            else:
-              coalesce_queue.append(changeinfo)
-            if len(coalesce_queue) >= queue_spec.coalesce_count:
-              break
-
-          if len(coalesce_queue) > 1:
-            result = self.coalesce_merge(queue_spec, coalesce_queue)
-            if result == 0:
-              # The coalition of changes was verified together, they have all
-              # been merged so we can poll gerrit and move on to more changes.
-              continue
-            else:
-              for changeinfo in coalesce_queue:
-                queue_spec.dirty_changes.add(changeinfo.change_id)
-          else:
-            logging.info('falling back to single-merge since coalition '
-                         'contains only one clean change')
-        else:
-          logging.info('skipping merge coalition, coalesce_count: %d, '
-                       'len(request_queue): %d', queue_spec.coalesce_count,
-                       len(request_queue))
-
-        # NOTE(josh): only do one merge per request to gerrit so that
-        # any changes to the queue (i.e. gerrit state through review
-        # updates or priority changes) are reflected in the merge order,
-        # as well as allowing us to pick-up on the pause sentinel
-        self.coalesce_merge(queue_spec, request_queue[:1])
-        queue_spec.dirty_changes.discard(request_queue[0].change_id)
+        self.merge_next()
 
       except (httplib2.HttpLib2Error, requests.RequestException):
         logging.exception('Error retrieving merge requests from gerrit')
@@ -910,6 +2430,9 @@ class MergeDaemon(object):
       except KeyboardInterrupt:
         break
 
+    if self.election is not None:
+      self.election.stop()
+    self.stop_outbox()
     logging.info('Exiting main loop')
 
     return 0
@@ -0,0 +1,246 @@
+"""
+Estimates when each queued change will be verified. The estimate replays the
+current queue through a model of the daemon using the recent build durations
+and failure rates of each project/branch.
+"""
+
+import datetime
+import threading
+
+from gerrit_mq import common
+from gerrit_mq import daemon
+from gerrit_mq import orm
+from gerrit_mq import scheduler
+
+# Statuses of finished merges which say something about build duration
+FINISHED_STATUSES = (orm.StatusKey.SUCCESS.value,
+                     orm.StatusKey.STEP_FAILED.value,
+                     orm.StatusKey.TIMEOUT.value)
+
+
+class LaneStats(object):
+  """
+  Build statistics of one project/branch: the median duration (seconds) of
+  builds which passed and failed, and the fraction of builds which failed.
+  """
+
+  def __init__(self, pass_durations, fail_durations):
+    self.pass_duration = common.percentile(pass_durations, 50)
+    self.fail_duration = common.percentile(fail_durations, 50)
+    if self.fail_duration is None:
+      self.fail_duration = self.pass_duration
+    count = len(pass_durations) + len(fail_durations)
+    self.fail_rate = float(len(fail_durations)) / count if count else 0.0
+
+  def get_expected_duration(self, batch_size):
+    """
+    Return the expected number of seconds to verify `batch_size` changes
+    together. If a batch fails, its changes are verified again one at a time.
+    """
+    single = ((1.0 - self.fail_rate) * self.pass_duration
+              + self.fail_rate * self.fail_duration)
+    if batch_size <= 1:
+      return single
+    pass_prob = (1.0 - self.fail_rate) ** batch_size
+    return (pass_prob * self.pass_duration
+            + (1.0 - pass_prob) * (self.fail_duration + batch_size * single))
+
+
+class EtaEngine(object):
+  """
+  Computes the estimated start and finish time of every change in the queue.
+  Estimates are cached and only recomputed when the queue, the in-progress
+  merges or the merge history change. The cache holds the times of queued
+  changes relative to when their lane is next free, and they are re-anchored
+  to the current time on every call.
+
+  A single daemon verifies one merge at a time across all of its queues. If
+  builders are configured (see `master`), then each project/branch is assumed
+  to be verified in parallel.
+  """
+
+  def __init__(self, config, history_limit=1000):
+    served = None
+    if 'daemon.queues' in config:
+      served = set(tuple(key) for key in config['daemon.queues'])
+
+    self.queue_specs = scheduler.RoutingIndex()
+    for spec_dict in config.get('queues', []):
+      spec = daemon.QueueSpec(**spec_dict)
+      if served is not None and (spec.project, spec.name) not in served:
+        continue
+      self.queue_specs.setdefault(spec.project, []).append(spec)
+
+    self.parallel = bool(config.get('builders', None))
+    self.history_limit = history_limit
+    self.lock = threading.Lock()
+
+    self.stats_key = None
+    self.stats = {}
+    self.default_stats = None
+
+    self.cache_key = None
+    self.running = {}
+    self.lane_busy = {}
+    self.queued = {}
+
+  def get_lane(self, project, branch):
+    if self.parallel:
+      return (project, branch)
+    return None
+
+  def update_stats(self, sql):
+    """
+    Recompute the per-branch build statistics if a merge finished since they
+    were last computed.
+    """
+    last_rid = (sql.query(orm.MergeStatus.rid)
+                .filter(orm.MergeStatus.status.in_(FINISHED_STATUSES))
+                .order_by(orm.MergeStatus.rid.desc()).limit(1).scalar())
+    if last_rid == self.stats_key:
+      return
+    self.stats_key = last_rid
+
+    query = (sql.query(orm.MergeStatus.project, orm.MergeStatus.branch,
+                       orm.MergeStatus.status, orm.MergeStatus.start_time,
+                       orm.MergeStatus.end_time)
+             .filter(orm.MergeStatus.status.in_(FINISHED_STATUSES))
+             .order_by(orm.MergeStatus.rid.desc())
+             .limit(self.history_limit))
+
+    durations = {}
+    all_durations = ([], [])
+    for project, branch, status, start_time, end_time in query:
+      if start_time is None or end_time is None:
+        continue
+      duration = (end_time - start_time).total_seconds()
+      idx = 0 if status == orm.StatusKey.SUCCESS.value else 1
+      durations.setdefault((project, branch), ([], []))[idx].append(duration)
+      all_durations[idx].append(duration)
+
+    self.stats = {key: LaneStats(*value) for key, value in durations.iteritems()
+                  if value[0]}
+    self.default_stats = None
+    if all_durations[0]:
+      self.default_stats = LaneStats(*all_durations)
+
+  def get_stats(self, project, branch):
+    return self.stats.get((project, branch), self.default_stats)
+
+  def get_coalesce_count(self, changeinfo):
+    spec = self.queue_specs.get_spec(changeinfo.project, changeinfo.branch)
+    if spec is None:
+      return None
+    return max(spec.coalesce_count, 1)
+
+  def compute(self, queue, in_progress):
+    """
+    Replay `queue` (in service order) after the `in_progress` merges, which
+    are (merge, change_ids) pairs. Returns a tuple of:
+
+      * a dictionary mapping each change id of an in-progress merge to the
+        (start, expected finish) time of that merge
+      * a dictionary mapping each lane to the expected finish time of its
+        in-progress merges
+      * a dictionary mapping each change id of the rest of the queue to a
+        tuple of (lane, start, finish), where start and finish are seconds
+        after the time at which its lane is next free
+    """
+    running = {}
+    lane_busy = {}
+    for merge, change_ids in in_progress:
+      stats = self.get_stats(merge.project, merge.branch)
+      if stats is None:
+        continue
+      lane = self.get_lane(merge.project, merge.branch)
+      finish = merge.start_time + datetime.timedelta(
+          seconds=stats.get_expected_duration(len(change_ids)))
+      lane_busy[lane] = max(lane_busy.get(lane, finish), finish)
+      for change_id in change_ids:
+        running[change_id] = (merge.start_time, finish)
+
+    queued = {}
+    lane_offset = {}
+    remaining = [changeinfo for changeinfo in queue
+                 if changeinfo.change_id not in running]
+    while remaining:
+      head = remaining[0]
+      coalesce_count = self.get_coalesce_count(head)
+      stats = self.get_stats(head.project, head.branch)
+      if coalesce_count is None or stats is None:
+        # Not handled by any queue, or no history to estimate from
+        remaining.pop(0)
+        continue
+
+      batch = [head]
+      if coalesce_count > 1:
+        batch = [changeinfo for changeinfo in remaining
+                 if changeinfo.project == head.project
+                 and changeinfo.branch == head.branch][:coalesce_count]
+
+      lane = self.get_lane(head.project, head.branch)
+      start = lane_offset.get(lane, 0.0)
+      finish = start + stats.get_expected_duration(len(batch))
+      lane_offset[lane] = finish
+      for changeinfo in batch:
+        queued[changeinfo.change_id] = (lane, start, finish)
+        remaining.remove(changeinfo)
+
+    return running, lane_busy, queued
+
+  def get_etas(self, sql, queue, now=None):
+    """
+    Return a dictionary mapping change id to a dictionary with the estimated
+    `eta_start` and `eta_finish` of the verification of that change. `queue`
+    is the complete queue in service order (see `functions.get_queue`).
+    """
+    if now is None:
+      now = datetime.datetime.utcnow()
+
+    query = (sql.query(orm.MergeStatus)
+             .filter(orm.MergeStatus.status
+                     == orm.StatusKey.IN_PROGRESS.value)
+             .order_by(orm.MergeStatus.rid.asc()))
+    in_progress = []
+    for merge in query:
+      change_ids = [row[0] for row in
+                    sql.query(orm.MergeChange.change_id)
+                    .filter(orm.MergeChange.merge_id == merge.rid)]
+      in_progress.append((merge, change_ids))
+
+    with self.lock:
+      self.update_stats(sql)
+      cache_key = (tuple(changeinfo.change_id for changeinfo in queue),
+                   tuple(merge.rid for merge, _ in in_progress),
+                   self.stats_key)
+      if cache_key != self.cache_key:
+        self.running, self.lane_busy, self.queued = self.compute(queue,
+                                                                 in_progress)
+        self.cache_key = cache_key
+      running = self.running
+      lane_busy = self.lane_busy
+      queued = self.queued
+
+    # Each lane is next free when its in-progress merges finish, or now if they
+    # have run over their expected duration or if there are none, so that an
+    # idle or paused queue doesn't report times in the past.
+    lane_free = {lane: max(now, finish)
+                 for lane, finish in lane_busy.iteritems()}
+
+    result = {}
+    for changeinfo in queue:
+      if changeinfo.change_id in running:
+        start, finish = running[changeinfo.change_id]
+        finish = max(now, finish)
+      elif changeinfo.change_id in queued:
+        lane, start_offset, finish_offset = queued[changeinfo.change_id]
+        lane_start = lane_free.get(lane, now)
+        start = lane_start + datetime.timedelta(seconds=start_offset)
+        finish = lane_start + datetime.timedelta(seconds=finish_offset)
+      else:
+        continue
+      result[changeinfo.change_id] = {
+          'eta_start': start.strftime(orm.GERRIT_TIME_SHORT_FMT),
+          'eta_finish': finish.strftime(orm.GERRIT_TIME_SHORT_FMT),
+      }
+    return result
@@ -1,9 +1,10 @@
 from __future__ import print_function
+import base64
 import ctypes
+import datetime
 import json
 import logging
 import os
-import shutil
 import subprocess
 import sys
 import time
@@ -11,6 +12,7 @@ import zipfile
 
 import jinja2
 import requests
+import sqlalchemy
 from gerrit_mq import common
 from gerrit_mq import orm
 
@@ -51,14 +53,24 @@ def get_next_poll_id(sql):
     return last_poll_id + 1
 
 
-def poll_gerrit(gerrit, sql, poll_id):
+def poll_gerrit(gerrit, sql, poll_id, projects=None):
   """
   Hit gerrit REST and read off the current queue of merge requests. Update the
   local cache database entries for any changes that have been updated since
   our last poll. Write the resulting ordered queue to the queue file.
+
+  If `projects` is not None then only changes to those projects are requested
+  from gerrit, and the cache will only contain changes to those projects.
   """
 
-  request_queue = gerrit.get_merge_requests()
+  if projects is None:
+    request_queue = gerrit.get_merge_requests()
+  elif projects:
+    request_queue = gerrit.get_merge_requests(
+        filters=[('project', sorted(projects))])
+  else:
+    request_queue = []
+
   for changeinfo in request_queue:
     # Take this opportunity to to update the AccountInfo table
     # with the owner info
@@ -114,265 +126,455 @@ def get_queue(sql, project_filter=None, branch_filter=None,
   if limit is not None and limit > 0:
     query = query.limit(limit)
 
-  return count, [common.ChangeInfo(**ci_sql.as_dict()) for ci_sql in query]
+  # Load the owners in the same query, rather than one query per
+  # row when each owner is first accessed
+  query = query.options(sqlalchemy.orm.joinedload(orm.ChangeInfo.owner))
+  return count, [common.ChangeInfo.from_sql(ci_sql) for ci_sql in query]
 
 
-def get_history(sql, project_filter, branch_filter, offset, limit):
+# Maximum number of values bound in one `IN` expression. SQLite allows 999
+# variables per statement.
+SQL_IN_CHUNK_SIZE = 500
+
+
+def parse_like(pattern):
   """
-  Return json serializable list of MergeStatus dictionaries for available
-  merge requests matching the given project and branch filters (as regular
-  expressions)
+  Return the literal string matched by the SQL `LIKE` expression `pattern`,
+  in which a backslash escapes a literal `%`, `_` or backslash. Returns None
+  if `pattern` has wildcards.
+  """
+  chars = []
+  escaped = False
+  for char in pattern:
+    if escaped:
+      chars.append(char)
+      escaped = False
+    elif char == '\\':
+      escaped = True
+    elif char in '%_':
+      return None
+    else:
+      chars.append(char)
+  if escaped:
+    chars.append('\\')
+  return ''.join(chars)
 
-  TODO(josh): filter out any which are IN_PROGRESS?
+
+def filter_like(query, column, pattern):
   """
-  query = sql.query(orm.MergeStatus)
+  Filter `query` to rows where `column` matches the SQL `LIKE` expression
+  `pattern` (case insensitive, with backslash as the escape character). A
+  pattern without wildcards (e.g. ``release\\_1`` for the branch `release_1`)
+  is compared with a case insensitive `=` instead, which can search the NOCASE
+  indexes on `column`.
+  """
+  if pattern is None:
+    return query
+  literal = parse_like(pattern)
+  if literal is None:
+    return query.filter(column.like(pattern, escape='\\'))
+  return query.filter(column.collate('NOCASE') == literal)
 
-  if project_filter is not None:
-    query = query.filter(orm.MergeStatus.project.like(project_filter))
-  if branch_filter is not None:
-    query = query.filter(orm.MergeStatus.branch.like(branch_filter))
 
-  query = query.order_by(orm.MergeStatus.end_time.desc())
-  count = query.count()
+def get_merge_changes(sql, merge_ids):
+  """
+  Return a dictionary mapping each of `merge_ids` to the list of MergeChange
+  rows of that merge in request order (with their owners loaded), in one
+  query per `SQL_IN_CHUNK_SIZE` merges.
+  """
+  merge_ids = list(merge_ids)
+  result = {merge_id: [] for merge_id in merge_ids}
+  for idx in range(0, len(merge_ids), SQL_IN_CHUNK_SIZE):
+    query = (sql.query(orm.MergeChange)
+             .options(sqlalchemy.orm.joinedload(orm.MergeChange.owner))
+             .filter(orm.MergeChange.merge_id.in_(
+                 merge_ids[idx:idx + SQL_IN_CHUNK_SIZE]))
+             .order_by(orm.MergeChange.merge_id,
+                       orm.MergeChange.request_time, orm.MergeChange.rid))
+    for change_sql in query:
+      result[change_sql.merge_id].append(change_sql)
+  return result
 
-  if offset > 0:
-    query = query.offset(offset)
 
-  if limit > 0:
-    query = query.limit(limit)
+def merges_as_dicts(sql, merges, include_changes):
+  """
+  Return json serializable dictionaries of the MergeStatus rows `merges`. If
+  `include_changes` is true then each dictionary includes the list of
+  `changes` of that merge.
+  """
+  changes = {}
+  if include_changes:
+    changes = get_merge_changes(sql, [ms_sql.rid for ms_sql in merges])
 
-  return dict(count=count, result=[ms_sql.as_dict() for ms_sql in query])
+  result = []
+  for ms_sql in merges:
+    merge_json = ms_sql.as_dict()
+    if include_changes:
+      merge_json['changes'] = [change_sql.as_dict() for change_sql
+                               in changes[ms_sql.rid]]
+    result.append(merge_json)
+  return result
 
 
-def sync_account_db(gerrit, sql):
+def encode_history_cursor(direction, rid):
   """
-  Synchronize local account table to gerrit account table
+  Return an opaque cursor for the page of history before ('prev') or after
+  ('next') the merge `rid`.
   """
+  return base64.urlsafe_b64encode('{}:{}'.format(direction, rid))
 
-  page_size = 25
-  for page_idx in range(10000):
-    offset = page_idx * page_size
-    json_list = gerrit.get('accounts/?start={offset}&n={page_size}&o=DETAILS'
-                           .format(offset=offset, page_size=page_size))
-    for ai_json in json_list:
-      query = (sql
-               .query(orm.AccountInfo)
-               .filter(orm.AccountInfo.rid == ai_json['_account_id']))
-      if query.count() > 0:
-        for ai_sql in query:
-          ai_sql.name = ai_json.get('name', '<none>')
-          ai_sql.email = ai_json.get('email', '<none>')
-          ai_sql.username = ai_json.get('username', '<none>')
-          sql.commit()
-          break
-      else:
-        kwargs = dict(ai_json)
-        kwargs['rid'] = kwargs.pop('_account_id')
-        for key in ['name', 'email', 'username']:
-          if key not in kwargs:
-            kwargs[key] = '<none>'
 
-        ai_sql = orm.AccountInfo(**kwargs)
-        sql.add(ai_sql)
-        sql.commit()
+def decode_history_cursor(cursor):
+  """
+  Return the (direction, rid) of a cursor returned by
+  `encode_history_cursor`. Raises ValueError if the cursor is malformed.
+  """
+  try:
+    direction, rid = base64.urlsafe_b64decode(str(cursor)).split(':')
+  except (TypeError, ValueError):
+    raise ValueError('Malformed history cursor: {}'.format(cursor))
+  if direction not in ('prev', 'next'):
+    raise ValueError('Malformed history cursor: {}'.format(cursor))
+  return direction, int(rid)
 
-    if len(json_list) < 1 or '_more_accounts' not in json_list[-1]:
-      break
 
+def get_merge_count(sql, project_filter, branch_filter):
+  """
+  Return the number of merges in the history matching the given project and
+  branch filters (as SQL `LIKE` expressions), from the maintained counter
+  table rather than a `count()` of the history. The count may be off by the
+  merges recorded while it is read.
+  """
+  # The counter table is maintained by sqlite triggers (see
+  # `orm.install_merge_count_triggers`), other databases count the history.
+  if sql.get_bind().dialect.name != 'sqlite':
+    query = sql.query(sqlalchemy.func.count(orm.MergeStatus.rid))
+    query = filter_like(query, orm.MergeStatus.project, project_filter)
+    query = filter_like(query, orm.MergeStatus.branch, branch_filter)
+    return query.scalar()
+
+  query = sql.query(sqlalchemy.func.sum(orm.MergeCount.count))
+  query = filter_like(query, orm.MergeCount.project, project_filter)
+  query = filter_like(query, orm.MergeCount.branch, branch_filter)
+  return query.scalar() or 0
 
-def migrate_db(gerrit, input_path, from_version, output_path, to_version):
+
+def get_history_page(sql, project_filter, branch_filter, cursor, limit,
+                     include_changes=False):
   """
-  Migrate a database from one schema version to another
+  Return a page of at most `limit` merges in the history (most recent first)
+  using keyset pagination on `rid`, so that the cost of a page doesn't depend
+  on how deep it is. `cursor` is the `next_cursor` or `prev_cursor` of a
+  previous page, or None for the first page. The result includes the cursors
+  of the adjacent pages (None if there isn't one), the cursor of the `last`
+  (oldest) page, and the approximate `count` of matching merges.
   """
+  query = sql.query(orm.MergeStatus)
 
-  if from_version == '0.1.0' and to_version == '0.2.0':
-    migrate_db_v0p1p0_to_v0p2p0(gerrit, input_path, output_path)
-  elif from_version == '0.2.0' and to_version == '0.2.1':
-    migrate_db_v0p2p0_to_v0p2p1(input_path, output_path)
+  query = filter_like(query, orm.MergeStatus.project, project_filter)
+  query = filter_like(query, orm.MergeStatus.branch, branch_filter)
 
+  direction, anchor_rid = 'next', None
+  if cursor:
+    direction, anchor_rid = decode_history_cursor(cursor)
 
-def migrate_db_v0p2p0_to_v0p2p1(input_path, output_path):
+  if direction == 'next':
+    if anchor_rid is not None:
+      query = query.filter(orm.MergeStatus.rid < anchor_rid)
+    query = query.order_by(orm.MergeStatus.rid.desc())
+  else:
+    query = query.filter(orm.MergeStatus.rid > anchor_rid)
+    query = query.order_by(orm.MergeStatus.rid.asc())
+
+  # Fetch one extra row to find out if there is another page in
+  # the direction we are going.
+  if limit > 0:
+    query = query.limit(limit + 1)
+  merges = list(query)
+  has_more = limit > 0 and len(merges) > limit
+  merges = merges[:limit] if limit > 0 else merges
+
+  if direction == 'next':
+    has_prev, has_next = anchor_rid is not None, has_more
+  else:
+    merges.reverse()
+    has_prev, has_next = has_more, anchor_rid > 0
+
+  next_cursor = None
+  prev_cursor = None
+  if has_next:
+    if merges:
+      next_cursor = encode_history_cursor('next', merges[-1].rid)
+    elif anchor_rid is not None:
+      next_cursor = encode_history_cursor('next', anchor_rid + 1)
+  if has_prev:
+    if merges:
+      prev_cursor = encode_history_cursor('prev', merges[0].rid)
+    else:
+      prev_cursor = encode_history_cursor('prev', anchor_rid - 1)
+
+  return dict(count=get_merge_count(sql, project_filter, branch_filter),
+              result=merges_as_dicts(sql, merges, include_changes),
+              next_cursor=next_cursor, prev_cursor=prev_cursor,
+              last_cursor=encode_history_cursor('prev', 0))
+
+
+def get_history(sql, project_filter, branch_filter, offset, limit,
+                include_changes=False):
   """
-  Split merge_history into merge_history and merge_changes.
+  Return json serializable list of MergeStatus dictionaries for available
+  merge requests matching the given project and branch filters (as SQL
+  `LIKE` expressions), most recently finished first. If `include_changes` is
+  true then each dictionary includes the list of `changes` of that merge. The
+  `count` of matching merges comes from `get_merge_count`. Deep pages are slow
+  on a long history, see `get_history_page` (which is ordered by merge id).
+
+  TODO(josh): filter out any which are IN_PROGRESS?
   """
+  query = sql.query(orm.MergeStatus)
 
-  tmp_path = input_path + '.mq_migration'
+  query = filter_like(query, orm.MergeStatus.project, project_filter)
+  query = filter_like(query, orm.MergeStatus.branch, branch_filter)
 
-  if os.path.exists(tmp_path):
-    logging.info('Removing stale temporary %s', tmp_path)
-    os.remove(tmp_path)
+  # The merge id breaks ties so that pages don't overlap
+  query = query.order_by(orm.MergeStatus.end_time.desc(),
+                         orm.MergeStatus.rid.desc())
+  count = get_merge_count(sql, project_filter, branch_filter)
 
-  logging.info('Copying %s to %s', input_path, tmp_path)
-  shutil.copyfile(input_path, tmp_path)
+  if offset > 0:
+    query = query.offset(offset)
 
-  logging.info('Creating merge_changes table')
-  import sqlite3
-  conn = sqlite3.connect(tmp_path)
-  cur = conn.cursor()
-  cur.execute('SELECT name FROM SQLITE_MASTER WHERE type="index"'
-              ' AND tbl_name="merge_history"')
-  indices = [row[0] for row in cur]
-  for index in indices:
-    logging.info('Dropping index %s from merge_history', index)
-    cur.execute('DROP INDEX {}'.format(index))
-  cur.execute('ALTER TABLE merge_history RENAME TO merge_history_v0p2p0')
-  conn.commit()
-  conn.close()
+  if limit > 0:
+    query = query.limit(limit)
 
-  try:
-    os.remove(output_path)
-  except OSError:
-    pass
+  return dict(count=count,
+              result=merges_as_dicts(sql, list(query), include_changes))
+
+
+def record_step_timing(sql, merge_id, project, queue, step, duration, status):
+  """
+  Store the duration of one build step in the step timing table.
+  """
 
-  os.rename(tmp_path, output_path)
+  sql.add(orm.StepTiming(merge_id=merge_id, project=project, queue=queue,
+                         step=step, duration=duration, status=status))
+  sql.commit()
 
-  logging.info('Migrating rows')
-  sql = orm.init_sql('sqlite:///{}'.format(output_path))()
 
-  prev_migration_query = (sql.query(orm.MergeStatus)
-                          .order_by(orm.MergeStatus.rid.desc())
-                          .limit(1))
-  source_query = sql.query(orm.MergeStatusV0p2p0)
+def get_step_durations(sql, project, queue, step, limit=100):
+  """
+  Return a list of durations (in seconds) for the `limit` most recent
+  successful executions of `step` in the given queue.
+  """
 
-  if prev_migration_query.count() > 0:
-    prev_migration_last = -1
-    for prev_status in prev_migration_query:
-      prev_migration_last = prev_status.rid
-      break
+  query = (sql.query(orm.StepTiming.duration)
+           .filter(orm.StepTiming.project == project)
+           .filter(orm.StepTiming.queue == queue)
+           .filter(orm.StepTiming.step == step)
+           .filter(orm.StepTiming.status == orm.StatusKey.SUCCESS.value)
+           .order_by(orm.StepTiming.rid.desc())
+           .limit(limit))
+  return [row[0] for row in query]
 
-    logging.info('Detected previous migration, will migrate increment'
-                 ' starting at row id %d', prev_migration_last)
-    source_query = source_query.filter(orm.MergeStatusV0p1p0.id >
-                                       prev_migration_last)
 
-  last_print_time = 0
-  query_count = source_query.count()
-  for idx, old_status in enumerate(source_query):
-    kwargs = {key: getattr(old_status, key) for key in
-              ['rid', 'project', 'branch', 'start_time', 'end_time', 'status']}
-    sql.add(orm.MergeStatus(**kwargs))
+def record_flake(sql, merge_id, project, queue, step, attempts):
+  """
+  Store a flake signal: `step` failed and then passed on retry.
+  """
 
-    kwargs = {key: getattr(old_status, key) for key in
-              ['owner_id', 'change_id', 'request_time', 'msg_meta']}
-    kwargs['merge_id'] = old_status.rid
-    sql.add(orm.MergeChange(**kwargs))
+  logging.info('Step %s passed after %d attempts, recording flake', step,
+               attempts)
+  sql.add(orm.FlakeEvent(merge_id=merge_id, project=project, queue=queue,
+                         step=step, attempts=attempts,
+                         when=datetime.datetime.utcnow()))
+  sql.commit()
 
-    sql.commit()
 
-    if time.time() - last_print_time > 0.5:
-      last_print_time = time.time()
-      progress = 100.0 * (idx + 1) / query_count
-      sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\r'
-                       .format(idx, query_count, progress))
-      sys.stdout.flush()
+def get_flaky_steps(sql, project_filter=None, queue_filter=None, limit=25):
+  """
+  Return a list of the flakiest build steps, ranked by the number of flake
+  events recorded for each. Each item is a json serializable dictionary
+  including the number of `flakes`, the number of times the step was executed
+  (`runs`, including retries), and the `flake_rate` (flakes per run).
 
-  sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\n'
-                   .format(query_count, query_count, 100.0))
+  `project_filter` and `queue_filter` are SQL `LIKE` expressions.
+  """
 
-  sql.close()
+  def apply_filters(query, table):
+    if project_filter is not None:
+      query = query.filter(table.project.like(project_filter))
+    if queue_filter is not None:
+      query = query.filter(table.queue.like(queue_filter))
+    return query
 
-  conn = sqlite3.connect(output_path)
-  cur = conn.cursor()
-  cur.execute('DROP TABLE merge_history_v0p2p0')
-  conn.commit()
-  conn.close()
+  flake_count = sqlalchemy.func.count(orm.FlakeEvent.rid)
+  query = (sql.query(orm.FlakeEvent.project, orm.FlakeEvent.queue,
+                     orm.FlakeEvent.step, flake_count,
+                     sqlalchemy.func.max(orm.FlakeEvent.when))
+           .group_by(orm.FlakeEvent.project, orm.FlakeEvent.queue,
+                     orm.FlakeEvent.step))
+  query = apply_filters(query, orm.FlakeEvent)
+  query = query.order_by(flake_count.desc())
+  if limit is not None and limit > 0:
+    query = query.limit(limit)
+  flakes = list(query)
+  if not flakes:
+    return []
+
+  run_counts = {}
+  query = (sql.query(orm.StepTiming.project, orm.StepTiming.queue,
+                     orm.StepTiming.step,
+                     sqlalchemy.func.count(orm.StepTiming.rid))
+           .filter(orm.StepTiming.step.in_(set(row[2] for row in flakes)))
+           .group_by(orm.StepTiming.project, orm.StepTiming.queue,
+                     orm.StepTiming.step))
+  query = apply_filters(query, orm.StepTiming)
+  for project, queue, step, count in query:
+    run_counts[(project, queue, step)] = count
+
+  result = []
+  for project, queue, step, count, last_flake in flakes:
+    runs = max(run_counts.get((project, queue, step), 0), count)
+    result.append(dict(project=project, queue=queue, step=step, flakes=count,
+                       runs=runs, flake_rate=float(count) / runs,
+                       last_flake=last_flake.strftime(
+                           common.GERRIT_TIME_SHORT_FMT)))
+
+  return sorted(result, key=lambda item: (-item['flakes'],
+                                          -item['flake_rate']))
+
+
+def acquire_leader_lease(sql, name, holder, ttl):
+  """
+  Acquire, or renew, the leader lease `name` for `holder`. The lease is only
+  granted if it is free, already held by `holder`, or expired. Returns True if
+  `holder` holds the lease for the next `ttl` seconds.
+  """
+
+  now = datetime.datetime.utcnow()
+  expire_time = now + datetime.timedelta(seconds=ttl)
+
+  # A single conditional UPDATE so that two daemons can't both
+  # take over an expired lease.
+  table = orm.LeaderLease.__table__
+  result = sql.execute(
+      table.update()
+      .where(table.c.name == name)
+      .where(sqlalchemy.or_(table.c.holder == holder,
+                            table.c.expire_time < now))
+      .values(holder=holder, renew_time=now, expire_time=expire_time))
+  sql.commit()
+  if result.rowcount == 1:
+    return True
+
+  if sql.query(orm.LeaderLease).get(name) is not None:
+    return False
+
+  try:
+    sql.add(orm.LeaderLease(name=name, holder=holder, renew_time=now,
+                            expire_time=expire_time))
+    sql.commit()
+  except sqlalchemy.exc.IntegrityError:
+    sql.rollback()
+    return False
+  return True
 
 
-def migrate_db_v0p1p0_to_v0p2p0(gerrit, input_path, output_path):
+def release_leader_lease(sql, name, holder):
   """
-  Migrate a database from one schema version to another
+  Expire the leader lease `name` immediately if it is held by `holder`, so that
+  a standby may take over without waiting.
   """
-  tmp_path = input_path + '.mq_migration'
+  table = orm.LeaderLease.__table__
+  sql.execute(table.update()
+              .where(table.c.name == name)
+              .where(table.c.holder == holder)
+              .values(expire_time=datetime.datetime.utcnow()))
+  sql.commit()
 
-  if os.path.exists(tmp_path):
-    logging.info('Removing stale temporary %s', tmp_path)
-    os.remove(tmp_path)
 
-  logging.info('Copying %s to %s', input_path, tmp_path)
-  shutil.copyfile(input_path, tmp_path)
+def set_leader_merge(sql, name, holder, merge_id):
+  """
+  Record `merge_id` as the merge in progress by the holder of leader lease
+  `name`, so that a successor knows which merge was interrupted.
+  """
+  table = orm.LeaderLease.__table__
+  sql.execute(table.update()
+              .where(table.c.name == name)
+              .where(table.c.holder == holder)
+              .values(merge_id=merge_id))
+  sql.commit()
 
-  logging.info('Renaming old table')
-  import sqlite3
-  conn = sqlite3.connect(tmp_path)
-  cur = conn.cursor()
-  cur.execute('ALTER TABLE merge_history RENAME TO merge_history_v0p1p0')
-  conn.commit()
-  conn.close()
 
-  logging.info('Migrating rows')
-  source_sql = orm.init_sql('sqlite:///{}'.format(tmp_path))()
-  dest_sql = orm.init_sql('sqlite:///{}'.format(output_path))()
+def get_dirty_change_ids(sql, change_ids):
+  """
+  Return the subset of `change_ids` whose most recent verification was a
+  failed coalesced verification (i.e. one of several changes verified
+  together).
+  """
 
-  prev_migration_query = (dest_sql.query(orm.MergeStatus)
-                          .order_by(orm.MergeStatus.rid.desc())
-                          .limit(1))
+  change_ids = list(change_ids)
+  if not change_ids:
+    return set()
 
-  source_query = source_sql.query(orm.MergeStatusV0p1p0)
+  latest = {}
+  query = (sql.query(orm.MergeChange.change_id,
+                     sqlalchemy.func.max(orm.MergeChange.merge_id))
+           .filter(orm.MergeChange.change_id.in_(change_ids))
+           .group_by(orm.MergeChange.change_id))
+  for change_id, merge_id in query:
+    latest[change_id] = merge_id
+  if not latest:
+    return set()
 
-  if prev_migration_query.count() > 0:
-    prev_migration_last = -1
-    for prev_status in prev_migration_query:
-      prev_migration_last = prev_status.rid
-      break
+  merge_ids = set(latest.values())
+  statuses = dict(sql.query(orm.MergeStatus.rid, orm.MergeStatus.status)
+                  .filter(orm.MergeStatus.rid.in_(merge_ids)))
+  sizes = dict(sql.query(orm.MergeChange.merge_id,
+                         sqlalchemy.func.count(orm.MergeChange.rid))
+               .filter(orm.MergeChange.merge_id.in_(merge_ids))
+               .group_by(orm.MergeChange.merge_id))
 
-    logging.info('Detected previous migration, will migrate increment'
-                 ' starting at row id %d', prev_migration_last)
-    source_query = source_query.filter(orm.MergeStatusV0p1p0.id >
-                                       prev_migration_last)
+  failed = (orm.StatusKey.STEP_FAILED.value, orm.StatusKey.TIMEOUT.value,
+            orm.StatusKey.CANCELED.value)
+  return set(change_id for change_id, merge_id in latest.iteritems()
+             if sizes.get(merge_id, 0) > 1 and statuses.get(merge_id) in failed)
 
-  last_print_time = 0
-  query_count = source_query.count()
-  for idx, old_status in enumerate(source_query):
-    if old_status.result == orm.StatusKey.IN_PROGRESS.value:
-      status = orm.StatusKey.CANCELED.value
-    else:
-      status = old_status.result
-
-    changeinfo = None
-    msg_meta = {}
-    max_tries = 10
-    sleep_duration = 2
-
-    for try_idx in range(max_tries):
-      try:
-        if not changeinfo:
-          changeinfo = gerrit.get_change(old_status.change_id)
-        if not msg_meta:
-          msg_meta = gerrit.get_message_meta(old_status.change_id,
-                                             changeinfo.current_revision)
-        break
-      except requests.RequestException:
-        logging.warn('Failed to poll gerrit for change %s %d/%d',
-                     old_status.change_id, try_idx, max_tries)
-        time.sleep(sleep_duration)
-
-    if changeinfo is not None:
-      owner_id = changeinfo.owner.account_id
-    else:
-      owner_id = -1
-    new_status = orm.MergeStatusV0p2p0(rid=old_status.id,
-                                       project='aircam',
-                                       branch=old_status.target_branch,
-                                       owner_id=owner_id,
-                                       change_id=old_status.change_id,
-                                       request_time=old_status.request_time,
-                                       start_time=old_status.start_time,
-                                       end_time=old_status.end_time,
-                                       msg_meta=json.dumps(msg_meta),
-                                       status=status)
-    dest_sql.add(new_status)
-    dest_sql.commit()
-
-    if time.time() - last_print_time > 0.5:
-      last_print_time = time.time()
-      progress = 100.0 * (idx + 1) / query_count
-      sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\r'
-                       .format(idx, query_count, progress))
-      sys.stdout.flush()
 
-  sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\n'
-                   .format(query_count, query_count, 100.0))
-  os.remove(tmp_path)
+def sync_account_db(gerrit, sql):
+  """
+  Synchronize local account table to gerrit account table
+  """
+
+  page_size = 25
+  for page_idx in range(10000):
+    offset = page_idx * page_size
+    json_list = gerrit.get('accounts/?start={offset}&n={page_size}&o=DETAILS'
+                           .format(offset=offset, page_size=page_size))
+    for ai_json in json_list:
+      query = (sql
+               .query(orm.AccountInfo)
+               .filter(orm.AccountInfo.rid == ai_json['_account_id']))
+      if query.count() > 0:
+        for ai_sql in query:
+          ai_sql.name = ai_json.get('name', '<none>')
+          ai_sql.email = ai_json.get('email', '<none>')
+          ai_sql.username = ai_json.get('username', '<none>')
+          sql.commit()
+          break
+      else:
+        kwargs = dict(ai_json)
+        kwargs['rid'] = kwargs.pop('_account_id')
+        for key in ['name', 'email', 'username']:
+          if key not in kwargs:
+            kwargs[key] = '<none>'
+
+        ai_sql = orm.AccountInfo(**kwargs)
+        sql.add(ai_sql)
+        sql.commit()
+
+    if len(json_list) < 1 or '_more_accounts' not in json_list[-1]:
+      break
 
 
 MISSING_IDS_QUERY = """
@@ -580,6 +782,18 @@ def get_real_argv():
     return infile.read().split('\0')[:-1]
 
 
+def restart_process(changelist, pidfile_path):
+  """
+  Restart (re-exec) the process because the files in `changelist` changed
+  """
+
+  logging.info('Detected a sourcefile change: \n  '
+               + '\n  '.join(changelist))
+  argv = get_real_argv()
+  os.remove(pidfile_path)
+  os.execvp(sys.executable, argv)
+
+
 def restart_if_modified(watch_manifest, pidfile_path):
   """
   Restart the process if any file in the manifest has changed
@@ -587,11 +801,7 @@ def restart_if_modified(watch_manifest, pidfile_path):
 
   changelist = get_changelist(watch_manifest)
   if changelist:
-    logging.info('Detected a sourcefile change: \n  '
-                 + '\n  '.join(changelist))
-    argv = get_real_argv()
-    os.remove(pidfile_path)
-    os.execvp(sys.executable, argv)
+    restart_process(changelist, pidfile_path)
 
 class ZipFileLoader(jinja2.BaseLoader):
   """
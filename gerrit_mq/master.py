@@ -1,13 +1,23 @@
-"""Web frontend for inspecting the merge queue."""
+"""
+Job dispatcher for a fleet of merge-queue builders. Builders lease merges
+from the master, renew their lease while they verify the merge, and report
+the result back to the master which records it in the merge history.
+"""
 
 from __future__ import print_function
 import cStringIO
+import datetime
+import logging
+import threading
+import time
 
 import flask
-import sqlalchemy
 
+from gerrit_mq import daemon
 from gerrit_mq import functions
 from gerrit_mq import orm
+from gerrit_mq import outbox
+from gerrit_mq import scheduler
 
 HTML_ESCAPE_TABLE = {
     "&": "&amp;",
@@ -86,10 +96,37 @@ class Master(flask.Flask):
     self.mq_config = mq_config
     self.secret_key = mq_config['webfront.secret_key']
 
-    self.add_url_rule('/gmq/get_history', self.get_job)
-    self.add_url_rule('/gmq/get_job', self.get_job)
-    self.add_url_rule('/gmq/get_queue', self.get_queue)
-    self.add_url_rule('/gmq/get_status', self.get_job)
+    # Builders must renew their lease at least this often (seconds) or else
+    # their merge is considered abandoned.
+    self.lease_ttl = mq_config.get('master.lease_ttl', 60)
+    self.poll_period = mq_config.get('master.poll_period', 60)
+    self.last_poll_time = 0
+
+    # Serializes dispatch so that two builders can't be handed
+    # merges for the same project/branch. The unique constraint on the lease
+    # table backs this up.
+    self.dispatch_lock = threading.Lock()
+    self.scheduler = scheduler.FairScheduler(
+        age_boost=mq_config.get('daemon.age_boost', None))
+
+    self.queue_index = {}
+    for spec_dict in mq_config['queues']:
+      spec = daemon.QueueSpec(**spec_dict)
+      self.queue_index[(spec.project, spec.name)] = spec
+
+    # Routing index of the queues of each builder, by builder name
+    self.builder_queues = {}
+
+    self.add_url_rule('/gmq/get_history', 'get_history', self.get_history)
+    self.add_url_rule('/gmq/get_job', 'get_job', self.get_job,
+                      methods=['POST'])
+    self.add_url_rule('/gmq/get_leases', 'get_leases', self.get_leases)
+    self.add_url_rule('/gmq/get_queue', 'get_queue', self.get_queue)
+    self.add_url_rule('/gmq/get_status', 'get_status', self.get_status)
+    self.add_url_rule('/gmq/post_result', 'post_result', self.post_result,
+                      methods=['POST'])
+    self.add_url_rule('/gmq/renew_lease', 'renew_lease', self.renew_lease,
+                      methods=['POST'])
 
   def get_queue(self):
     """
@@ -106,10 +143,11 @@ class Master(flask.Flask):
         = extract_common_args(flask.request.args)
 
     sql = self.sql_factory()
-    result = functions.get_queue(sql, project_filter, branch_filter, offset,
-                                 limit)
+    count, result_list = functions.get_queue(sql, project_filter, branch_filter,
+                                             offset, limit)
     sql.close()
-    return flask.jsonify(result)
+    return flask.jsonify(count=count,
+                         result=[ci.as_dict() for ci in result_list])
 
   def get_history(self):
     """
@@ -120,11 +158,28 @@ class Master(flask.Flask):
       `branch` : SQL `LIKE` expression for branches to match
       `offset` : start offset for pagination
       `limit` : maximum number of records to return
+      `cursor` : paginate by cursor instead of offset. Empty for the first
+                 page, or the `next_cursor`, `prev_cursor` or `last_cursor`
+                 of a previous result.
     """
     project_filter, branch_filter, offset, limit \
         = extract_common_args(flask.request.args)
 
     sql = self.sql_factory()
+    if 'cursor' in flask.request.args:
+      try:
+        result = functions.get_history_page(
+            sql, project_filter, branch_filter, flask.request.args['cursor'],
+            limit)
+      except ValueError:
+        sql.close()
+        response = flask.jsonify({'status': 'ERROR',
+                                  'reason': 'invalid cursor'})
+        response.status_code = 400
+        return response
+      sql.close()
+      return flask.jsonify(result)
+
     result = functions.get_history(sql, project_filter, branch_filter, offset,
                                    limit)
     sql.close()
@@ -159,19 +214,33 @@ class Master(flask.Flask):
     response.status_code = 404
     return response
 
-  def get_job(self):
+  def get_leases(self):
+    """
+    Return json-encoded list of the currently active job leases
+    """
+    sql = self.sql_factory()
+    query = sql.query(orm.JobLease).order_by(orm.JobLease.merge_id)
+    result = [lease.as_dict() for lease in query]
+    sql.close()
+    return flask.jsonify(result=result)
+
+  def authenticate(self):
     """
-    Return the next available job for a given executor
+    Return the configuration of the builder making the current request, or
+    None and an error response if the builder can't be authenticated.
 
-    Query params:
-      `builder_id` : the builder id
-      `auth_key` : the builder secret
+    Builders authenticate with HTTP basic auth (`Authorization` header) using
+    their name and secret, so that the secret does not end up in access logs.
     """
     builder = None
-    builder_id = flask.request.args.get('builder_id', None)
+    builder_id = None
+    auth_key = None
+    if flask.request.authorization is not None:
+      builder_id = flask.request.authorization.username
+      auth_key = flask.request.authorization.password
 
     for builder_config in self.mq_config['builders']:
-      if builder_config['id'] == builder_id:
+      if builder_config['name'] == builder_id:
         builder = builder_config
         break
 
@@ -180,31 +249,242 @@ class Master(flask.Flask):
                                 'reason':
                                 'Builder not found {}'.format(builder_id)})
       response.status_code = 404
-      return response
+      return None, response
 
-    if builder['auth_key'] != flask.request.args.get('auth_key', None):
+    if builder['auth_key'] != auth_key:
       response = flask.jsonify({'status': 'ERROR',
                                 'reason': 'Invalid credentials'})
       response.status_code = 403
+      return None, response
+
+    return builder, None
+
+  def get_builder_queues(self, builder):
+    """
+    Return a map of project name to the list of queue specs that `builder`
+    builds.
+    """
+    queues = self.builder_queues.get(builder['name'], None)
+    if queues is not None:
+      return queues
+
+    queues = scheduler.RoutingIndex()
+    for project, name in builder['queues']:
+      spec = self.queue_index.get((project, name), None)
+      if spec is None:
+        logging.warn('builder %s queue not listed in queue index: %s/%s',
+                     builder['name'], project, name)
+        continue
+      queues.setdefault(project, []).append(spec)
+    self.builder_queues[builder['name']] = queues
+    return queues
+
+  def poll_gerrit(self, sql):
+    """
+    Update the queue from gerrit, at most once every poll period
+    """
+    if time.time() - self.last_poll_time < self.poll_period:
+      return
+
+    self.last_poll_time = time.time()
+    projects = None
+    if not self.mq_config.get('master.query_all_projects', False):
+      projects = sorted(set(project for builder in self.mq_config['builders']
+                            for project, _ in builder['queues']))
+    poll_id = functions.get_next_poll_id(sql)
+    functions.poll_gerrit(self.gerrit, sql, poll_id, projects)
+
+  def reap_expired_leases(self, sql):
+    """
+    Mark any merges whose lease has expired as abandoned, and release their
+    project/branch for dispatch.
+    """
+    now = datetime.datetime.utcnow()
+    query = sql.query(orm.JobLease).filter(orm.JobLease.expire_time < now)
+    for lease in query:
+      logging.warn('Lease on merge %d held by %s expired, marking it abandoned',
+                   lease.merge_id, lease.builder)
+      merge = sql.query(orm.MergeStatus).get(lease.merge_id)
+      if merge is not None:
+        merge.status = orm.StatusKey.ABANDONED.value
+        merge.end_time = now
+      sql.delete(lease)
+    sql.commit()
+
+  def dispatch(self, sql, builder):
+    """
+    Select the next merge for `builder`, record it, and lease it to the
+    builder. Returns a json-serializable job description, or an empty
+    dictionary if there is nothing for the builder to do.
+    """
+    self.reap_expired_leases(sql)
+    self.poll_gerrit(sql)
+
+    busy = set((lease.project, lease.branch)
+               for lease in sql.query(orm.JobLease))
+    _, global_queue = functions.get_queue(sql)
+    pending_ids = outbox.get_pending_change_ids(sql)
+    available = [changeinfo for changeinfo in global_queue
+                 if (changeinfo.project, changeinfo.branch) not in busy
+                 and changeinfo.change_id not in pending_ids]
+
+    queue_spec, request_queue = self.scheduler.select(
+        available, self.get_builder_queues(builder))
+    if queue_spec is None or not request_queue:
+      return {}
+
+    change_queue = request_queue[:1]
+    if queue_spec.coalesce_count > 0 and len(request_queue) > 1:
+      coalition = daemon.get_coalition(queue_spec, request_queue)
+      if len(coalition) > 1:
+        change_queue = coalition
+
+    for changeinfo in change_queue:
+      functions.add_or_update_account_info(sql, changeinfo.owner)
+    merge = daemon.create_sql_records(sql, queue_spec, change_queue)
+
+    now = datetime.datetime.utcnow()
+    sql.add(orm.JobLease(
+        merge_id=merge.rid, builder=builder['name'],
+        project=queue_spec.project, branch=merge.branch,
+        queue=queue_spec.name, start_time=now, renew_time=now,
+        expire_time=now + datetime.timedelta(seconds=self.lease_ttl)))
+    sql.commit()
+
+    logging.info('Dispatched merge %d of %s/%s to %s', merge.rid,
+                 merge.project, merge.branch, builder['name'])
+    return {
+        'merge_id': merge.rid,
+        'project': queue_spec.project,
+        'branch': merge.branch,
+        'queue': queue_spec.name,
+        'changes': [changeinfo.as_dict() for changeinfo in change_queue],
+        'lease_ttl': self.lease_ttl,
+    }
+
+  def get_job(self):
+    """
+    Return the next available job for a given builder. The job is leased to
+    the builder which must renew the lease until it posts the result. Requires
+    builder authentication, see `authenticate`.
+    """
+    builder, error_response = self.authenticate()
+    if builder is None:
+      return error_response
+
+    with self.dispatch_lock:
+      sql = self.sql_factory()
+      try:
+        job = self.dispatch(sql, builder)
+      finally:
+        sql.close()
+    return flask.jsonify(job)
+
+  def get_lease(self, sql, builder):
+    """
+    Return the lease for the `merge_id` in the current request if it is held
+    by `builder`, or None and an error response otherwise.
+    """
+    try:
+      merge_id = int(flask.request.form['merge_id'])
+    except (KeyError, ValueError):
+      response = flask.jsonify({'status': 'ERROR',
+                                'reason': 'invalid merge_id'})
+      response.status_code = 400
+      return None, response
+
+    lease = (sql.query(orm.JobLease)
+             .filter(orm.JobLease.merge_id == merge_id)
+             .filter(orm.JobLease.builder == builder['name'])
+             .first())
+    if lease is None:
+      response = flask.jsonify({'status': 'ERROR',
+                                'reason': 'No lease on merge {} for {}'
+                                          .format(merge_id, builder['name'])})
+      response.status_code = 409
+      return None, response
+    return lease, None
+
+  def renew_lease(self):
+    """
+    Extend the lease on a merge held by a builder. Requires builder
+    authentication, see `authenticate`.
+
+    Form params:
+      `merge_id` : row id of the leased merge
+    """
+    builder, error_response = self.authenticate()
+    if builder is None:
+      return error_response
+
+    with self.dispatch_lock:
+      sql = self.sql_factory()
+      self.reap_expired_leases(sql)
+      lease, error_response = self.get_lease(sql, builder)
+      if lease is None:
+        sql.close()
+        return error_response
+
+      lease.renew_time = datetime.datetime.utcnow()
+      lease.expire_time = (lease.renew_time
+                           + datetime.timedelta(seconds=self.lease_ttl))
+      sql.commit()
+      result = {'status': 'SUCCESS', 'lease': lease.as_dict()}
+      sql.close()
+    return flask.jsonify(result)
+
+  def post_result(self):
+    """
+    Record the result of a leased merge and release the lease. Requires
+    builder authentication, see `authenticate`.
+
+    Form params:
+      `merge_id` : row id of the leased merge
+      `status` : the result of the merge (see `orm.StatusKey`)
+    """
+    builder, error_response = self.authenticate()
+    if builder is None:
+      return error_response
+
+    try:
+      status = orm.StatusKey(int(flask.request.form['status'])).value
+    except (KeyError, ValueError):
+      response = flask.jsonify({'status': 'ERROR',
+                                'reason': 'invalid status'})
+      response.status_code = 400
       return response
 
-    sql = self.sql_factory()
-    query = (sql
-             .query(sqlalchemy.func.min(orm.ChangeInfo.query_time))
-             .group_by(orm.ChangeInfo.project, orm.ChangeInfo.branch)
-             .order_by(orm.ChangeInfo.query_time.desc()))
-
-    builder_queues = []
-    for ci_sql in query:
-      if (ci_sql.project, ci_sql.branch) in builder_queues:
-        response = flask.jsonify(ci_sql.as_dict())
+    with self.dispatch_lock:
+      sql = self.sql_factory()
+      lease, error_response = self.get_lease(sql, builder)
+      if lease is None:
         sql.close()
-        return response
+        return error_response
+
+      merge = sql.query(orm.MergeStatus).get(lease.merge_id)
+      merge.status = status
+      merge.end_time = datetime.datetime.utcnow()
+
+      queue_spec = self.queue_index.get((lease.project, lease.queue), None)
+      if queue_spec is not None:
+        change_ids = [change.change_id for change
+                      in (sql.query(orm.MergeChange)
+                          .filter(orm.MergeChange.merge_id == merge.rid))]
+        queue_spec.update_dirty_changes(change_ids, status)
+        # As in `daemon.MergeDaemon.merge_next`, a change which
+        # has been verified on its own is no longer dirty, whatever the result
+        if len(change_ids) == 1 and status != orm.StatusKey.PREEMPTED.value:
+          queue_spec.dirty_changes.discard(change_ids[0])
+
+      logging.info('Merge %d finished by %s with status %d', merge.rid,
+                   builder['name'], status)
+      sql.delete(lease)
+      sql.commit()
+      sql.close()
 
-    sql.close()
-    return flask.jsonify({})
+    return flask.jsonify({'status': 'SUCCESS'})
 
 
-def main(mq_config, gerrit, session_factory):  # pylint: disable=unused-argument
+def main(mq_config, gerrit, session_factory):
   app = Master(mq_config, gerrit, session_factory)
-  app.run(**mq_config['webfront.listen'])
+  app.run(**mq_config['master.listen'])
@@ -0,0 +1,147 @@
+"""
+Lightweight in-process metrics. The daemon records gauges and histograms into
+a registry and periodically writes a json snapshot of that registry to disk
+where the webfront can serve it.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+from gerrit_mq import common
+
+# Upper bounds (seconds) of the histogram buckets. The last bucket catches
+# everything else.
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800,
+                   3600, 7200, 14400, 28800, 86400)
+
+# Number of recent samples retained by each histogram for computing
+# percentiles.
+RECENT_SAMPLE_COUNT = 1000
+
+
+def get_label_str(labels):
+  """
+  Return a canonical string representing a set of labels, e.g.
+  'project=foo,queue=master'
+  """
+  return ','.join('{}={}'.format(key, labels[key]) for key in sorted(labels))
+
+
+class Histogram(object):
+  """
+  Accumulates a distribution of observed values
+  """
+
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.bucket_counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = None
+    self.recent = collections.deque(maxlen=RECENT_SAMPLE_COUNT)
+
+  def observe(self, value):
+    idx = 0
+    while idx < len(self.buckets) and value > self.buckets[idx]:
+      idx += 1
+    self.bucket_counts[idx] += 1
+    self.count += 1
+    self.sum += value
+    if self.max is None or value > self.max:
+      self.max = value
+    self.recent.append(value)
+
+  def as_dict(self):
+    recent = list(self.recent)
+    return {
+        'count': self.count,
+        'sum': self.sum,
+        'mean': (self.sum / self.count) if self.count else None,
+        'max': self.max,
+        'p50': common.percentile(recent, 50),
+        'p95': common.percentile(recent, 95),
+        'p99': common.percentile(recent, 99),
+        'buckets': [[bound, count] for bound, count
+                    in zip(self.buckets + ('inf',), self.bucket_counts)],
+    }
+
+
+class Registry(object):
+  """
+  A collection of named gauges and histograms. Each metric name may carry
+  several series distinguished by their labels.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.gauges = {}
+    self.histograms = {}
+
+  def set_gauge(self, name, value, **labels):
+    with self.lock:
+      series = self.gauges.setdefault(name, {})
+      series[get_label_str(labels)] = value
+
+  def observe(self, name, value, **labels):
+    with self.lock:
+      series = self.histograms.setdefault(name, {})
+      label_str = get_label_str(labels)
+      if label_str not in series:
+        series[label_str] = Histogram()
+      series[label_str].observe(value)
+
+  @contextlib.contextmanager
+  def timer(self, name, **labels):
+    """
+    Context manager which observes the wall-time duration of its body into
+    histogram `name`.
+    """
+    start_time = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start_time, **labels)
+
+  def reset(self):
+    with self.lock:
+      self.gauges = {}
+      self.histograms = {}
+
+  def snapshot(self):
+    """
+    Return a json-serializable dictionary of the current state of all metrics
+    """
+    with self.lock:
+      return {
+          'time': time.time(),
+          'gauges': {name: dict(series)
+                     for name, series in self.gauges.iteritems()},
+          'histograms': {name: {label_str: hist.as_dict()
+                                for label_str, hist in series.iteritems()}
+                         for name, series in self.histograms.iteritems()},
+      }
+
+  def write(self, outpath):
+    """
+    Write a snapshot to `outpath`. The file is replaced atomically so that
+    readers never see a partial snapshot.
+    """
+    tmp_path = outpath + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+      json.dump(self.snapshot(), outfile, indent=2, sort_keys=True)
+    os.rename(tmp_path, outpath)
+
+
+# Process-wide default registry
+REGISTRY = Registry()
+
+# pylint: disable=invalid-name
+set_gauge = REGISTRY.set_gauge
+observe = REGISTRY.observe
+timer = REGISTRY.timer
+snapshot = REGISTRY.snapshot
+write = REGISTRY.write
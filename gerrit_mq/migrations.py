@@ -0,0 +1,282 @@
+"""
+Migrations of the merge queue database from one schema version to the next.
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import requests
+from gerrit_mq import orm
+
+
+def migrate_db(gerrit, input_path, from_version, output_path, to_version):
+  """
+  Migrate a database from one schema version to another
+  """
+
+  if from_version == '0.1.0' and to_version == '0.2.0':
+    migrate_db_v0p1p0_to_v0p2p0(gerrit, input_path, output_path)
+  elif from_version == '0.2.0' and to_version == '0.2.1':
+    migrate_db_v0p2p0_to_v0p2p1(input_path, output_path)
+  elif from_version == '0.3.0' and to_version == '0.4.0':
+    migrate_db_v0p3p0_to_v0p4p0(input_path, output_path)
+
+
+# (name, table, columns) of the indexes added to existing tables in 0.4.0
+INDEXES_V0P4P0 = [
+    ('ix_merge_history_project_branch_rid', 'merge_history',
+     'project COLLATE NOCASE, branch COLLATE NOCASE, rid'),
+    ('ix_merge_history_project_branch_end_time', 'merge_history',
+     'project COLLATE NOCASE, branch COLLATE NOCASE, end_time'),
+    ('ix_merge_history_end_time', 'merge_history', 'end_time'),
+    ('ix_merge_history_status_rid', 'merge_history', 'status, rid'),
+    ('ix_merge_changes_merge_id_request_time', 'merge_changes',
+     'merge_id, request_time'),
+    ('ix_merge_changes_change_id_merge_id', 'merge_changes',
+     'change_id, merge_id'),
+    ('ix_step_timings_project_queue_step_status', 'step_timings',
+     'project, queue, step, status'),
+    ('ix_flake_events_project_queue_step', 'flake_events',
+     'project, queue, step'),
+]
+
+# Indexes which are prefixes of the ones above
+DROPPED_INDEXES_V0P4P0 = ['ix_merge_history_project',
+                          'ix_merge_changes_merge_id']
+
+
+def migrate_db_v0p3p0_to_v0p4p0(input_path, output_path):
+  """
+  Add the submission outcome columns to merge_changes, and the composite
+  indexes of 0.4.0 to the history tables. Tables which are new in 0.4.0 are
+  created when the database is first opened.
+  """
+
+  tmp_path = input_path + '.mq_migration'
+
+  if os.path.exists(tmp_path):
+    logging.info('Removing stale temporary %s', tmp_path)
+    os.remove(tmp_path)
+
+  logging.info('Copying %s to %s', input_path, tmp_path)
+  shutil.copyfile(input_path, tmp_path)
+
+  import sqlite3
+  conn = sqlite3.connect(tmp_path)
+  cur = conn.cursor()
+  cur.execute('PRAGMA table_info(merge_changes)')
+  columns = [row[1] for row in cur]
+  for column in ['submit_status', 'submit_message']:
+    if column in columns:
+      logging.info('merge_changes already has column %s', column)
+      continue
+    logging.info('Adding column %s to merge_changes', column)
+    cur.execute('ALTER TABLE merge_changes ADD COLUMN {} VARCHAR'
+                .format(column))
+  cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+  tables = set(row[0] for row in cur)
+  for name, table, columns in INDEXES_V0P4P0:
+    if table not in tables:
+      continue
+    logging.info('Creating index %s on %s (%s)', name, table, columns)
+    cur.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'
+                .format(name, table, columns))
+  for name in DROPPED_INDEXES_V0P4P0:
+    cur.execute('DROP INDEX IF EXISTS {}'.format(name))
+  conn.commit()
+  conn.close()
+
+  try:
+    os.remove(output_path)
+  except OSError:
+    pass
+
+  os.rename(tmp_path, output_path)
+
+
+def migrate_db_v0p2p0_to_v0p2p1(input_path, output_path):
+  """
+  Split merge_history into merge_history and merge_changes.
+  """
+
+  tmp_path = input_path + '.mq_migration'
+
+  if os.path.exists(tmp_path):
+    logging.info('Removing stale temporary %s', tmp_path)
+    os.remove(tmp_path)
+
+  logging.info('Copying %s to %s', input_path, tmp_path)
+  shutil.copyfile(input_path, tmp_path)
+
+  logging.info('Creating merge_changes table')
+  import sqlite3
+  conn = sqlite3.connect(tmp_path)
+  cur = conn.cursor()
+  cur.execute('SELECT name FROM SQLITE_MASTER WHERE type="index"'
+              ' AND tbl_name="merge_history"')
+  indices = [row[0] for row in cur]
+  for index in indices:
+    logging.info('Dropping index %s from merge_history', index)
+    cur.execute('DROP INDEX {}'.format(index))
+  cur.execute('ALTER TABLE merge_history RENAME TO merge_history_v0p2p0')
+  conn.commit()
+  conn.close()
+
+  try:
+    os.remove(output_path)
+  except OSError:
+    pass
+
+  os.rename(tmp_path, output_path)
+
+  logging.info('Migrating rows')
+  sql = orm.init_sql('sqlite:///{}'.format(output_path))()
+
+  prev_migration_query = (sql.query(orm.MergeStatus)
+                          .order_by(orm.MergeStatus.rid.desc())
+                          .limit(1))
+  source_query = sql.query(orm.MergeStatusV0p2p0)
+
+  if prev_migration_query.count() > 0:
+    prev_migration_last = -1
+    for prev_status in prev_migration_query:
+      prev_migration_last = prev_status.rid
+      break
+
+    logging.info('Detected previous migration, will migrate increment'
+                 ' starting at row id %d', prev_migration_last)
+    source_query = source_query.filter(orm.MergeStatusV0p1p0.id >
+                                       prev_migration_last)
+
+  last_print_time = 0
+  query_count = source_query.count()
+  for idx, old_status in enumerate(source_query):
+    kwargs = {key: getattr(old_status, key) for key in
+              ['rid', 'project', 'branch', 'start_time', 'end_time', 'status']}
+    sql.add(orm.MergeStatus(**kwargs))
+
+    kwargs = {key: getattr(old_status, key) for key in
+              ['owner_id', 'change_id', 'request_time', 'msg_meta']}
+    kwargs['merge_id'] = old_status.rid
+    sql.add(orm.MergeChange(**kwargs))
+
+    sql.commit()
+
+    if time.time() - last_print_time > 0.5:
+      last_print_time = time.time()
+      progress = 100.0 * (idx + 1) / query_count
+      sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\r'
+                       .format(idx, query_count, progress))
+      sys.stdout.flush()
+
+  sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\n'
+                   .format(query_count, query_count, 100.0))
+
+  sql.close()
+
+  conn = sqlite3.connect(output_path)
+  cur = conn.cursor()
+  cur.execute('DROP TABLE merge_history_v0p2p0')
+  conn.commit()
+  conn.close()
+
+
+def migrate_db_v0p1p0_to_v0p2p0(gerrit, input_path, output_path):
+  """
+  Migrate a database from one schema version to another
+  """
+  tmp_path = input_path + '.mq_migration'
+
+  if os.path.exists(tmp_path):
+    logging.info('Removing stale temporary %s', tmp_path)
+    os.remove(tmp_path)
+
+  logging.info('Copying %s to %s', input_path, tmp_path)
+  shutil.copyfile(input_path, tmp_path)
+
+  logging.info('Renaming old table')
+  import sqlite3
+  conn = sqlite3.connect(tmp_path)
+  cur = conn.cursor()
+  cur.execute('ALTER TABLE merge_history RENAME TO merge_history_v0p1p0')
+  conn.commit()
+  conn.close()
+
+  logging.info('Migrating rows')
+  source_sql = orm.init_sql('sqlite:///{}'.format(tmp_path))()
+  dest_sql = orm.init_sql('sqlite:///{}'.format(output_path))()
+
+  prev_migration_query = (dest_sql.query(orm.MergeStatus)
+                          .order_by(orm.MergeStatus.rid.desc())
+                          .limit(1))
+
+  source_query = source_sql.query(orm.MergeStatusV0p1p0)
+
+  if prev_migration_query.count() > 0:
+    prev_migration_last = -1
+    for prev_status in prev_migration_query:
+      prev_migration_last = prev_status.rid
+      break
+
+    logging.info('Detected previous migration, will migrate increment'
+                 ' starting at row id %d', prev_migration_last)
+    source_query = source_query.filter(orm.MergeStatusV0p1p0.id >
+                                       prev_migration_last)
+
+  last_print_time = 0
+  query_count = source_query.count()
+  for idx, old_status in enumerate(source_query):
+    if old_status.result == orm.StatusKey.IN_PROGRESS.value:
+      status = orm.StatusKey.CANCELED.value
+    else:
+      status = old_status.result
+
+    changeinfo = None
+    msg_meta = {}
+    max_tries = 10
+    sleep_duration = 2
+
+    for try_idx in range(max_tries):
+      try:
+        if not changeinfo:
+          changeinfo = gerrit.get_change(old_status.change_id)
+        if not msg_meta:
+          msg_meta = gerrit.get_message_meta(old_status.change_id,
+                                             changeinfo.current_revision)
+        break
+      except requests.RequestException:
+        logging.warn('Failed to poll gerrit for change %s %d/%d',
+                     old_status.change_id, try_idx, max_tries)
+        time.sleep(sleep_duration)
+
+    if changeinfo is not None:
+      owner_id = changeinfo.owner.account_id
+    else:
+      owner_id = -1
+    new_status = orm.MergeStatusV0p2p0(rid=old_status.id,
+                                       project='aircam',
+                                       branch=old_status.target_branch,
+                                       owner_id=owner_id,
+                                       change_id=old_status.change_id,
+                                       request_time=old_status.request_time,
+                                       start_time=old_status.start_time,
+                                       end_time=old_status.end_time,
+                                       msg_meta=json.dumps(msg_meta),
+                                       status=status)
+    dest_sql.add(new_status)
+    dest_sql.commit()
+
+    if time.time() - last_print_time > 0.5:
+      last_print_time = time.time()
+      progress = 100.0 * (idx + 1) / query_count
+      sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\r'
+                       .format(idx, query_count, progress))
+      sys.stdout.flush()
+
+  sys.stdout.write('{:6d}/{:6d} [{:6.2f}%]\n'
+                   .format(query_count, query_count, 100.0))
+  os.remove(tmp_path)
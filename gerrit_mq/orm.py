@@ -2,6 +2,7 @@
 
 import enum
 import json
+import os
 
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
@@ -11,7 +12,10 @@ from sqlalchemy import Column
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import DateTime
+from sqlalchemy import Float
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import UniqueConstraint
 
 GERRIT_TIME_SHORT_FMT = '%Y-%m-%d %H:%M:%S'
 
@@ -22,6 +26,8 @@ Base = declarative_base()  # pylint: disable=invalid-name
 
 
 class StatusKey(enum.Enum):
+  ABANDONED = -5
+  PREEMPTED = -4
   TIMEOUT = -3
   CANCELED = -2
   STEP_FAILED = -1
@@ -29,6 +35,16 @@ class StatusKey(enum.Enum):
   IN_PROGRESS = 1
 
 
+class SubmitStatusKey(enum.Enum):
+  """
+  Outcome of submitting one change of a verified merge
+  """
+  MERGED = 'merged'        # gerrit merged the change
+  SUBMITTED = 'submitted'  # gerrit accepted the change for submission
+  REFUSED = 'refused'      # gerrit refused to submit the change
+  SKIPPED = 'skipped'      # not submitted because an earlier change failed
+
+
 class Cancellation(Base):   # pylint: disable=no-init
   """
   Whether or not a merge has been cancedled
@@ -174,13 +190,25 @@ class MergeStatus(Base):  # pylint: disable=no-init
   Data about an attempt to complete a merge.
   """
   __tablename__ = 'merge_history'
-  __table_args__ = {'sqlite_autoincrement': True}
+  # History is read most recent first, filtered by project/branch
+  # or by status. Pages of the history are ordered by end time, see
+  # `functions.get_history`. Project/branch filters are case insensitive
+  # (like SQL `LIKE`) so they are indexed with the NOCASE collation.
+  __table_args__ = (Index('ix_merge_history_project_branch_rid',
+                          sqlalchemy.text('project COLLATE NOCASE'),
+                          sqlalchemy.text('branch COLLATE NOCASE'), 'rid'),
+                    Index('ix_merge_history_project_branch_end_time',
+                          sqlalchemy.text('project COLLATE NOCASE'),
+                          sqlalchemy.text('branch COLLATE NOCASE'), 'end_time'),
+                    Index('ix_merge_history_end_time', 'end_time'),
+                    Index('ix_merge_history_status_rid', 'status', 'rid'),
+                    {'sqlite_autoincrement': True})
 
   # row/record id
   rid = Column(Integer, primary_key=True)
 
   # the name of the project
-  project = Column(String, index=True)
+  project = Column(String)
 
   # the name of the target branch
   branch = Column(String, index=True)
@@ -208,13 +236,36 @@ class MergeStatus(Base):  # pylint: disable=no-init
     return result
 
 
+class MergeCount(Base):  # pylint: disable=no-init
+  """
+  Number of merges in the history of each project/branch. Maintained by
+  triggers on `merge_history` (see `install_merge_count_triggers`) so that
+  the size of the history can be reported without a `count()` over it.
+  """
+  __tablename__ = 'merge_counts'
+
+  project = Column(String, primary_key=True)
+  branch = Column(String, primary_key=True)
+  count = Column(Integer)
+
+  def __repr__(self):
+    return ('<MergeCount(project="{}", branch="{}", count={})>'
+            .format(self.project, self.branch, self.count))
+
+
 class MergeChange(Base):  # pylint: disable=no-init
   """
   Information about one change that was part of one merge attempt
   """
 
   __tablename__ = 'merge_changes'
-  __table_args__ = {'sqlite_autoincrement': True}
+  # Changes are read by merge in request order, and the last
+  # merge of a change is looked up by change id
+  __table_args__ = (Index('ix_merge_changes_merge_id_request_time',
+                          'merge_id', 'request_time'),
+                    Index('ix_merge_changes_change_id_merge_id',
+                          'change_id', 'merge_id'),
+                    {'sqlite_autoincrement': True})
 
   # row/record id
   rid = Column(Integer, primary_key=True)
@@ -240,13 +291,21 @@ class MergeChange(Base):  # pylint: disable=no-init
   # like feature-branch, target-branch, etc.
   msg_meta = Column(String)
 
+  # outcome of submitting the change, see values in the SubmitStatusKey enum.
+  # None if the change was not submitted (the verification failed).
+  submit_status = Column(String)
+
+  # details of the outcome (e.g. why gerrit refused to submit the change)
+  submit_message = Column(String)
+
   def __repr__(self):
     return ('<MergeChange(id="{}", gerrit_id="{}">'
             .format(self.rid, self.change_id))
 
   def as_dict(self):
     result = {key: getattr(self, key) for key
-              in ['rid', 'change_id', 'merge_id', 'owner_id']}
+              in ['rid', 'change_id', 'merge_id', 'owner_id',
+                  'submit_status', 'submit_message']}
 
     for key in ['request_time']:
       result[key] = getattr(self, key).strftime(GERRIT_TIME_SHORT_FMT)
@@ -269,6 +328,217 @@ class MergeChange(Base):  # pylint: disable=no-init
     return result
 
 
+class StepTiming(Base):  # pylint: disable=no-init
+  """
+  Duration of a single build step (or of an entire verification) used to
+  derive time budgets from history.
+  """
+
+  __tablename__ = 'step_timings'
+  __table_args__ = (Index('ix_step_timings_project_queue_step_status',
+                          'project', 'queue', 'step', 'status'),
+                    {'sqlite_autoincrement': True})
+
+  # row/record id
+  rid = Column(Integer, primary_key=True)
+
+  # row/record id of the merge that this step was executed for
+  merge_id = Column(Integer, ForeignKey('merge_history.rid'))
+
+  # the name of the project
+  project = Column(String, index=True)
+
+  # the name of the queue (not the branch, which may be a pattern)
+  queue = Column(String, index=True)
+
+  # the name of the build step
+  step = Column(String)
+
+  # wall-clock duration of the step, in seconds
+  duration = Column(Float)
+
+  # status of the step. See values in the StatusKey enum.
+  status = Column(Integer)
+
+  def __repr__(self):
+    return ('<StepTiming(id="{}", step="{}/{}/{}">'
+            .format(self.rid, self.project, self.queue, self.step))
+
+  def as_dict(self):
+    return {key: getattr(self, key) for key
+            in ['rid', 'merge_id', 'project', 'queue', 'step', 'duration',
+                'status']}
+
+
+class FlakeEvent(Base):  # pylint: disable=no-init
+  """
+  Record of a build step which failed and then passed when it was retried
+  during the same merge.
+  """
+
+  __tablename__ = 'flake_events'
+  __table_args__ = (Index('ix_flake_events_project_queue_step',
+                          'project', 'queue', 'step'),
+                    {'sqlite_autoincrement': True})
+
+  # row/record id
+  rid = Column(Integer, primary_key=True)
+
+  # row/record id of the merge that this step was executed for
+  merge_id = Column(Integer, ForeignKey('merge_history.rid'))
+
+  # the name of the project
+  project = Column(String, index=True)
+
+  # the name of the queue
+  queue = Column(String, index=True)
+
+  # the name of the build step
+  step = Column(String)
+
+  # number of attempts it took for the step to pass
+  attempts = Column(Integer)
+
+  # when the step passed
+  when = Column(DateTime)
+
+  def __repr__(self):
+    return ('<FlakeEvent(id="{}", step="{}/{}/{}">'
+            .format(self.rid, self.project, self.queue, self.step))
+
+  def as_dict(self):
+    result = {key: getattr(self, key) for key
+              in ['rid', 'merge_id', 'project', 'queue', 'step', 'attempts']}
+    result['when'] = self.when.strftime(GERRIT_TIME_SHORT_FMT)
+    return result
+
+
+class JobLease(Base):  # pylint: disable=no-init
+  """
+  A merge which has been dispatched to a builder. The builder must renew the
+  lease before it expires or else the merge is considered abandoned. There is
+  at most one lease for any project/branch at a time.
+  """
+
+  __tablename__ = 'job_leases'
+  __table_args__ = (UniqueConstraint('project', 'branch'),
+                    {'sqlite_autoincrement': True})
+
+  # row/record id
+  rid = Column(Integer, primary_key=True)
+
+  # row/record id of the merge that was dispatched
+  merge_id = Column(Integer, ForeignKey('merge_history.rid'), unique=True)
+
+  # name of the builder holding the lease
+  builder = Column(String, index=True)
+
+  # the project/branch being merged
+  project = Column(String)
+  branch = Column(String)
+
+  # the name of the queue
+  queue = Column(String)
+
+  # when the lease was granted
+  start_time = Column(DateTime)
+
+  # when the builder last renewed the lease
+  renew_time = Column(DateTime)
+
+  # when the lease expires if it isn't renewed
+  expire_time = Column(DateTime, index=True)
+
+  def __repr__(self):
+    return ('<JobLease(merge_id="{}", builder="{}", branch="{}/{}">'
+            .format(self.merge_id, self.builder, self.project, self.branch))
+
+  def as_dict(self):
+    result = {key: getattr(self, key) for key
+              in ['rid', 'merge_id', 'builder', 'project', 'branch', 'queue']}
+    for key in ['start_time', 'renew_time', 'expire_time']:
+      result[key] = getattr(self, key).strftime(GERRIT_TIME_SHORT_FMT)
+    return result
+
+
+class OutboxMessage(Base):  # pylint: disable=no-init
+  """
+  A review (message and label votes) waiting to be posted to a gerrit change
+  by the outbox sender (see `outbox`). Messages to the same change are posted
+  in the order they were created.
+  """
+
+  __tablename__ = 'gerrit_outbox'
+  __table_args__ = {'sqlite_autoincrement': True}
+
+  # row/record id, defines the order in which messages are posted
+  rid = Column(Integer, primary_key=True)
+
+  # the change and revision to post the review to
+  change_id = Column(String, index=True)
+  revision = Column(String)
+
+  # json encoded ReviewInput
+  payload = Column(String)
+
+  # a message with the same key as an existing message is not enqueued again
+  dedup_key = Column(String, unique=True)
+
+  # one of the status values in `outbox`
+  status = Column(String, index=True)
+
+  # number of times posting this message was attempted
+  attempts = Column(Integer)
+
+  # when the message was enqueued, when to try posting it next, and when it
+  # was posted
+  create_time = Column(DateTime)
+  next_attempt_time = Column(DateTime)
+  send_time = Column(DateTime)
+
+  # when posting this message was first attempted. After that the message may
+  # already be on gerrit even if the attempt didn't report success.
+  first_attempt_time = Column(DateTime, nullable=True)
+
+  # the sender which claimed the message for posting it (while `sending`),
+  # and when the claim expires if the sender doesn't record the outcome
+  owner = Column(String, nullable=True)
+  expire_time = Column(DateTime, nullable=True)
+
+  def __repr__(self):
+    return ('<OutboxMessage(id="{}", change_id="{}", status="{}")>'
+            .format(self.rid, self.change_id, self.status))
+
+
+class LeaderLease(Base):  # pylint: disable=no-init
+  """
+  Lease used to elect a single active daemon among several which share the
+  database. The holder must renew the lease before it expires or else another
+  daemon may take it over.
+  """
+
+  __tablename__ = 'leader_leases'
+
+  # name of the election
+  name = Column(String, primary_key=True)
+
+  # identifies the daemon holding the lease (host:pid)
+  holder = Column(String)
+
+  # when the holder last renewed the lease
+  renew_time = Column(DateTime)
+
+  # when the lease expires if it isn't renewed
+  expire_time = Column(DateTime)
+
+  # row/record id of the merge the holder is working on, if any
+  merge_id = Column(Integer, nullable=True)
+
+  def __repr__(self):
+    return ('<LeaderLease(name="{}", holder="{}")>'
+            .format(self.name, self.holder))
+
+
 class AccountInfo(Base):  # pylint: disable=no-init
   """
   Local cache of gerrit AccoutnInfo objects  to reduce the number of gerrit
@@ -432,10 +702,135 @@ class QueueSpec(Base):  # pylint: disable=no-init
     return result
 
 
-def init_sql(database_url):
+# Default settings of sqlite databases, which may be overridden by the
+# `sqlite` dictionary of the config. A pragma whose value is None is left at
+# sqlite's default.
+SQLITE_DEFAULTS = {
+    # Readers don't block the writer (nor the writer the readers)
+    'journal_mode': 'WAL',
+    # In WAL mode, a crash may lose the last commits but can't corrupt
+    'synchronous': 'NORMAL',
+    # Milliseconds to wait for a lock before "database is locked"
+    'busy_timeout': 10000,
+    # Bytes of the database file to access through mmap
+    'mmap_size': 256 * 1024 * 1024,
+    # Page cache size, negative is in KiB
+    'cache_size': -32 * 1024,
+    # Connections kept open by each process. Zero to open a new connection
+    # for each session.
+    'pool_size': 8,
+}
+
+SQLITE_PRAGMAS = ['journal_mode', 'synchronous', 'busy_timeout', 'mmap_size',
+                  'cache_size']
+
+
+def get_sqlite_settings(sqlite=None):
+  """
+  Return `SQLITE_DEFAULTS` updated with the `sqlite` dictionary
+  """
+  settings = dict(SQLITE_DEFAULTS)
+  if sqlite is not None:
+    settings.update(sqlite)
+  return settings
+
+
+def make_sqlite_engine(database_url, settings):
+  """
+  Create an engine for a sqlite database which sets the pragmas in `settings`
+  on each new connection and, unless `pool_size` is zero, keeps a pool of
+  connections which are shared by the threads (but not the processes) of the
+  process which created them.
+  """
+  url = sqlalchemy.engine.url.make_url(database_url)
+  kwargs = {}
+  if url.database in (None, '', ':memory:'):
+    # Each connection to an in-memory database is a different
+    # database, so keep the default (one connection per thread)
+    pass
+  elif settings['pool_size'] > 0:
+    kwargs = dict(poolclass=sqlalchemy.pool.QueuePool,
+                  pool_size=settings['pool_size'], max_overflow=-1,
+                  connect_args={'check_same_thread': False})
+  else:
+    kwargs = dict(poolclass=sqlalchemy.pool.NullPool)
+  engine = sqlalchemy.create_engine(database_url, echo=False, **kwargs)
+
+  def on_connect(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+      if settings[pragma] is not None:
+        cursor.execute('PRAGMA {} = {}'.format(pragma, settings[pragma]))
+    cursor.close()
+
+  def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # pylint: disable=unused-argument
+    # A connection inherited through fork() must not be used by
+    # the child, so drop it and have the pool open a new one.
+    if connection_record.info['pid'] != os.getpid():
+      connection_record.connection = connection_proxy.connection = None
+      raise sqlalchemy.exc.DisconnectionError(
+          'Connection belongs to process {}, not {}'.format(
+              connection_record.info['pid'], os.getpid()))
+
+  sqlalchemy.event.listen(engine, 'connect', on_connect)
+  sqlalchemy.event.listen(engine, 'checkout', on_checkout)
+  return engine
+
+
+MERGE_COUNT_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS merge_counts_insert
+    AFTER INSERT ON merge_history
+    BEGIN
+      INSERT OR IGNORE INTO merge_counts (project, branch, count)
+        VALUES (NEW.project, NEW.branch, 0);
+      UPDATE merge_counts SET count = count + 1
+        WHERE project IS NEW.project AND branch IS NEW.branch;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS merge_counts_delete
+    AFTER DELETE ON merge_history
+    BEGIN
+      UPDATE merge_counts SET count = count - 1
+        WHERE project IS OLD.project AND branch IS OLD.branch;
+    END
+    """]
+
+
+def install_merge_count_triggers(engine):
+  """
+  Create the triggers which maintain `merge_counts`. If the table is empty
+  but the history isn't (i.e. the table is new to an existing database) then
+  it is first filled from the history. Several processes may do this at once,
+  in which case the first one to fill the table wins.
+  """
+  with engine.begin() as conn:
+    history_empty = conn.execute(
+        'SELECT 1 FROM merge_history LIMIT 1').first() is None
+    counts_empty = conn.execute(
+        'SELECT 1 FROM merge_counts LIMIT 1').first() is None
+    if counts_empty and not history_empty:
+      conn.execute('INSERT OR IGNORE INTO merge_counts'
+                   ' (project, branch, count)'
+                   ' SELECT project, branch, COUNT(*) FROM merge_history'
+                   ' GROUP BY project, branch')
+    for statement in MERGE_COUNT_TRIGGERS:
+      conn.execute(statement)
+
+
+def init_sql(database_url, sqlite=None):
   """
   Initialize sqlalchemy and the sqlite database. Returns a session factory.
+  `sqlite` overrides `SQLITE_DEFAULTS` for sqlite databases.
   """
-  engine = sqlalchemy.create_engine(database_url, echo=False)
+  if database_url.startswith('sqlite'):
+    engine = make_sqlite_engine(database_url, get_sqlite_settings(sqlite))
+  else:
+    engine = sqlalchemy.create_engine(database_url, echo=False)
   Base.metadata.create_all(engine)
+  if engine.dialect.name == 'sqlite':
+    install_merge_count_triggers(engine)
   return sqlalchemy.orm.sessionmaker(bind=engine)
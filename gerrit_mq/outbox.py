@@ -0,0 +1,304 @@
+"""
+Persistent outbox for reviews posted to gerrit. The merge path only enqueues
+a review in the database. A background sender posts the reviews concurrently
+(but in order for any one change), retrying failures with backoff, so that a
+slow or flaky gerrit doesn't hold up the build or the next merge.
+
+Several senders may share the outbox (e.g. the workers of a fleet). Each
+message is claimed by one sender before it is posted, and a message whose
+earlier attempt may have reached gerrit is only posted again if gerrit doesn't
+already show it.
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing.pool
+import Queue
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+import requests
+import sqlalchemy
+
+from gerrit_mq import metrics
+from gerrit_mq import orm
+
+# Values of `OutboxMessage.status`
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+# Upper bound (seconds) on the delay between attempts to post a message
+MAX_RETRY_DELAY = 300
+
+# Sent and failed messages are deleted after this long
+RETENTION = datetime.timedelta(days=7)
+
+# Allowance for the clock of gerrit being behind ours when looking for a
+# message that was posted by an earlier attempt
+CLOCK_SKEW = datetime.timedelta(minutes=5)
+
+
+def enqueue_review(sql, change_id, revision, review_dict, dedup_key=None):
+  """
+  Add a review to the outbox. If `dedup_key` is not None and a message with
+  the same key was already enqueued then the review is not enqueued again.
+  """
+  if dedup_key is not None:
+    query = (sql.query(orm.OutboxMessage.rid)
+             .filter(orm.OutboxMessage.dedup_key == dedup_key))
+    if query.first() is not None:
+      logging.info('Review %s is already in the outbox', dedup_key)
+      return
+
+  now = datetime.datetime.utcnow()
+  sql.add(orm.OutboxMessage(change_id=change_id, revision=revision,
+                            payload=json.dumps(review_dict),
+                            dedup_key=dedup_key, status=PENDING, attempts=0,
+                            create_time=now, next_attempt_time=now))
+  sql.commit()
+
+
+def get_pending_change_ids(sql):
+  """
+  Return the set of change ids which have reviews waiting in the outbox
+  """
+  query = (sql.query(orm.OutboxMessage.change_id)
+           .filter(orm.OutboxMessage.status.in_((PENDING, SENDING)))
+           .distinct())
+  return set(row[0] for row in query)
+
+
+def flush(sql, dedup_keys, timeout=60):
+  """
+  Wait up to `timeout` seconds for the reviews with the given `dedup_keys` to
+  be posted (or given up on). Reviews of other merges, e.g. one which keeps
+  failing, are not waited for. Returns true if they were.
+  """
+  query = (sql.query(orm.OutboxMessage.rid)
+           .filter(orm.OutboxMessage.dedup_key.in_(list(dedup_keys)))
+           .filter(orm.OutboxMessage.status.in_((PENDING, SENDING))))
+  start_time = time.time()
+  while query.first() is not None:
+    if time.time() - start_time > timeout:
+      return False
+    time.sleep(0.5)
+  return True
+
+
+class OutboxSender(threading.Thread):
+  """
+  Background thread which posts the reviews in the outbox using a pool of
+  `workers` threads. At most one review per change is in flight at a time.
+  A review which fails is retried with exponential backoff starting at
+  `retry_backoff` seconds, and is given up on after `max_attempts`.
+
+  A sender claims a message for `claim_ttl` seconds while posting it. If the
+  sender dies, another sender takes over the message once the claim expires.
+  `claim_ttl` must be longer than a request to gerrit may take.
+  """
+
+  def __init__(self, gerrit, session_factory, workers=4, max_attempts=8,
+               retry_backoff=5.0, poll_period=1.0, claim_ttl=300):
+    super(OutboxSender, self).__init__(name='gerrit-outbox')
+    self.daemon = True
+    self.gerrit = gerrit
+    self.sql_session = session_factory()
+    self.pool = multiprocessing.pool.ThreadPool(max(workers, 1))
+    self.max_attempts = max_attempts
+    self.retry_backoff = retry_backoff
+    self.poll_period = poll_period
+    self.claim_ttl = datetime.timedelta(seconds=claim_ttl)
+
+    # Identifies this sender in the claims, unique even across a re-exec
+    self.owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(),
+                                   uuid.uuid4().hex[:8])
+
+    # change ids with a review in flight
+    self.in_flight = set()
+    # (rid, change_id, success) of reviews which finished posting
+    self.results = Queue.Queue()
+    self.wake_event = threading.Event()
+    self.stop_event = threading.Event()
+    self.last_prune_time = 0
+
+  def is_posted(self, change_id, review_dict, since):
+    """
+    Return true if gerrit shows the message of `review_dict` on the change,
+    posted after `since`. A review without a message is always posted again,
+    since setting the same votes again is harmless.
+    """
+    message = review_dict.get('message', None)
+    if not message:
+      return False
+    return self.gerrit.has_message(change_id, message, since - CLOCK_SKEW)
+
+  def post(self, rid, change_id, revision, payload, first_attempt_time):
+    """
+    Post one review. If an earlier attempt to post it may have reached gerrit
+    (i.e. `first_attempt_time` is not None) then first check whether gerrit
+    already has it.
+    """
+    success = False
+    try:
+      review_dict = json.loads(payload)
+      if (first_attempt_time is not None
+          and self.is_posted(change_id, review_dict, first_attempt_time)):
+        logging.info('Review %d was already posted to %s', rid, change_id)
+        success = True
+      else:
+        success = self.gerrit.set_review(change_id, revision, review_dict)
+    except (requests.RequestException, ValueError):
+      logging.exception('Failed to check for review %d on %s', rid,
+                        change_id)
+    finally:
+      self.results.put((rid, change_id, success))
+      self.wake_event.set()
+
+  def collect(self):
+    """
+    Record the outcome of reviews which finished posting
+    """
+    now = datetime.datetime.utcnow()
+    while True:
+      try:
+        rid, change_id, success = self.results.get_nowait()
+      except Queue.Empty:
+        break
+
+      self.in_flight.discard(change_id)
+      message = self.sql_session.query(orm.OutboxMessage).get(rid)
+      if message is None:
+        continue
+      if message.status != SENDING or message.owner != self.owner:
+        # Our claim expired and another sender took the message over
+        logging.warn('Lost the claim on review %d to %s', rid, change_id)
+        continue
+      message.owner = None
+      message.expire_time = None
+      message.attempts += 1
+      if success:
+        message.status = SENT
+        message.send_time = now
+      elif message.attempts >= self.max_attempts:
+        logging.error('Giving up on posting review %d to %s after %d attempts',
+                      rid, change_id, message.attempts)
+        message.status = FAILED
+      else:
+        delay = (min(self.retry_backoff * 2 ** (message.attempts - 1),
+                     MAX_RETRY_DELAY) * random.uniform(0.5, 1.5))
+        logging.warn('Failed to post review %d to %s, retrying in %.1f'
+                     ' seconds', rid, change_id, delay)
+        message.status = PENDING
+        message.next_attempt_time = now + datetime.timedelta(seconds=delay)
+    self.sql_session.commit()
+
+  def claim(self, rid, status, now):
+    """
+    Atomically claim message `rid` for this sender if it is still `status`
+    (and, if it is `sending`, the claim of the previous sender has expired).
+    Returns true if this sender now owns the message.
+    """
+    query = (self.sql_session.query(orm.OutboxMessage)
+             .filter(orm.OutboxMessage.rid == rid)
+             .filter(orm.OutboxMessage.status == status))
+    if status == SENDING:
+      query = query.filter(orm.OutboxMessage.expire_time <= now)
+    count = query.update(
+        {'status': SENDING, 'owner': self.owner,
+         'expire_time': now + self.claim_ttl,
+         'first_attempt_time': sqlalchemy.func.coalesce(
+             orm.OutboxMessage.first_attempt_time, now)},
+        synchronize_session=False)
+    self.sql_session.commit()
+    return count == 1
+
+  def dispatch(self):
+    """
+    Start posting the oldest pending review of each change which doesn't
+    already have one in flight, here or at another sender. Messages claimed
+    by a sender which didn't record the outcome before its claim expired are
+    taken over.
+    """
+    now = datetime.datetime.utcnow()
+    query = (self.sql_session.query(orm.OutboxMessage.rid,
+                                    orm.OutboxMessage.change_id,
+                                    orm.OutboxMessage.revision,
+                                    orm.OutboxMessage.payload,
+                                    orm.OutboxMessage.status,
+                                    orm.OutboxMessage.next_attempt_time,
+                                    orm.OutboxMessage.expire_time,
+                                    orm.OutboxMessage.first_attempt_time)
+             .filter(orm.OutboxMessage.status.in_((PENDING, SENDING)))
+             .order_by(orm.OutboxMessage.rid.asc()))
+
+    messages = query.all()
+    blocked = set(self.in_flight)
+    for (rid, change_id, revision, payload, status, next_attempt_time,
+         expire_time, first_attempt_time) in messages:
+      if change_id in blocked:
+        continue
+      # Later messages to this change wait for this one
+      blocked.add(change_id)
+      if status == SENDING and expire_time > now:
+        continue
+      if status == PENDING and next_attempt_time > now:
+        continue
+      if not self.claim(rid, status, now):
+        continue
+      if status == SENDING:
+        logging.warn('Taking over review %d to %s from an expired claim',
+                     rid, change_id)
+      self.in_flight.add(change_id)
+      self.pool.apply_async(self.post, (rid, change_id, revision, payload,
+                                        first_attempt_time))
+    metrics.set_gauge('outbox_depth', len(messages))
+
+  def prune(self):
+    """
+    Delete old messages which were sent or given up on
+    """
+    if time.time() - self.last_prune_time < 3600:
+      return
+    self.last_prune_time = time.time()
+    (self.sql_session.query(orm.OutboxMessage)
+     .filter(orm.OutboxMessage.status.in_((SENT, FAILED)))
+     .filter(orm.OutboxMessage.create_time
+             < datetime.datetime.utcnow() - RETENTION)
+     .delete(synchronize_session=False))
+    self.sql_session.commit()
+
+  def run(self):
+    while not self.stop_event.is_set():
+      try:
+        self.collect()
+        self.dispatch()
+        self.prune()
+      except sqlalchemy.exc.SQLAlchemyError:
+        logging.exception('Failed to process the gerrit outbox')
+        self.sql_session.rollback()
+      self.wake_event.wait(self.poll_period)
+      self.wake_event.clear()
+
+    # Record the outcome of the reviews that were in flight
+    self.pool.close()
+    self.pool.join()
+    try:
+      self.collect()
+    except sqlalchemy.exc.SQLAlchemyError:
+      logging.exception('Failed to process the gerrit outbox')
+      self.sql_session.rollback()
+
+  def stop(self):
+    """
+    Stop dispatching reviews and wait for the ones in flight to finish
+    """
+    self.stop_event.set()
+    self.wake_event.set()
+    self.join()
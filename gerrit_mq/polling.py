@@ -0,0 +1,93 @@
+"""
+Decides how long the daemon waits between polls of gerrit. The interval backs
+off exponentially while the daemon's queues stay empty, tightens right after
+a merge completes or new merge requests show up, and never spends gerrit
+requests faster than the configured budget allows.
+"""
+
+import logging
+
+from gerrit_mq import metrics
+
+
+class PollController(object):
+  """
+  Adaptive poll interval. After each poll the controller is told which
+  changes are queued and how many gerrit requests the poll cost, and it
+  updates `interval`:
+
+    * new changes in the queue (or a merge completed): `min_period`
+    * queue is empty: multiply by `backoff`, up to `max_period`
+    * otherwise: multiply by `backoff`, up to `period`
+
+  If `request_budget` is not None then it is the number of gerrit requests
+  per hour that polling may use, and the interval is never shorter than the
+  time it takes the budget to pay for the previous poll.
+  """
+
+  def __init__(self, period=60, min_period=10, max_period=600, backoff=2.0,
+               request_budget=None):
+    self.period = period
+    self.min_period = min_period
+    self.max_period = max_period
+    self.backoff = backoff
+    self.request_budget = request_budget
+
+    self.interval = period
+    self.last_cost = 0
+    self.known_ids = set()
+
+  def configure(self, config):
+    """
+    Update the controller parameters from the `daemon.*` keys of `config`
+    """
+    self.period = config.get('daemon.poll_period', 60)
+    self.min_period = min(config.get('daemon.poll_period_min', 10),
+                          self.period)
+    self.max_period = max(config.get('daemon.poll_period_max', 600),
+                          self.period)
+    self.backoff = max(config.get('daemon.poll_backoff', 2.0), 1.0)
+    self.request_budget = config.get('daemon.gerrit_request_budget', None)
+    self.interval = min(max(self.interval, self.min_period), self.max_period)
+
+  def get_interval(self):
+    """
+    Return the number of seconds between the start of the previous poll and
+    the start of the next one.
+    """
+    interval = self.interval
+    if self.request_budget:
+      interval = max(interval, 3600.0 * self.last_cost / self.request_budget)
+    return interval
+
+  def set_interval(self, interval):
+    self.interval = interval
+    metrics.set_gauge('poll_interval', self.get_interval())
+
+  def on_merge(self):
+    """
+    Called when a merge finishes. Whatever is queued behind it can start
+    right away, and the merge may have unblocked other changes.
+    """
+    self.set_interval(self.min_period)
+
+  def on_poll(self, change_ids, cost=1):
+    """
+    Called after each poll with the ids of the changes queued for this daemon
+    and the number of gerrit requests that the poll made.
+    """
+    change_ids = set(change_ids)
+    new_ids = change_ids - self.known_ids
+    self.known_ids = change_ids
+    self.last_cost = cost
+
+    if new_ids:
+      if self.interval > self.min_period:
+        logging.info('%d new merge requests, polling every %.1f seconds',
+                     len(new_ids), self.min_period)
+      self.set_interval(self.min_period)
+    elif not change_ids:
+      self.set_interval(min(self.interval * self.backoff, self.max_period))
+    else:
+      self.set_interval(min(self.interval * self.backoff,
+                            max(self.period, self.min_period)))
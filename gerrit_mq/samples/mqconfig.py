@@ -29,6 +29,22 @@ MOVE_FLASHPACK_PATH = (
 # This is the sqlalchemy URL of the sqlite database to use
 db_url = 'sqlite:///' + os.path.join(DATA_ROOT, 'mergedb.sqlite')
 
+# Optional settings of a sqlite database (see orm.SQLITE_DEFAULTS). The
+# daemon writes and the webfront reads the same file, so by default it is
+# opened in WAL mode so that they don't block each other. Pragmas set to None
+# are left at sqlite's defaults.
+sqlite = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # milliseconds to wait for a lock
+    'busy_timeout': 10000,
+    'mmap_size': 256 * 1024 * 1024,
+    # negative is KiB
+    'cache_size': -32 * 1024,
+    # connections kept open by each process, 0 for one per session
+    'pool_size': 8,
+}
+
 # This is the directory where we'll store our log files. This includes logs for
 # ``gerrit-mq`` as well as logs for the merge attempts
 log_path = os.path.join(DATA_ROOT, 'logs')
@@ -57,8 +73,29 @@ gerrit = {
         # Note the use of double quotes b/c bash will chomp the first set when
         # it passes the argument to ssh.
         'password': 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqurstuvwxyz',
+
+        # Number of connections to gerrit kept open (and alive) for reuse.
+        # Each component may override any of these settings in its own
+        # `gerrit_rest` dictionary (see `webfront`).
+        'pool_size': 4,
+
+        # Seconds to wait for a connection to gerrit, and for a response
+        'connect_timeout': 5.0,
+        'read_timeout': 30.0,
+
+        # Failed GET requests (connection errors, timeouts and 5xx responses)
+        # are retried up to this many times with randomized exponential
+        # backoff starting at `retry_backoff` seconds. Other requests are only
+        # retried if the connection could not be established.
+        'max_retries': 3,
+        'retry_backoff': 0.5,
     },
 
+    # Optional url (format string with a `{project}` field) to clone
+    # repositories from, instead of ssh with the parameters below. For
+    # example, the clone url of the fake gerrit used in testing.
+    # 'clone_url': 'file:///tmp/fake-gerrit/git/{project}.git',
+
     # SSH access parameters. There's no option (yet) to override SSH identity
     # so you'll need the identity file in a place that the ssh client will
     # look for it.
@@ -93,6 +130,12 @@ webfront = {
         'port' : 8081,
     },
 
+    # Overrides of `gerrit.rest` for the webfront, which serves requests
+    # from several threads at once.
+    'gerrit_rest' : {
+        'pool_size' : 10,
+    },
+
     # The public base URL used to access this page. This is used to fill in
     # some links on templates as well as to provide gerrit comments that link
     # to the merge status pages.
@@ -120,6 +163,43 @@ queues = [{
         ['make', 'ci-upload'],
     ],
     'submit_with_rest': True,
+
+    # How a verified coalition of changes is submitted over REST. 'serial'
+    # submits the changes one at a time in the order they were merged. 'topic'
+    # sets the topic of all of the changes to the name of the merge branch and
+    # submits them with a single request, which requires
+    # `change.submitWholeTopic` to be enabled on the gerrit server. Note that
+    # this replaces any topic the changes had.
+    'submit_strategy': 'serial',
+
+    # When several queues handled by the same daemon have pending changes,
+    # each queue gets a share of the daemon's merges proportional to its
+    # weight (default 1). This queue gets twice the share of the others.
+    'weight': 2,
+
+    # Time budget for all of the build steps together. If the budget is
+    # exhausted the build is killed (including any processes it spawned) and
+    # the merge is recorded as TIMEOUT so that the queue can move on. A budget
+    # may be an absolute number of seconds, or it may be derived from the
+    # history of successful builds in this queue. This one allows one and a
+    # half times the 95th percentile of the last 100 builds, once there are at
+    # least 10 of them, and two hours until then.
+    'merge_timeout': {
+        'percentile': 95,
+        'factor': 1.5,
+        'min_samples': 10,
+        'fallback': 2 * 60 * 60,
+    },
+
+    # Default time budget for each build step. A step may override this by
+    # being specified as a dictionary, e.g.
+    # {'command': ['make', 'ci-upload'], 'timeout': 600}
+    'step_timeout': None,
+
+    # If true, kill the build as soon as the historical (median) duration of
+    # the remaining steps predicts that it cannot finish within
+    # `merge_timeout`, rather than waiting for the budget to run out.
+    'predictive_kill': True,
 }, {
     # Example of maybe our release candidate. Maybe these branches are longer
     # lived and have fewer commits so we build them in a separate directory.
@@ -132,6 +212,34 @@ queues = [{
     'merge_build_env': False,
     'build_steps': COMMON_BUILDSTEPS,
     'submit_with_rest': True,
+}, {
+    # Example of a queue whose build steps are a graph rather than a sequence.
+    # Each step may list the steps it `depends` on, and independent steps
+    # are executed in parallel (up to `max_parallel_steps` at a time). The
+    # output of each step is written to the logs as a separate section. If any
+    # step fails then any other steps that are running are killed.
+    'project' : 'mainproject',
+    'branch' : r'^docs/.*$',
+    'name' : 'docs',
+    'build_env': COMMON_BUILDENV,
+    'merge_build_env': False,
+    'build_steps': [
+        {'name': 'build', 'command': ['make', 'ci-build']},
+        {'name': 'lint', 'command': ['make', 'ci-lint'], 'depends': ['build']},
+        {'name': 'test', 'command': ['make', 'ci-test'], 'depends': ['build'],
+         'retryable': True},
+        {'name': 'docs', 'command': ['make', 'ci-docs'], 'depends': []},
+    ],
+    'max_parallel_steps': 3,
+
+    # Steps marked `retryable` are executed up to `max_attempts` times before
+    # their failure fails the merge. A step that fails and then passes is
+    # recorded as a flake, see `gerrit-mq get-flaky-steps`.
+    'retry_policy': {
+        'max_attempts': 2,
+        'delay': 30,
+    },
+    'submit_with_rest': True,
 }, {
     # Maybe we also have a manufacturing branch which is similarly long-lived
     # but generally somewhat divergent from the other two.
@@ -177,11 +285,78 @@ daemon = {
     'offline_sentinel_path' : os.path.join(DATA_ROOT, 'pause'),
 
     # The daemon will poll for new changes on gerrit every this many seconds
+    # while there are changes in its queues.
     'poll_period' : 60,
 
+    # Right after a merge completes, or when new merge requests show up, the
+    # daemon polls every `poll_period_min` seconds for a while. While its
+    # queues are empty the period is multiplied by `poll_backoff` after each
+    # poll, up to `poll_period_max` seconds.
+    'poll_period_min' : 10,
+    'poll_period_max' : 600,
+    'poll_backoff' : 2.0,
+
+    # If not None, the number of gerrit requests per hour that polling may
+    # use. The daemon makes one request per poll plus one per queued change.
+    'gerrit_request_budget' : None,
+
+    # Reviews (the "in submission" and result messages and Merge-Queue votes)
+    # are written to an outbox in the database and posted to gerrit in the
+    # background by a pool of `workers` threads, in order for each change.
+    # Failed posts are retried with exponential backoff starting at
+    # `retry_backoff` seconds, up to `max_attempts` times. Changes are not
+    # merged again while they have reviews in the outbox. A review is claimed
+    # for `claim_ttl` seconds while it is posted. If the sender dies, another
+    # sender takes the review over after that, and posts it again only if
+    # gerrit doesn't already show it.
+    'outbox' : {
+        'workers' : 4,
+        'max_attempts' : 8,
+        'retry_backoff' : 5.0,
+        'claim_ttl' : 300,
+    },
+
+    # If not None, a change with a "Priority:" tag lower (more urgent) than
+    # this value preempts a running merge of lower priority changes. The
+    # daemon checks for such changes every `poll_period` seconds during a
+    # build. The preempted build is killed, the urgent change is verified, and
+    # then the preempted changes are verified again (reusing their merged
+    # state if possible). Their Merge-Queue score is not changed.
+    'preempt_priority' : None,
+
+    # Queues are serviced round-robin in proportion to their `weight`. If a
+    # change at the head of a queue has been waiting longer than this many
+    # seconds then that queue is serviced next regardless of its turn, which
+    # bounds how long a low-weight queue can be starved. None disables this.
+    'age_boost' : 4 * 60 * 60,
+
+    # By default the daemon only asks gerrit for changes to the projects of the
+    # queues it serves, so the local cache (and the webfront) only contains
+    # those changes. Set this to true to cache the queue of every project.
+    'query_all_projects' : False,
+
+    # If not None, the daemon periodically writes a json snapshot of its
+    # metrics (queue depths, wait times, merge durations, ...) to this path.
+    # The webfront serves it at /gmq/get_metrics.
+    'metrics_path' : os.path.join(DATA_ROOT, 'metrics.json'),
+
+    # If not None, several daemons configured with the same queues and sharing
+    # the database elect a leader through a lease in the database. Only the
+    # leader verifies merges. It renews its lease every `ttl / 3` seconds and
+    # if it fails to do so for `ttl` seconds (e.g. it crashed) then a standby
+    # takes over, marking the merge that was in progress as ABANDONED. Daemons
+    # participating in the same election must use the same `name` and should
+    # have synchronized clocks.
+    'leader_election' : None,
+    # 'leader_election' : {
+    #     'name' : 'mainproject',
+    #     'ttl' : 15,
+    # },
+
     # The daemon will configure the given directory as a ccache directory of
     # the given size, and export ccache environment variables. This allows a
-    # single ccache directory to be shared across queues.
+    # single ccache directory to be shared across queues. Omit to not use
+    # ccache.
     'ccache' : {
         'path' : os.path.join(DATA_ROOT, '.ccache'),
         'size' : '100G',
@@ -191,9 +366,73 @@ daemon = {
     # multiple startup as well as to help debug.
     'pidfile_path' : os.path.join(DATA_ROOT, 'pid'),
 
+    # The daemon restarts itself when its source files change. Changes are
+    # applied once no files have been written for this many seconds, so that
+    # the daemon doesn't restart in the middle of a deploy.
+    'watch_debounce' : 2.0,
+
     # Unless this is true, gerrit-mq will post comments to gerrit changes to
     # indicate status. For instance it will post a comment when merge
     # verification starts. It will post another comment when verification ends
     # with the result of the verification and a link to the job outputs.
     'silent' : False,
 }
+
+# Instead of a single daemon, merges may be verified by a fleet of builders.
+# In that case `gerrit-mq master` dispatches merges to builders which run
+# `gerrit-mq worker <name>`. Each merge is leased to one builder, and there is
+# only ever one active merge for any project/branch. Note that the master and
+# all of the builders share this configuration, including `db_url` (so that
+# for builders on other hosts this must be a network database) and `log_path`
+# (so that the webfront can serve the build logs).
+master = {
+    # What interface/port to listen on for requests from builders.
+    'listen' : {
+        'host' : '127.0.0.1',
+        'port' : 8082,
+    },
+
+    # A builder must renew its lease on a merge at least this often (seconds).
+    # If it doesn't the merge is recorded as ABANDONED and the changes are
+    # dispatched again.
+    'lease_ttl' : 60,
+
+    # The master polls gerrit for the queue at most this often (seconds)
+    'poll_period' : 60,
+
+    # Like `daemon.query_all_projects`, by default the master only asks gerrit
+    # for changes to the projects that its builders serve.
+    'query_all_projects' : False,
+}
+
+worker = {
+    # Where builders can reach the master
+    'master_url' : 'http://mergequeue:8082',
+
+    # How long a builder waits (seconds) before asking for another job when
+    # there was nothing to do.
+    'poll_period' : 10,
+
+    # A builder waits up to this many seconds for the reviews of a merge to
+    # be posted to gerrit before it reports the result to the master.
+    'outbox_timeout' : 60,
+}
+
+# The builders allowed to lease merges from the master
+builders = [{
+    # Name of the builder, given on the `gerrit-mq worker` command line
+    'name' : 'builder1',
+
+    # Shared secret between the master and this builder
+    'auth_key' : 'change-me',
+
+    # Queues that this builder may build
+    'queues' : [
+        ('mainproject', 'master'),
+        ('mainproject', 'release'),
+    ],
+
+    # Root of this builder's workspace. Defaults to a subdirectory of
+    # `daemon.workspace_path` named after the builder.
+    'workspace_path' : os.path.join(DATA_ROOT, 'builder1'),
+}]
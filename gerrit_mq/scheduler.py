@@ -0,0 +1,197 @@
+"""
+Selects which queue the daemon should service next. Queues are serviced by
+deficit round-robin so that a busy queue cannot starve the other queues
+handled by the same daemon.
+"""
+
+import datetime
+import logging
+
+from gerrit_mq import metrics
+
+
+class RoutingIndex(dict):
+  """
+  Map of project name to the list of queue specs for that project, which
+  memoizes the spec that handles each (project, branch). The same handful of
+  branches show up on every poll so the branch patterns only need to be
+  matched once per branch rather than once per change per loop. The index
+  must not be modified after it is built.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(RoutingIndex, self).__init__(*args, **kwargs)
+    self.memo = {}
+
+  def get_spec(self, project, branch):
+    key = (project, branch)
+    if key in self.memo:
+      return self.memo[key]
+
+    spec = None
+    for candidate in self.get(project, []):
+      if candidate.branch.match(branch):
+        spec = candidate
+        break
+    self.memo[key] = spec
+    return spec
+
+
+def get_matching_spec(queue_specs, cinfo):
+  """
+  Return the spec from `queue_specs` which handles the change `cinfo`, or None
+  if the change isn't handled by any of them.
+  """
+  if isinstance(queue_specs, RoutingIndex):
+    return queue_specs.get_spec(cinfo.project, cinfo.branch)
+
+  for spec in queue_specs.get(cinfo.project, []):
+    if spec.branch.match(cinfo.branch):
+      return spec
+  return None
+
+
+def get_requests_matching(request_queue, project, branch):
+  """
+  Filter request_queue returning a list of only those requests matching the
+  given branch and project
+  """
+
+  return [cinfo for cinfo in request_queue
+          if cinfo.project == project and cinfo.branch == branch]
+
+
+def get_queue_key(queue_spec):
+  return (queue_spec.project, queue_spec.name)
+
+
+def get_wait_time(changeinfo, now):
+  """
+  Return the number of seconds that `changeinfo` has been waiting in the queue
+  """
+  return max((now - changeinfo.queue_time).total_seconds(), 0)
+
+
+def get_priority(changeinfo):
+  return changeinfo.message_meta.get('Priority', 100)
+
+
+def partition_requests(request_queue, queue_specs):
+  """
+  Split the globally sorted `request_queue` into one list per queue spec.
+  Returns a dictionary mapping (project, name) to a (spec, changes) pair.
+  Changes that don't match any spec are dropped. The relative order of
+  changes is preserved.
+  """
+  if not isinstance(queue_specs, RoutingIndex):
+    queue_specs = RoutingIndex(queue_specs)
+
+  partitions = {}
+  for cinfo in request_queue:
+    spec = queue_specs.get_spec(cinfo.project, cinfo.branch)
+    if spec is None:
+      continue
+    key = get_queue_key(spec)
+    if key not in partitions:
+      partitions[key] = (spec, [])
+    partitions[key][1].append(cinfo)
+  return partitions
+
+
+class FairScheduler(object):
+  """
+  Deficit round-robin scheduler across (project, queue name). Each time
+  around the round every backlogged queue earns credit equal to its `weight`
+  and each merge costs one credit, so over time queues are serviced in
+  proportion to their weights.
+
+  Within a queue, changes are serviced in queue order (i.e. by Priority and
+  then request time). Across queues, only the queues whose head change has the
+  most urgent Priority compete for service, so Priority remains a global
+  ordering. If `age_boost` is not None, then any queue whose head change has
+  waited longer than `age_boost` seconds is serviced before the round-robin
+  (oldest first), which bounds the worst-case latency of low-weight queues.
+  """
+
+  def __init__(self, age_boost=None):
+    self.age_boost = age_boost
+    self.deficits = {}
+    self.last_key = None
+
+  def get_round(self, keys):
+    """
+    Return `keys` in round-robin order starting after the last queue serviced
+    """
+    ring = sorted(keys)
+    if self.last_key is None:
+      return ring
+    after = [key for key in ring if key > self.last_key]
+    before = [key for key in ring if key <= self.last_key]
+    return after + before
+
+  def select_round_robin(self, partitions, keys):
+    ring = self.get_round(keys)
+    while True:
+      for key in ring:
+        if self.deficits.get(key, 0.0) >= 1.0:
+          return key
+      for key in ring:
+        spec = partitions[key][0]
+        self.deficits[key] = self.deficits.get(key, 0.0) + spec.weight
+
+  def select(self, request_queue, queue_specs, now=None):
+    """
+    Select the next queue to service. Returns the `queue_spec` and a list of all
+    outstanding changes to the (`project`, `branch`) of the change at the head
+    of that queue. Returns (None, []) if there is nothing to do.
+    """
+    if now is None:
+      now = datetime.datetime.utcnow()
+
+    partitions = partition_requests(request_queue, queue_specs)
+    for spec_list in queue_specs.itervalues():
+      for spec in spec_list:
+        key = get_queue_key(spec)
+        depth = len(partitions[key][1]) if key in partitions else 0
+        metrics.set_gauge('queue_depth', depth, project=spec.project,
+                          queue=spec.name)
+        if key in partitions:
+          metrics.set_gauge('queue_head_wait_seconds',
+                            get_wait_time(partitions[key][1][0], now),
+                            project=spec.project, queue=spec.name)
+        else:
+          metrics.set_gauge('queue_head_wait_seconds', 0,
+                            project=spec.project, queue=spec.name)
+
+    # Idle queues don't bank credit while they are idle, otherwise
+    # they could burst ahead of everyone else when they become backlogged.
+    for key in list(self.deficits):
+      if key not in partitions:
+        del self.deficits[key]
+
+    if not partitions:
+      return None, []
+
+    top_priority = min(get_priority(changes[0])
+                       for _, changes in partitions.itervalues())
+    eligible = [key for key, (_, changes) in partitions.iteritems()
+                if get_priority(changes[0]) == top_priority]
+
+    selected = None
+    if self.age_boost is not None:
+      starved = [key for key in eligible
+                 if get_wait_time(partitions[key][1][0], now) > self.age_boost]
+      if starved:
+        selected = min(starved,
+                       key=lambda key: partitions[key][1][0].queue_time)
+        logging.info('Age boosting queue %s/%s', *selected)
+
+    if selected is None:
+      selected = self.select_round_robin(partitions, eligible)
+      self.deficits[selected] -= 1.0
+    self.last_key = selected
+
+    spec, changes = partitions[selected]
+    head = changes[0]
+    return spec, get_requests_matching(request_queue, head.project,
+                                       head.branch)
@@ -0,0 +1,444 @@
+"""
+Discrete-event simulation of the merge queue, for tuning the batching and
+concurrency policies against historical load. The arrivals, build durations
+and outcomes of past merge requests are read from the merge history and then
+replayed through one or more scheduling policies.
+
+Each project/branch is simulated independently, as if it had a dedicated
+builder (or `concurrency` builders for the speculative policy).
+"""
+
+import collections
+import itertools
+import math
+import multiprocessing
+import random
+
+from gerrit_mq import common
+from gerrit_mq import orm
+
+# Statuses of merges whose duration is representative of a failing build
+FAILED_STATUSES = (orm.StatusKey.STEP_FAILED.value,
+                   orm.StatusKey.TIMEOUT.value)
+
+
+class Lane(object):
+  """
+  The history of one project/branch: `arrivals` is a time-ordered list of
+  (seconds, good) for each merge request, where `good` is true if the request
+  was eventually merged. `pass_durations` and `fail_durations` are the
+  durations (in seconds) of historical builds which passed and failed.
+  """
+
+  def __init__(self, project, branch):
+    self.project = project
+    self.branch = branch
+    self.arrivals = []
+    self.pass_durations = []
+    self.fail_durations = []
+
+
+def load_trace(sql, project_filter=None, branch_filter=None, since=None):
+  """
+  Build a list of `Lane` from the merge history. `project_filter` and
+  `branch_filter` are SQL `LIKE` expressions. If `since` is not None then only
+  requests made after that datetime are included.
+  """
+
+  query = (sql.query(orm.MergeChange.change_id, orm.MergeChange.request_time,
+                     orm.MergeStatus.rid, orm.MergeStatus.project,
+                     orm.MergeStatus.branch, orm.MergeStatus.status,
+                     orm.MergeStatus.start_time, orm.MergeStatus.end_time)
+           .join(orm.MergeStatus,
+                 orm.MergeChange.merge_id == orm.MergeStatus.rid))
+  if project_filter is not None:
+    query = query.filter(orm.MergeStatus.project.like(project_filter))
+  if branch_filter is not None:
+    query = query.filter(orm.MergeStatus.branch.like(branch_filter))
+  if since is not None:
+    query = query.filter(orm.MergeChange.request_time >= since)
+
+  lanes = {}
+  requests = {}
+  seen_merges = set()
+  origin = None
+  for (change_id, request_time, merge_id, project, branch, status,
+       start_time, end_time) in query:
+    if request_time is None:
+      continue
+    key = (project, branch)
+    if key not in lanes:
+      lanes[key] = Lane(project, branch)
+    lane = lanes[key]
+
+    # A request is identified by its request time, the same
+    # change may be requested again after it is fixed.
+    request_key = (key, change_id, request_time)
+    requests[request_key] = (requests.get(request_key, False)
+                             or status == orm.StatusKey.SUCCESS.value)
+    if origin is None or request_time < origin:
+      origin = request_time
+
+    if merge_id in seen_merges or start_time is None or end_time is None:
+      continue
+    seen_merges.add(merge_id)
+    duration = (end_time - start_time).total_seconds()
+    if status == orm.StatusKey.SUCCESS.value:
+      lane.pass_durations.append(duration)
+    elif status in FAILED_STATUSES:
+      lane.fail_durations.append(duration)
+
+  for (key, _, request_time), good in requests.iteritems():
+    lanes[key].arrivals.append(((request_time - origin).total_seconds(),
+                                good))
+
+  # Lanes without enough history of their own borrow that of all lanes
+  all_pass = [duration for lane in lanes.itervalues()
+              for duration in lane.pass_durations]
+  all_fail = [duration for lane in lanes.itervalues()
+              for duration in lane.fail_durations]
+  for lane in lanes.itervalues():
+    lane.arrivals.sort()
+    if not lane.pass_durations:
+      lane.pass_durations = all_pass
+    if not lane.fail_durations:
+      lane.fail_durations = all_fail or lane.pass_durations
+
+  return [lanes[key] for key in sorted(lanes) if lanes[key].pass_durations]
+
+
+class LaneResult(object):
+  """
+  Outcome of simulating a lane: `latencies` lists the time (seconds) from
+  arrival until each request was merged or rejected, and `build_seconds` is
+  the total builder time spent, including builds that were thrown away.
+  """
+
+  def __init__(self):
+    self.latencies = []
+    self.merged = 0
+    self.rejected = 0
+    self.builds = 0
+    self.build_seconds = 0.0
+    self.end_time = 0.0
+
+
+class LaneState(object):
+  """
+  Bookkeeping shared by the policies while simulating one lane
+  """
+
+  def __init__(self, lane, config, rng):
+    self.lane = lane
+    self.arrivals = lane.arrivals
+    self.poll_period = config.get('poll_period', 60)
+    self.rng = rng
+    self.next_arrival = 0
+    self.last_poll = float('-inf')
+    self.result = LaneResult()
+
+  def has_arrivals(self):
+    return self.next_arrival < len(self.arrivals)
+
+  def get_poll_time(self, now, idle):
+    """
+    Return the time at which the daemon next polls gerrit, given that it is
+    free at `now`. If the daemon is `idle` then it keeps polling until there
+    is a request.
+    """
+    when = max(now, self.last_poll + self.poll_period)
+    if idle and self.has_arrivals():
+      arrival_time = self.arrivals[self.next_arrival][0]
+      if arrival_time > when:
+        if self.poll_period > 0:
+          when += (math.ceil((arrival_time - when) / self.poll_period)
+                   * self.poll_period)
+        else:
+          when = arrival_time
+    return when
+
+  def poll(self, when, queue):
+    """
+    Poll gerrit at time `when`, appending the requests seen to `queue`
+    """
+    self.last_poll = when
+    self.receive(when, queue)
+    return when
+
+  def receive(self, now, queue):
+    """
+    Append the requests that have arrived by `now` to `queue`, as indices into
+    `arrivals`.
+    """
+    while (self.has_arrivals()
+           and self.arrivals[self.next_arrival][0] <= now):
+      queue.append(self.next_arrival)
+      self.next_arrival += 1
+
+  def build(self, batch):
+    """
+    Return (passed, duration) for a build of the changes in `batch`
+    """
+    passed = all(self.arrivals[idx][1] for idx in batch)
+    durations = (self.lane.pass_durations if passed
+                 else self.lane.fail_durations)
+    duration = durations[int(self.rng.random() * len(durations))]
+    self.result.builds += 1
+    self.result.build_seconds += duration
+    return passed, duration
+
+  def decide(self, idx, now, merged):
+    self.result.latencies.append(now - self.arrivals[idx][0])
+    if merged:
+      self.result.merged += 1
+    else:
+      self.result.rejected += 1
+    self.result.end_time = max(self.result.end_time, now)
+
+
+def simulate_batches(state, get_batch, on_failure):
+  """
+  Common loop of the policies which run one build at a time. `get_batch`
+  selects the next changes to build from the queue and `on_failure` handles a
+  failed build of more than one change.
+  """
+
+  queue = []
+  now = 0.0
+  skip_poll = False
+  while queue or state.has_arrivals():
+    if not skip_poll:
+      now = state.poll(state.get_poll_time(now, idle=not queue), queue)
+    skip_poll = False
+
+    batch = get_batch(queue)
+    passed, duration = state.build(batch)
+    now += duration
+    if passed or len(batch) == 1:
+      for idx in batch:
+        queue.remove(idx)
+        state.decide(idx, now, passed)
+    else:
+      skip_poll = on_failure(queue, batch)
+  return state.result
+
+
+def simulate_serial(lane, config, rng):
+  """
+  Verify one change at a time
+  """
+  state = LaneState(lane, config, rng)
+  return simulate_batches(state, lambda queue: queue[:1], None)
+
+
+def simulate_coalesced(lane, config, rng):
+  """
+  Verify up to `coalesce_count` changes together. If the coalition fails, its
+  changes are marked dirty and verified one at a time (like the daemon).
+  """
+  state = LaneState(lane, config, rng)
+  coalesce_count = max(config.get('coalesce_count', 1), 1)
+  dirty = set()
+
+  def get_batch(queue):
+    batch = []
+    for idx in queue:
+      if idx in dirty:
+        break
+      batch.append(idx)
+      if len(batch) >= coalesce_count:
+        break
+    if len(batch) > 1:
+      return batch
+    return queue[:1]
+
+  def on_failure(queue, batch):  # pylint: disable=unused-argument
+    dirty.update(batch)
+    # The daemon verifies the head change right away, without
+    # polling gerrit again.
+    return True
+
+  return simulate_batches(state, get_batch, on_failure)
+
+
+def simulate_bisecting(lane, config, rng):
+  """
+  Verify up to `coalesce_count` changes together. If the batch fails, it is
+  split in half and each half is verified until the failing changes are
+  isolated.
+  """
+  state = LaneState(lane, config, rng)
+  coalesce_count = max(config.get('coalesce_count', 1), 1)
+  pending = []
+
+  def get_batch(queue):
+    if pending:
+      return pending.pop()
+    return queue[:coalesce_count]
+
+  def on_failure(queue, batch):  # pylint: disable=unused-argument
+    half = len(batch) // 2
+    pending.append(batch[half:])
+    pending.append(batch[:half])
+    return True
+
+  return simulate_batches(state, get_batch, on_failure)
+
+
+def simulate_speculative(lane, config, rng):
+  """
+  Verify up to `concurrency` changes at once, each one speculatively merged
+  on top of all of the changes ahead of it. When a change fails, the builds of
+  the changes behind it are restarted without it.
+  """
+  state = LaneState(lane, config, rng)
+  result = state.result
+  concurrency = max(config.get('concurrency', 1), 1)
+
+  queue = []
+  # each item is [idx, start_time, end_time, passed] in queue order
+  pipeline = []
+  now = 0.0
+
+  def fill(now):
+    while len(pipeline) < concurrency and len(queue) > len(pipeline):
+      idx = queue[len(pipeline)]
+      ahead = [item[0] for item in pipeline]
+      passed, duration = state.build(ahead + [idx])
+      pipeline.append([idx, now, now + duration, passed])
+
+  while queue or state.has_arrivals():
+    if not queue:
+      now = state.poll(state.get_poll_time(now, idle=True), queue)
+    fill(now)
+
+    # Start more builds at each poll until the head build finishes
+    while len(pipeline) < concurrency and state.has_arrivals():
+      when = state.get_poll_time(now, idle=True)
+      if when >= pipeline[0][2]:
+        break
+      now = state.poll(when, queue)
+      fill(now)
+
+    idx, _, end_time, passed = pipeline.pop(0)
+    queue.remove(idx)
+    now = max(now, end_time)
+    state.decide(idx, now, passed)
+    if not passed:
+      # The builds behind the failed change included it, so they are thrown
+      # away (and the remainder of their time is not spent).
+      for item in pipeline:
+        result.build_seconds -= max(item[2] - now, 0)
+      del pipeline[:]
+
+  return result
+
+
+POLICIES = collections.OrderedDict([
+    ('serial', simulate_serial),
+    ('coalesced', simulate_coalesced),
+    ('bisecting', simulate_bisecting),
+    ('speculative', simulate_speculative),
+])
+
+# Parameters of the config which affect each policy
+POLICY_PARAMS = {
+    'serial': ('poll_period',),
+    'coalesced': ('coalesce_count', 'poll_period'),
+    'bisecting': ('coalesce_count', 'poll_period'),
+    'speculative': ('concurrency', 'poll_period'),
+}
+
+
+def simulate(lanes, config, seed=0):
+  """
+  Simulate all `lanes` under `config`, a dictionary with the `policy` and its
+  parameters. Returns a json serializable dictionary of summary statistics.
+  """
+
+  policy = POLICIES[config['policy']]
+  rng = random.Random(seed)
+
+  latencies = []
+  out = dict(config)
+  out.update({'changes': 0, 'merged': 0, 'rejected': 0, 'builds': 0,
+              'build_hours': 0.0})
+  start_time = None
+  end_time = 0.0
+  for lane in lanes:
+    if not lane.arrivals:
+      continue
+    result = policy(lane, config, rng)
+    latencies.extend(result.latencies)
+    out['changes'] += len(lane.arrivals)
+    out['merged'] += result.merged
+    out['rejected'] += result.rejected
+    out['builds'] += result.builds
+    out['build_hours'] += result.build_seconds / 3600.0
+    lane_start = lane.arrivals[0][0]
+    if start_time is None or lane_start < start_time:
+      start_time = lane_start
+    end_time = max(end_time, result.end_time)
+
+  span_hours = (end_time - (start_time or 0.0)) / 3600.0
+  out['throughput_per_hour'] = (out['merged'] / span_hours
+                                if span_hours > 0 else None)
+  out['latency_p50'] = common.percentile(latencies, 50)
+  out['latency_p95'] = common.percentile(latencies, 95)
+  out['latency_max'] = max(latencies) if latencies else None
+  return out
+
+
+def get_configs(policies, coalesce_counts, concurrencies, poll_periods):
+  """
+  Return the list of distinct configs in the cartesian product of the given
+  parameter values. Parameters that don't affect a policy are dropped.
+  """
+
+  configs = []
+  seen = set()
+  for policy, coalesce_count, concurrency, poll_period in itertools.product(
+      policies, coalesce_counts, concurrencies, poll_periods):
+    params = {'coalesce_count': coalesce_count, 'concurrency': concurrency,
+              'poll_period': poll_period}
+    config = {'policy': policy}
+    for key in POLICY_PARAMS[policy]:
+      config[key] = params[key]
+    key = tuple(sorted(config.items()))
+    if key not in seen:
+      seen.add(key)
+      configs.append(config)
+  return configs
+
+
+# The trace used by pool workers, sent once when each worker starts
+_POOL_LANES = None
+
+
+def _init_pool(lanes):
+  global _POOL_LANES  # pylint: disable=global-statement
+  _POOL_LANES = lanes
+
+
+def _simulate_pool(args):
+  config, seed = args
+  return simulate(_POOL_LANES, config, seed)
+
+
+def sweep(lanes, configs, seed=0, jobs=1):
+  """
+  Simulate `lanes` under each of `configs`, using `jobs` processes. Every
+  config is simulated with the same random `seed` so that the results are
+  comparable.
+  """
+
+  if jobs <= 1:
+    return [simulate(lanes, config, seed) for config in configs]
+
+  pool = multiprocessing.Pool(jobs, initializer=_init_pool, initargs=(lanes,))
+  try:
+    return pool.map(_simulate_pool, [(config, seed) for config in configs],
+                    chunksize=max(len(configs) // (4 * jobs), 1))
+  finally:
+    pool.close()
+    pool.join()
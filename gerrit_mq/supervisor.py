@@ -0,0 +1,321 @@
+"""
+Executes the build steps of a merge in a process which is detached from the
+daemon, so that the build survives a restart (re-exec) of the daemon. The
+supervisor reports progress through a json state file which the daemon polls,
+and which a restarted daemon uses to reattach to the build.
+"""
+
+import errno
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Values of `status` in the state file
+STARTING = 'starting'
+RUNNING = 'running'
+FINISHED = 'finished'
+
+# Values of `result` in the state file once finished
+SUCCESS = 'success'
+FAILED = 'failed'
+KILLED = 'killed'
+
+
+def get_state_path(log_path, merge_id):
+  return '{}/{:06d}.state'.format(log_path, merge_id)
+
+
+def get_log_path(state_path):
+  return os.path.splitext(state_path)[0] + '.supervisor.log'
+
+
+def read_state(state_path):
+  """
+  Return the state dictionary from `state_path` or None if it does not exist.
+  """
+  try:
+    with open(state_path, 'r') as infile:
+      return json.load(infile)
+  except (IOError, OSError):
+    return None
+
+
+def write_state(state_path, state):
+  """
+  Replace the state file atomically, so that the reader never sees a partial
+  write.
+  """
+  state['update_time'] = time.time()
+  tmp_path = state_path + '.tmp'
+  with open(tmp_path, 'w') as outfile:
+    json.dump(state, outfile, indent=2, sort_keys=True)
+  os.rename(tmp_path, state_path)
+
+
+def get_process_stamp(pid):
+  """
+  Return a string which identifies process `pid` across pid reuse and host
+  reboots: the boot id of the host and the start time of the process (field 22
+  of /proc/<pid>/stat). Returns None if this is not available.
+  """
+  try:
+    with open('/proc/sys/kernel/random/boot_id', 'r') as infile:
+      boot_id = infile.read().strip()
+    with open('/proc/{:d}/stat'.format(pid), 'r') as infile:
+      stat = infile.read()
+  except (IOError, OSError):
+    return None
+
+  # The command name (field 2) is in parentheses and may contain spaces, so
+  # count fields from the end of it. The first field after it is field 3.
+  fields = stat[stat.rindex(')') + 1:].split()
+  return '{}:{}'.format(boot_id, fields[22 - 3])
+
+
+def is_alive(pid, stamp=None):
+  """
+  Return true if process `pid` exists. If `stamp` (see `get_process_stamp`)
+  is given then `pid` must also still be the same process, and not some
+  unrelated process which was later given the same pid.
+  """
+  try:
+    os.kill(pid, 0)
+  except OSError as err:
+    if err.errno != errno.EPERM:
+      return False
+  if stamp is None:
+    return True
+  current_stamp = get_process_stamp(pid)
+  return current_stamp is None or current_stamp == stamp
+
+
+def is_resumable(state):
+  """
+  Return true if `state` describes a supervisor that is still running, or one
+  which finished but whose result was not yet consumed by the daemon.
+  """
+  if state is None or state['status'] == STARTING:
+    return False
+  if state['status'] == FINISHED:
+    return True
+  return is_alive(state['pid'], state.get('pid_stamp'))
+
+
+class Supervisor(object):
+  """
+  Drives a `daemon.StepRunner` to completion, recording each finished step
+  as an event in the state file.
+  """
+
+  def __init__(self, state_path, job, runner):
+    self.state_path = state_path
+    self.runner = runner
+    self.stop_requested = False
+    self.state = {
+        'pid': os.getpid(),
+        'pid_stamp': get_process_stamp(os.getpid()),
+        'job': job,
+        'start_time': time.time(),
+        'status': RUNNING,
+        'result': None,
+        'failure': None,
+        'events': [],
+        'running': {},
+        'succeeded': [],
+    }
+
+  def handle_sigterm(self, signum, frame):  # pylint: disable=unused-argument
+    self.stop_requested = True
+
+  def finish(self, result):
+    self.state['status'] = FINISHED
+    self.state['result'] = result
+    self.state['running'] = {}
+    self.state['succeeded'] = sorted(self.runner.succeeded)
+    write_state(self.state_path, self.state)
+
+  def run(self):
+    runner = self.runner
+    while True:
+      for running, duration in runner.poll_finished():
+        step_name = running.step.name
+        event = {'step': step_name, 'stepno': running.step_idx,
+                 'command': running.step.get_command_str(),
+                 'duration': duration, 'returncode': running.proc.returncode,
+                 'attempts': runner.attempts[step_name], 'retried': False}
+        self.state['events'].append(event)
+        if running.proc.returncode == 0:
+          continue
+        if runner.retry_step(running):
+          event['retried'] = True
+          continue
+
+        # The first failure cancels any sibling steps
+        runner.kill_all()
+        self.state['failure'] = {
+            'stepno': running.step_idx,
+            'retcode': running.proc.returncode,
+            'command': running.step.get_command_str()}
+        return self.finish(FAILED)
+
+      if runner.is_complete():
+        return self.finish(SUCCESS)
+
+      if self.stop_requested:
+        runner.kill_all()
+        return self.finish(KILLED)
+
+      runner.start_ready_steps()
+      self.state['running'] = {
+          name: {'stepno': running.step_idx,
+                 'command': running.step.get_command_str(),
+                 'start_time': running.start_time,
+                 'pid': running.proc.pid,
+                 'pid_stamp': running.pid_stamp}
+          for name, running in runner.running.items()}
+      self.state['succeeded'] = sorted(runner.succeeded)
+      write_state(self.state_path, self.state)
+      time.sleep(1)
+
+
+def launch(state_path, job, runner_spec, timeout=30):
+  """
+  Start a detached supervisor process executing the build steps described by
+  `runner_spec` (see `daemon.get_runner_spec`), and return its initial state.
+  `job` is stored in the state file so that a restarted daemon knows what it
+  was working on.
+
+  The supervisor is a fresh python interpreter (see `main`) rather than a fork
+  of the daemon, because the daemon is multi-threaded and a forked child may
+  inherit locks (e.g. those of the logging module) held by other threads.
+  """
+
+  if os.path.exists(state_path):
+    os.remove(state_path)
+  write_state(state_path, {'status': STARTING, 'job': job,
+                           'runner': runner_spec})
+
+  # The supervisor must be able to import this package even if the daemon was
+  # started from a zip or the source tree rather than an installed package.
+  env = dict(os.environ)
+  package_parent = os.path.dirname(
+      os.path.dirname(os.path.abspath(__file__)))
+  env['PYTHONPATH'] = os.pathsep.join(
+      [package_parent] + [path for path
+                          in env.get('PYTHONPATH', '').split(os.pathsep)
+                          if path])
+
+  with open(os.devnull, 'r') as devnull:
+    with open(get_log_path(state_path), 'a') as logfile:
+      proc = subprocess.Popen(
+          [sys.executable, '-m', 'gerrit_mq.supervisor', state_path],
+          stdin=devnull, stdout=logfile, stderr=logfile, close_fds=True,
+          env=env)
+  # Returns as soon as the supervisor has detached itself
+  proc.wait()
+
+  # The supervisor writes its state before it starts the first step
+  start_time = time.time()
+  while time.time() - start_time < timeout:
+    state = read_state(state_path)
+    if state is not None and state['status'] != STARTING:
+      return state
+    time.sleep(0.1)
+  raise RuntimeError('Build supervisor failed to start')
+
+
+def kill_steps(state):
+  """
+  Kill the process group of each build step which is running in `state`. Each
+  step is started in its own session (see `daemon.StepRunner`) so they are not
+  killed along with the supervisor.
+  """
+  for name, running in state.get('running', {}).items():
+    pid = running.get('pid')
+    if pid is None or not is_alive(pid, running.get('pid_stamp')):
+      continue
+    logging.warn('Killing build step %s (%d)', name, pid)
+    try:
+      os.killpg(pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+
+def stop(state_path, timeout=60):
+  """
+  Ask the supervisor to kill its build steps and wait for it to finish. If it
+  does not finish within `timeout` then kill it and its build steps. Returns
+  the final state, or None if the supervisor is gone.
+  """
+  state = read_state(state_path)
+  if state is None or state['status'] in (STARTING, FINISHED):
+    return state
+
+  pid = state['pid']
+  stamp = state.get('pid_stamp')
+  if is_alive(pid, stamp):
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError:
+      pass
+
+  start_time = time.time()
+  while is_alive(pid, stamp):
+    if time.time() - start_time > timeout:
+      logging.warn('Supervisor %d did not exit, killing it', pid)
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        pass
+      break
+    latest_state = read_state(state_path)
+    if latest_state is None or latest_state['status'] == FINISHED:
+      return latest_state
+    state = latest_state
+    time.sleep(0.5)
+
+  # The supervisor died without cleaning up after itself, so the steps that it
+  # last reported as running may still be alive.
+  kill_steps(state)
+  return state
+
+
+def main(state_path):
+  """
+  Entry point of the supervisor process started by `launch`. The job and the
+  build steps to execute are read from the (initial) state file.
+  """
+  request = read_state(state_path)
+
+  # Start a new session and fork once more so that the supervisor is
+  # re-parented to init, and is not affected by the daemon re-exec'ing or
+  # exiting. The daemon reaps the parent.
+  os.setsid()
+  if os.fork() != 0:
+    os._exit(0)  # pylint: disable=protected-access
+
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)-8s %(message)s',
+                      datefmt='%Y-%m-%d %H:%M:%S')
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+  # The daemon module imports this one, so import it late
+  from gerrit_mq import daemon
+  supervisor = Supervisor(state_path, request['job'],
+                          daemon.make_step_runner(request['runner']))
+  signal.signal(signal.SIGTERM, supervisor.handle_sigterm)
+  try:
+    supervisor.run()
+  except:  # pylint: disable=bare-except
+    logging.exception('Supervisor failed')
+    supervisor.finish(KILLED)
+    return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1]))
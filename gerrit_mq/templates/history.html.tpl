@@ -32,18 +32,10 @@ on_ready(history_page_ready);
 
 </table>
 <ul class="pager">
-  <li><a id="first_page_anchor" href="?page=0">first</a></li>
-  <li><a id="prev_page_anchor" href="?page=0">prev</a></li>
-  <li>
-    <form action="" class="form-inline">
-      <input class="form-control" id="page_input" size="6" type="text"
-             value="0" name="page"/>
-      <input class="form-control" id="page_size_input" type="hidden"
-             value="25" name="page_size" />
-      <input class="form-control" type="submit" name="submit" value="goto"/>
-    </form>
-  </li>
-  <li><a id="next_page_anchor" href="?page=0">next</a></li>
-  <li><a id="last_page_anchor" href="?page=0">last</a></li>
+  <li><a id="first_page_anchor" href="?">first</a></li>
+  <li><a id="prev_page_anchor" href="?">prev</a></li>
+  <li><span id="history_count"></span></li>
+  <li><a id="next_page_anchor" href="?">next</a></li>
+  <li><a id="last_page_anchor" href="?">last</a></li>
 </ul>
 {% endblock %}
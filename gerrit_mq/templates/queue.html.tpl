@@ -8,6 +8,7 @@
   <td>{{branch}}</td>
   <td>{{owner.name}}</td>
   <td> <a href="{{gerrit_url}}/#/q/{{change_id}}">{{change_id}}</a></td>
+  <td>{{eta_str}}</td>
 </script>
 {% endraw %}
 
@@ -38,6 +39,7 @@ on_ready(queue_page_ready);
       <th>Target Branch</th>
       <th>Owner</th>
       <th>Change ID</th>
+      <th>ETA</th>
     </tr>
   </thead>
   <tbody id='history_table'>
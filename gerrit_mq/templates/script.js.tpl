@@ -46,6 +46,10 @@ function get_query_as_object() {
     query_obj.merge_id = -1;
   }
 
+  if(!("cursor" in query_obj)) {
+    query_obj.cursor = "";
+  }
+
   if("follow_stream" in query_obj) {
     query_obj.follow_stream = (query_obj.follow_stream == "true");
   } else {
@@ -342,6 +346,8 @@ function parse_datetime(date_str) {
 }
 
 var kStatusMap = {
+  "-5" : "ABANDONED",
+  "-4" : "PREEMPTED",
   "-3" : "TIMEOUT",
   "-2" : "CANCELED",
   "-1" : "STEP FAILED",
@@ -514,10 +520,39 @@ function update_build_duration(start_time, cell) {
 }
 
 
+// Return the URL of the history page starting at `cursor`, or null if
+// there is no such page.
+function get_history_url(cursor, page_size) {
+  if(cursor === null) {
+    return null;
+  }
+  return "?cursor=" + encodeURIComponent(cursor) + "&page_size=" + page_size;
+}
+
+// Set history pager link URLs from the cursors returned by the webfront.
+// Pages without a cursor link back to the current page.
+function set_history_pagination(data, page_size) {
+  var anchors = {
+    first_page_anchor : get_history_url("", page_size),
+    prev_page_anchor : get_history_url(data.prev_cursor, page_size),
+    next_page_anchor : get_history_url(data.next_cursor, page_size),
+    last_page_anchor : get_history_url(data.last_cursor, page_size),
+  };
+
+  for(var anchor_id in anchors) {
+    if(anchors[anchor_id] !== null) {
+      document.getElementById(anchor_id).href = anchors[anchor_id];
+    } else {
+      document.getElementById(anchor_id).href = location.search;
+    }
+  }
+  document.getElementById("history_count").innerHTML =
+    "~" + data.count + " merges";
+}
+
 // Callback for when history page data is received from webfront
 function render_history(query_obj, data, page_context) {
-  var num_pages = Math.ceil(data.count / query_obj.page_size);
-  set_pagination(query_obj.page, num_pages, query_obj.page_size);
+  set_history_pagination(data, query_obj.page_size);
 
   var head_template = document.getElementById("history_head_tpl").innerHTML;
   var tail_template = document.getElementById("history_tail_tpl").innerHTML;
@@ -552,7 +587,7 @@ function render_history(query_obj, data, page_context) {
     new_row.innerHTML = Mustache.to_html(head_template, args);
     new_row.className = row_class;
 
-    if(query_obj.page == 0 && idx == 0 && merge.status == 1) {
+    if(query_obj.cursor == "" && idx == 0 && merge.status == 1) {
       var start_time = parse_datetime(merge.start_time) / 1000;
       var duration_cell = new_row.cells[new_row.cells.length-1];
       duration_cell.innerHTML = "";
@@ -585,8 +620,8 @@ function fetch_and_render_history(query_obj, page_context) {
     }
   };
 
-  var row_offset = query_obj.page * query_obj.page_size;
-  xhttp.open("GET", "/gmq/get_history?offset=" + row_offset
+  xhttp.open("GET", "/gmq/get_history?cursor="
+                    + encodeURIComponent(query_obj.cursor)
                     + "&limit=" + query_obj.page_size);
   xhttp.setRequestHeader("Accept", "application/json");
   xhttp.send();
@@ -647,7 +682,6 @@ function update_durations(page_context) {
 // Called when the history page is ready
 function history_page_ready() {
   var query_obj = get_query_as_object();
-  set_pagination(query_obj.page, null, query_obj.page_size);
 
   var page_context = {
     current_merge : null,
@@ -704,6 +738,13 @@ function render_queue(query_obj, data) {
     } else {
       change_info.feature_branch = "null";
     }
+    if (change_info.eta_finish) {
+      var eta = parse_datetime(change_info.eta_finish) / 1000;
+      change_info.eta_str =
+          format_duration(Math.max(eta - Date.now() / 1000, 0));
+    } else {
+      change_info.eta_str = "?";
+    }
     var new_row = history_table.insertRow(-1);
     change_info.gerrit_url = kGerritURL;
     new_row.innerHTML = Mustache.to_html(template, change_info);
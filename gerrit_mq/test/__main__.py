@@ -19,7 +19,10 @@ import traceback
 from gerrit_mq import common
 from gerrit_mq import functions
 from gerrit_mq.test import automation
+from gerrit_mq.test import benchmark
+from gerrit_mq.test import fake_gerrit
 from gerrit_mq.test import gerrit_docker
+from gerrit_mq.test import query_plans
 
 # TODO(josh): dedup this infrastructure
 def class_to_cmd(name):
@@ -244,6 +247,260 @@ class CreateReviews(Command):
       logging.error('Unrecognized subcommand %s', args.subcommand)
 
 
+class LocalFleet(Command):
+  """
+  Start the master and several builder processes on this host, for testing
+  the distributed builder fleet.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('builders', nargs='*',
+                           help='names of the builders to start. Default is '
+                                'all builders in the config')
+    subparser.add_argument('--no-master', action='store_true',
+                           help="Don't start the master")
+
+  @classmethod
+  def run_args(cls, config, args):
+    if not args.builders:
+      args.builders = [builder['name'] for builder in config['builders']]
+
+    base_cmd = [sys.executable, '-Bm', 'gerrit_mq', '-c', args.config]
+    commands = []
+    if not args.no_master:
+      commands.append(base_cmd + ['master'])
+    for builder_name in args.builders:
+      commands.append(base_cmd + ['worker', builder_name])
+
+    procs = []
+    for cmd in commands:
+      logging.info('Starting %s', ' '.join(cmd))
+      procs.append(subprocess.Popen(cmd))
+
+      # Give the master a moment to start listening
+      if cmd[-1] == 'master':
+        time.sleep(2)
+
+    try:
+      while all(proc.poll() is None for proc in procs):
+        time.sleep(0.5)
+    except KeyboardInterrupt:
+      pass
+
+    for proc in procs:
+      if proc.poll() is None:
+        proc.send_signal(signal.SIGINT)
+
+    for proc in procs:
+      proc.wait()
+      logging.info('%s exited with %d', proc.pid, proc.returncode)
+
+
+class FakeGerrit(Command):
+  """
+  Serve a fake gerrit REST api, backed by local git repositories, with some
+  queued changes. Point gerrit.rest.url and gerrit.clone_url at it.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--root-dir', default=None,
+                           help='where to put the git repositories. Default '
+                                'is a temporary directory')
+    subparser.add_argument('--port', type=int, default=8080,
+                           help='port to listen on')
+    subparser.add_argument('--projects', nargs='+', default=['test_project'],
+                           help='projects to create')
+    subparser.add_argument('--num-changes', type=int, default=10,
+                           help='number of queued changes in each project')
+    subparser.add_argument('--latency', type=float, default=0.0,
+                           help='delay each response by this many seconds')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    root_dir = args.root_dir
+    if root_dir is None:
+      root_dir = tempfile.mkdtemp(prefix='fake-gerrit-')
+
+    gerrit = fake_gerrit.FakeGerrit(root_dir)
+    for project in args.projects:
+      gerrit.add_project(project)
+      for _ in range(args.num_changes):
+        gerrit.create_change(project)
+    gerrit.set_latency(args.latency)
+
+    url = gerrit.start(port=args.port)
+    logging.info('gerrit.rest.url = %s', url)
+    logging.info('gerrit.clone_url = %s', gerrit.get_clone_url())
+    try:
+      while True:
+        time.sleep(1)
+    except KeyboardInterrupt:
+      pass
+    gerrit.stop()
+    if args.root_dir is None:
+      shutil.rmtree(root_dir)
+
+
+class Benchmark(Command):
+  """
+  Measure daemon throughput and per-merge overhead against the fake gerrit,
+  with trivial build steps, for several batch sizes. Results are json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--batch-sizes', type=int, nargs='+',
+                           default=[1, 2, 4, 8],
+                           help='coalesce counts to benchmark')
+    subparser.add_argument('--num-changes', type=int, default=16,
+                           help='number of changes merged in each case')
+    subparser.add_argument('--step', nargs='+', default=['true'],
+                           help='command of the (single) build step, e.g. '
+                                '`sleep 1`')
+    subparser.add_argument('--latency', type=float, default=0.0,
+                           help='delay each gerrit response by this many '
+                                'seconds')
+    subparser.add_argument('--root-dir', default=None,
+                           help='keep the repositories, databases and logs '
+                                'of each case in this directory')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = benchmark.run_benchmark(args.batch_sizes, args.num_changes,
+                                      [args.step], args.latency,
+                                      args.root_dir)
+    benchmark.write_results(results, args.outfile)
+
+
+class LabelBenchmark(Command):
+  """
+  Compare the speed of resolving Merge-Queue label histories with the
+  sort-based reference implementation. Results are json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--num-changes', type=int, default=500,
+                           help='number of label histories')
+    subparser.add_argument('--entries-per-change', type=int, default=20,
+                           help='number of label entries in each history')
+    subparser.add_argument('--repeat', type=int, default=5,
+                           help='report the best of this many runs')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = benchmark.benchmark_label_resolution(
+        args.num_changes, args.entries_per_change, args.repeat)
+    benchmark.write_results(results, args.outfile)
+
+
+class QueueBenchmark(Command):
+  """
+  Time reading the cached queue from the database, compared with the
+  previous as_dict()-based implementation. Results are json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--queue-size', type=int, default=500,
+                           help='number of changes in the queue')
+    subparser.add_argument('--num-owners', type=int, default=50,
+                           help='number of distinct change owners')
+    subparser.add_argument('--repeat', type=int, default=5,
+                           help='report the best of this many runs')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = benchmark.benchmark_get_queue(args.queue_size, args.num_owners,
+                                            args.repeat)
+    benchmark.write_results(results, args.outfile)
+
+
+class HistoryBenchmark(Command):
+  """
+  Time paging through a growing merge history with the changes of each merge,
+  compared with the previous one-query-per-merge implementation. Results are
+  json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--history-sizes', type=int, nargs='+',
+                           default=[1000, 10000, 100000],
+                           help='number of merges in the history')
+    subparser.add_argument('--page-size', type=int, default=500,
+                           help='number of merges per request')
+    subparser.add_argument('--num-requests', type=int, default=20,
+                           help='number of requests at each history size')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = benchmark.benchmark_history(args.history_sizes, args.page_size,
+                                          args.num_requests)
+    benchmark.write_results(results, args.outfile)
+
+
+class ConcurrencyBenchmark(Command):
+  """
+  Time recording merges in one process while threads of another read the
+  history, with the previous and the tuned sqlite settings. Results are json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--duration', type=float, default=10.0,
+                           help='seconds to run each case for')
+    subparser.add_argument('--num-readers', type=int, default=4,
+                           help='number of reader threads')
+    subparser.add_argument('--history-size', type=int, default=10000,
+                           help='number of merges in the history')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = benchmark.benchmark_concurrency(args.duration, args.num_readers,
+                                              args.history_size)
+    benchmark.write_results(results, args.outfile)
+
+
+class QueryPlans(Command):
+  """
+  Run EXPLAIN QUERY PLAN over the queries of the webfront, functions and
+  daemon on a generated database and flag full scans and sorts. Exits
+  non-zero if any are flagged. Results are json.
+  """
+
+  @staticmethod
+  def setup_parser(subparser):
+    subparser.add_argument('--num-merges', type=int, default=2000,
+                           help='number of merges in the generated history')
+    subparser.add_argument('-o', '--outfile', default=None,
+                           help='write json results here instead of stdout')
+
+  @classmethod
+  def run_args(cls, config, args):  # pylint: disable=unused-argument
+    results = query_plans.check_query_plans(args.num_merges)
+    flagged = [result for result in results if result['problems']]
+    for result in flagged:
+      logging.warn('%s\n  plan: %s\n  problems: %s',
+                   query_plans.abbreviate(result['statement']),
+                   '; '.join(result['plan']), ', '.join(result['problems']))
+    logging.info('%d of %d statements flagged', len(flagged), len(results))
+    benchmark.write_results(results, args.outfile)
+    return 1 if flagged else 0
+
+
 def iter_command_classes():
   """
   Return a list of all Command subclasses in this file.
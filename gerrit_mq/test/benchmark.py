@@ -0,0 +1,704 @@
+"""
+Benchmarks of the merge queue.
+
+End-to-end throughput benchmark of the merge daemon. A `MergeDaemon` works
+through a queue of generated changes on the fake gerrit (see `fake_gerrit`)
+with trivial build steps, so what is measured is the orchestration overhead
+of each merge: fetching and merging in git, cleanup, gerrit REST requests,
+database statements and log compression. Each batch size (`coalesce_count`)
+is run as a separate case and the results are written as json so that they
+can be compared across releases.
+
+Micro-benchmark of resolving the Merge-Queue label of a change from its label
+history, comparing `common.resolve_merge_queue_labels` with the sort-based
+reference implementation.
+
+Micro-benchmark of reading the cached merge queue from the database with
+`functions.get_queue`, compared with building each record through
+`as_dict()`.
+
+Regression benchmark of paging through the merge history as the webfront
+does with `functions.get_history`, compared with the one-query-per-merge
+reference implementation, as the history grows.
+
+Benchmark of a writer process recording merges as the daemon does while
+reader threads page through the history as the webfront does, with the
+sqlite settings of `orm.SQLITE_DEFAULTS` and with the settings databases were
+opened with before.
+"""
+
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import sqlalchemy
+
+import gerrit_mq
+from gerrit_mq import common
+from gerrit_mq import daemon
+from gerrit_mq import functions
+from gerrit_mq import metrics
+from gerrit_mq import orm
+from gerrit_mq.test import fake_gerrit
+
+PROJECT = 'benchmark'
+
+# Give up on a case if the queue isn't drained within this many seconds
+CASE_TIMEOUT = 3600
+
+
+class SqlTimer(object):
+  """
+  Counts the statements executed on an engine and the time spent on them
+  """
+
+  def __init__(self, engine):
+    self.count = 0
+    self.seconds = 0.0
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', self.before)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute', self.after)
+
+  def before(self, conn, cursor, statement, parameters, context,
+             executemany):  # pylint: disable=unused-argument,too-many-arguments
+    conn.info.setdefault('query_start_time', []).append(time.time())
+
+  def after(self, conn, cursor, statement, parameters, context,
+            executemany):  # pylint: disable=unused-argument,too-many-arguments
+    self.count += 1
+    self.seconds += time.time() - conn.info['query_start_time'].pop()
+
+
+def make_config(case_dir, gerrit, batch_size, build_steps):
+  """
+  Return the daemon config for one benchmark case
+  """
+  return common.ConfigDict({
+      'db_url': 'sqlite:///{}/db.sqlite'.format(case_dir),
+      'log_path': os.path.join(case_dir, 'logs'),
+      'gerrit': {
+          'rest': {
+              'url': gerrit.url,
+              'username': fake_gerrit.MQ_USERNAME,
+              'password': 'benchmark',
+          },
+          'clone_url': gerrit.get_clone_url(),
+      },
+      'webfront': {
+          'url': 'http://localhost:8081',
+      },
+      'daemon': {
+          'workspace_path': os.path.join(case_dir, 'workspace'),
+          'pidfile_path': os.path.join(case_dir, 'pid'),
+          'queues': [(PROJECT, 'master')],
+          'outbox': {'poll_period': 0.1},
+      },
+      'queues': [{
+          'project': PROJECT,
+          'branch': 'master',
+          'build_env': {'PATH': os.environ.get('PATH', '/usr/bin:/bin')},
+          'build_steps': build_steps,
+          'coalesce_count': batch_size,
+      }],
+  })
+
+
+def summarize_histograms(series_dict):
+  """
+  Sum the count and total of all series of a histogram
+  """
+  count = sum(hist['count'] for hist in series_dict.itervalues())
+  seconds = sum(hist['sum'] for hist in series_dict.itervalues())
+  return {'count': count, 'seconds': seconds}
+
+
+def run_case(root_dir, batch_size, num_changes, build_steps, latency=0.0):
+  """
+  Merge `num_changes` generated changes in batches of `batch_size` and return
+  a dictionary of measurements.
+  """
+  case_dir = os.path.join(root_dir, 'batch_{:03d}'.format(batch_size))
+  os.makedirs(os.path.join(case_dir, 'logs'))
+
+  gerrit = fake_gerrit.FakeGerrit(os.path.join(case_dir, 'gerrit'))
+  gerrit.add_project(PROJECT)
+  for _ in range(num_changes):
+    gerrit.create_change(PROJECT)
+  gerrit.set_latency(latency)
+  gerrit.start()
+
+  config = make_config(case_dir, gerrit, batch_size, build_steps)
+  rest = common.get_gerrit(config, 'daemon')
+  session_factory = orm.init_sql(config['db_url'])
+  sql_timer = SqlTimer(session_factory.kw['bind'])
+  metrics.REGISTRY.reset()
+
+  app = daemon.MergeDaemon(config, rest, session_factory())
+  app.start_outbox()
+
+  statuses = {}
+  start_time = time.time()
+  try:
+    while time.time() - start_time < CASE_TIMEOUT:
+      status = app.merge_next()
+      if status is not None:
+        name = orm.StatusKey(status).name
+        statuses[name] = statuses.get(name, 0) + 1
+        continue
+      if not any(change.status == 'NEW'
+                 for change in gerrit.changes.itervalues()):
+        break
+      # The remaining changes are waiting on the outbox
+      time.sleep(0.1)
+    else:
+      logging.error('Benchmark case %d timed out', batch_size)
+    elapsed = time.time() - start_time
+  finally:
+    app.outbox_sender.stop()
+    gerrit.stop()
+
+  snapshot = metrics.snapshot()
+  histograms = snapshot['histograms']
+  merges = sum(statuses.values())
+  merged = sum(1 for change in gerrit.changes.itervalues()
+               if change.status == 'MERGED')
+
+  phases = {}
+  for label_str, hist in histograms.get('merge_phase_seconds', {}).iteritems():
+    phases[label_str.split('=', 1)[1]] = {
+        'count': hist['count'],
+        'seconds': hist['sum'],
+        'per_merge': hist['sum'] / merges if merges else None,
+    }
+
+  # Everything but the build steps themselves is overhead
+  overhead = None
+  if merges:
+    overhead = (elapsed - phases.get('build', {}).get('seconds', 0.0)) / merges
+
+  return {
+      'batch_size': batch_size,
+      'num_changes': num_changes,
+      'merges': merges,
+      'merged_changes': merged,
+      'statuses': statuses,
+      'elapsed_seconds': elapsed,
+      'seconds_per_merge': elapsed / merges if merges else None,
+      'overhead_seconds_per_merge': overhead,
+      'merges_per_hour': 3600.0 * merges / elapsed if elapsed else None,
+      'changes_per_hour': 3600.0 * merged / elapsed if elapsed else None,
+      'phases': phases,
+      'rest': summarize_histograms(histograms.get('gerrit_request_seconds',
+                                                  {})),
+      'db': {'count': sql_timer.count, 'seconds': sql_timer.seconds},
+      'gerrit_endpoints': gerrit.get_stats(),
+  }
+
+
+def run_benchmark(batch_sizes, num_changes, build_steps, latency=0.0,
+                  root_dir=None):
+  """
+  Run one case for each of `batch_sizes` and return the results as a
+  json-serializable dictionary. Work is done under `root_dir`, or a
+  temporary directory which is removed afterward.
+  """
+  # The daemon commits merges in its workspace, which needs a git
+  # identity on hosts that don't have one configured
+  for key, value in fake_gerrit.GIT_ENV.iteritems():
+    os.environ.setdefault(key, value)
+
+  keep_root = root_dir is not None
+  if root_dir is None:
+    root_dir = tempfile.mkdtemp(prefix='gerrit-mq-benchmark-')
+
+  results = {
+      'version': gerrit_mq.VERSION,
+      'time': datetime.datetime.utcnow().strftime(orm.GERRIT_TIME_SHORT_FMT),
+      'host': socket.gethostname(),
+      'python': platform.python_version(),
+      'build_steps': build_steps,
+      'latency': latency,
+      'cases': [],
+  }
+  try:
+    for batch_size in batch_sizes:
+      logging.info('Benchmarking batch size %d', batch_size)
+      results['cases'].append(run_case(root_dir, batch_size, num_changes,
+                                       build_steps, latency))
+  finally:
+    if not keep_root:
+      shutil.rmtree(root_dir)
+  return results
+
+
+def make_label_history(num_entries, start_time):
+  """
+  Return a random list of Merge-Queue label entries, like the `all` list of
+  the label in a ChangeInfo.
+  """
+  entries = []
+  when = start_time
+  for _ in range(num_entries):
+    when += datetime.timedelta(seconds=random.randint(1, 3600),
+                               microseconds=1000 * random.randint(0, 999))
+    entry = {'_account_id': random.randint(1000000, 1000010),
+             'value': random.choice((-1, 0, 1, 1))}
+    # Gerrit doesn't report the date of a vote reset to 0
+    if entry['value'] != 0:
+      entry['date'] = fake_gerrit.format_time(when)
+    entries.append(entry)
+  random.shuffle(entries)
+  return entries
+
+
+def time_label_resolution(resolve, histories, repeat, before=None):
+  """
+  Return the best time (seconds) over `repeat` runs of `resolve` on each of
+  `histories`. `before` is called before each run.
+  """
+  best = None
+  for _ in range(repeat):
+    if before is not None:
+      before()
+    start_time = time.time()
+    for history in histories:
+      resolve(history)
+    duration = time.time() - start_time
+    if best is None or duration < best:
+      best = duration
+  return best
+
+
+def benchmark_label_resolution(num_changes=500, entries_per_change=20,
+                               repeat=5, seed=0):
+  """
+  Time the resolution of the Merge-Queue label of `num_changes` changes with
+  random label histories, as done on every poll, with the sort-based
+  reference implementation and with `common.resolve_merge_queue_labels`
+  (with an empty and with a populated timestamp cache). Returns a
+  json-serializable dictionary.
+  """
+  random.seed(seed)
+  start_time = datetime.datetime(2017, 1, 1)
+  histories = [make_label_history(entries_per_change, start_time)
+               for _ in range(num_changes)]
+
+  def reference(history):
+    return common.get_resolved_merge_queue_score(
+        common.sort_merge_queue_labels(history))
+
+  for history in histories:
+    expect_time, expect_score = reference(history)
+    got_time, got_score = common.resolve_merge_queue_labels(history)
+    assert got_score == expect_score, history
+    if expect_score == 1:
+      assert got_time == expect_time, history
+
+  timings = {
+      'reference': time_label_resolution(reference, histories, repeat),
+      'cold': time_label_resolution(common.resolve_merge_queue_labels,
+                                    histories, repeat,
+                                    common.GERRIT_TIME_CACHE.clear),
+      'warm': time_label_resolution(common.resolve_merge_queue_labels,
+                                    histories, repeat),
+  }
+
+  num_entries = num_changes * entries_per_change
+  results = {'num_changes': num_changes,
+             'entries_per_change': entries_per_change}
+  for key, seconds in timings.iteritems():
+    results[key] = {
+        'seconds': seconds,
+        'usec_per_entry': 1e6 * seconds / num_entries,
+        'speedup': timings['reference'] / seconds,
+    }
+  return results
+
+
+def fill_queue(sql, queue_size, num_owners):
+  """
+  Cache a queue of `queue_size` changes owned by `num_owners` accounts
+  """
+  for account_id in range(num_owners):
+    sql.merge(orm.AccountInfo(rid=1000000 + account_id,
+                              name='User {}'.format(account_id),
+                              email='user{}@example.com'.format(account_id),
+                              username='user{}'.format(account_id)))
+
+  queue_time = datetime.datetime(2017, 1, 1)
+  for idx in range(queue_size):
+    queue_time += datetime.timedelta(seconds=random.randint(1, 600))
+    meta = {'Closes': [], 'Resolves': [],
+            'Feature-Branch': 'feature_{:06d}'.format(idx)}
+    if idx % 10 == 0:
+      meta['Priority'] = random.randint(0, 99)
+    sql.add(orm.ChangeInfo(
+        project='project{}'.format(idx % 5), branch='master',
+        change_id='I{:040x}'.format(idx), subject='Change {}'.format(idx),
+        current_revision='{:040x}'.format(idx),
+        owner_id=1000000 + random.randint(0, num_owners - 1),
+        message_meta=json.dumps(meta), queue_time=queue_time,
+        queue_score=1, poll_id=1, priority=meta.get('Priority', 100)))
+  sql.commit()
+
+
+def get_queue_reference(sql):
+  """
+  The queue query as it was done before `common.ChangeInfo.from_sql`: the
+  owners are loaded lazily and each row goes through `as_dict()`.
+  """
+  query = (sql.query(orm.ChangeInfo)
+           .order_by(orm.ChangeInfo.poll_id.desc(),
+                     orm.ChangeInfo.priority.asc(),
+                     orm.ChangeInfo.queue_time.asc()))
+  count = query.count()
+  return count, [common.ChangeInfo(**ci_sql.as_dict()) for ci_sql in query]
+
+
+def benchmark_get_queue(queue_size=500, num_owners=50, repeat=5, seed=0):
+  """
+  Time reading a queue of `queue_size` changes from the database and
+  serializing it as the webfront does, with `functions.get_queue` and with
+  `get_queue_reference`. Each run uses a new session so nothing is served from
+  the session's identity map. Returns a json-serializable dictionary.
+  """
+  random.seed(seed)
+  db_dir = tempfile.mkdtemp(prefix='gerrit-mq-benchmark-')
+  session_factory = orm.init_sql('sqlite:///{}/db.sqlite'.format(db_dir))
+  sql_timer = SqlTimer(session_factory.kw['bind'])
+  sql = session_factory()
+  fill_queue(sql, queue_size, num_owners)
+  sql.close()
+
+  def check(get_queue):
+    sql = session_factory()
+    _, queue = get_queue(sql)
+    sql.close()
+    return [changeinfo.as_dict() for changeinfo in queue]
+
+  assert check(get_queue_reference) == check(functions.get_queue)
+
+  results = {'queue_size': queue_size, 'num_owners': num_owners}
+  for key, get_queue in (('reference', get_queue_reference),
+                         ('get_queue', functions.get_queue)):
+    best = None
+    statements = None
+    for _ in range(repeat):
+      sql = session_factory()
+      count_before = sql_timer.count
+      start_time = time.time()
+      _, queue = get_queue(sql)
+      load_time = time.time() - start_time
+      json.dumps([changeinfo.as_dict() for changeinfo in queue])
+      total_time = time.time() - start_time
+      sql.close()
+      statements = sql_timer.count - count_before
+      if best is None or total_time < best['seconds']:
+        best = {'seconds': total_time, 'load_seconds': load_time}
+    best['statements'] = statements
+    results[key] = best
+  results['speedup'] = (results['reference']['seconds']
+                        / results['get_queue']['seconds'])
+  shutil.rmtree(db_dir)
+  return results
+
+
+def fill_history(sql, start, stop, num_owners, changes_per_merge):
+  """
+  Append merges `start` through `stop` to the merge history, each with
+  `changes_per_merge` changes owned by one of `num_owners` accounts
+  """
+  if start == 0:
+    sql.execute(orm.AccountInfo.__table__.insert(), [
+        dict(rid=1000000 + account_id, name='User {}'.format(account_id),
+             email='user{}@example.com'.format(account_id),
+             username='user{}'.format(account_id))
+        for account_id in range(num_owners)])
+
+  start_time = datetime.datetime(2017, 1, 1)
+  merges = []
+  changes = []
+  for rid in range(start + 1, stop + 1):
+    merge_time = start_time + datetime.timedelta(minutes=10 * rid)
+    merges.append(dict(rid=rid, project='project{}'.format(rid % 5),
+                       branch='master', start_time=merge_time,
+                       end_time=merge_time + datetime.timedelta(minutes=5),
+                       status=orm.StatusKey.SUCCESS.value))
+    for idx in range(changes_per_merge):
+      changes.append(dict(
+          merge_id=rid, owner_id=1000000 + random.randint(0, num_owners - 1),
+          change_id='I{:032x}{:08x}'.format(rid, idx),
+          request_time=merge_time - datetime.timedelta(hours=1),
+          feature_branch='feature_{:08d}_{}'.format(rid, idx),
+          msg_meta='{}', submit_status='merged', submit_message=''))
+  sql.execute(orm.MergeStatus.__table__.insert(), merges)
+  sql.execute(orm.MergeChange.__table__.insert(), changes)
+  sql.commit()
+
+
+def get_history_reference(sql, offset, limit):
+  """
+  The webfront history query as it was before `functions.get_history` loaded
+  the changes: one query for the changes of each merge on the page.
+  """
+  query = sql.query(orm.MergeStatus).order_by(orm.MergeStatus.rid.desc())
+  count = query.count()
+  if offset > 0:
+    query = query.offset(offset)
+  if limit > 0:
+    query = query.limit(limit)
+
+  result = []
+  for merge_sql in list(query):
+    merge_json = merge_sql.as_dict()
+    query = (sql.query(orm.MergeChange)
+             .join(orm.MergeChange.owner)
+             .filter(orm.MergeChange.merge_id == merge_sql.rid))
+    merge_json['changes'] = [change_sql.as_dict() for change_sql in query]
+    result.append(merge_json)
+  return dict(count=count, result=result)
+
+
+def percentile(values, fraction):
+  """
+  Return the `fraction` percentile of `values` (nearest rank)
+  """
+  values = sorted(values)
+  return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def benchmark_history(history_sizes=(1000, 10000, 100000), page_size=500,
+                      num_requests=20, num_owners=50, changes_per_merge=2,
+                      seed=0):
+  """
+  Time requests for a page of `page_size` merges, at random offsets, of a
+  merge history which is grown through each of `history_sizes`, with
+  `functions.get_history`, with `functions.get_history_page` (reaching the
+  same page by cursor) and with `get_history_reference`. Each request uses a
+  new session and is serialized to json. Returns a json-serializable
+  dictionary with the latency percentiles and the number of statements per
+  request at each history size.
+  """
+  random.seed(seed)
+  db_dir = tempfile.mkdtemp(prefix='gerrit-mq-benchmark-')
+  session_factory = orm.init_sql('sqlite:///{}/db.sqlite'.format(db_dir))
+  sql_timer = SqlTimer(session_factory.kw['bind'])
+
+  def get_history(sql, offset, limit):
+    return functions.get_history(sql, None, None, offset, limit,
+                                 include_changes=True)
+
+  def get_history_page(sql, offset, limit):
+    # Merges are numbered 1 through history_size, so the page at
+    # `offset` is the one after the merge with rid history_size - offset + 1
+    cursor = ''
+    if offset > 0:
+      cursor = functions.encode_history_cursor('next',
+                                               history_size - offset + 1)
+    return functions.get_history_page(sql, None, None, cursor, limit,
+                                      include_changes=True)
+
+  results = {'page_size': page_size, 'changes_per_merge': changes_per_merge,
+             'num_requests': num_requests, 'sizes': []}
+  history_size = 0
+  for next_size in sorted(history_sizes):
+    sql = session_factory()
+    fill_history(sql, history_size, next_size, num_owners, changes_per_merge)
+    sql.close()
+    history_size = next_size
+
+    offsets = [0] + [random.randint(0, max(history_size - page_size, 0))
+                     for _ in range(num_requests - 1)]
+    size_results = {'history_size': history_size}
+    outputs = {}
+    for key, get_page in (('reference', get_history_reference),
+                          ('get_history', get_history),
+                          ('get_history_page', get_history_page)):
+      latencies = []
+      statements = []
+      outputs[key] = []
+      for offset in offsets:
+        sql = session_factory()
+        count_before = sql_timer.count
+        start_time = time.time()
+        page = get_page(sql, offset, page_size)
+        json.dumps(page)
+        latencies.append(time.time() - start_time)
+        statements.append(sql_timer.count - count_before)
+        sql.close()
+        outputs[key].append(page['result'])
+      size_results[key] = {'p50_seconds': percentile(latencies, 0.5),
+                           'p95_seconds': percentile(latencies, 0.95),
+                           'max_statements': max(statements)}
+    assert outputs['reference'] == outputs['get_history']
+    assert outputs['reference'] == outputs['get_history_page']
+    size_results['p95_speedup'] = (size_results['reference']['p95_seconds']
+                                   / size_results['get_history']['p95_seconds'])
+    logging.info('History of %d merges: p95 %.3fs, by cursor %.3fs'
+                 ' (reference %.3fs)', history_size,
+                 size_results['get_history']['p95_seconds'],
+                 size_results['get_history_page']['p95_seconds'],
+                 size_results['reference']['p95_seconds'])
+    results['sizes'].append(size_results)
+  shutil.rmtree(db_dir)
+  return results
+
+
+# Sqlite settings which reproduce how databases were opened before
+# `orm.SQLITE_DEFAULTS`
+LEGACY_SQLITE = {'journal_mode': 'DELETE', 'synchronous': 'FULL',
+                 'busy_timeout': None, 'mmap_size': None, 'cache_size': None,
+                 'pool_size': 0}
+
+
+def summarize_latencies(latencies, errors, duration):
+  """
+  Return the throughput and latency percentiles of a list of latencies
+  """
+  result = {'count': len(latencies), 'errors': errors,
+            'per_second': len(latencies) / duration}
+  if latencies:
+    result.update(p50_seconds=percentile(latencies, 0.5),
+                  p95_seconds=percentile(latencies, 0.95),
+                  max_seconds=max(latencies))
+  return result
+
+
+def write_merges(database_url, sqlite, duration, results):
+  """
+  Record merges as the daemon does, for `duration` seconds, and put the
+  summary of their latencies into the `results` queue
+  """
+  session_factory = orm.init_sql(database_url, sqlite)
+  latencies = []
+  errors = 0
+  start_time = time.time()
+  while time.time() - start_time < duration:
+    sql = session_factory()
+    merge_start = time.time()
+    try:
+      now = datetime.datetime.utcnow()
+      merge = orm.MergeStatus(project='project0', branch='master',
+                              start_time=now, end_time=now,
+                              status=orm.StatusKey.IN_PROGRESS.value)
+      sql.add(merge)
+      sql.commit()
+      for idx in range(2):
+        sql.add(orm.MergeChange(
+            merge_id=merge.rid, owner_id=1000000,
+            change_id='I{:032x}{:08x}'.format(merge.rid, idx),
+            request_time=now, feature_branch='feature', msg_meta='{}'))
+      sql.commit()
+      merge.status = orm.StatusKey.SUCCESS.value
+      merge.end_time = datetime.datetime.utcnow()
+      sql.commit()
+      latencies.append(time.time() - merge_start)
+    except sqlalchemy.exc.OperationalError:
+      logging.exception('Failed to record merge')
+      sql.rollback()
+      errors += 1
+    finally:
+      sql.close()
+  results.put(summarize_latencies(latencies, errors, duration))
+
+
+def read_history(session_factory, duration, page_size, latencies, errors):
+  """
+  Request the first page of the history and the queue, as the webfront
+  does, for `duration` seconds. Appends the latency of each request to
+  `latencies` and each failure to `errors`.
+  """
+  start_time = time.time()
+  while time.time() - start_time < duration:
+    sql = session_factory()
+    request_start = time.time()
+    try:
+      json.dumps(functions.get_history_page(sql, None, None, '', page_size,
+                                            include_changes=True))
+      json.dumps([changeinfo.as_dict() for changeinfo
+                  in functions.get_queue(sql, limit=page_size)[1]])
+      latencies.append(time.time() - request_start)
+    except sqlalchemy.exc.OperationalError:
+      logging.exception('Failed to read history')
+      errors.append(time.time() - request_start)
+    finally:
+      sql.close()
+
+
+def run_concurrency_case(sqlite, duration, num_readers, history_size,
+                         page_size):
+  """
+  Run a writer process and `num_readers` reader threads on a new database
+  with the given sqlite settings. Returns a json-serializable summary of the
+  writer and reader latencies.
+  """
+  db_dir = tempfile.mkdtemp(prefix='gerrit-mq-benchmark-')
+  database_url = 'sqlite:///{}/db.sqlite'.format(db_dir)
+  session_factory = orm.init_sql(database_url, sqlite)
+  sql = session_factory()
+  fill_history(sql, 0, history_size, num_owners=50, changes_per_merge=2)
+  fill_queue(sql, queue_size=100, num_owners=50)
+  sql.close()
+
+  writer_results = multiprocessing.Queue()
+  writer = multiprocessing.Process(
+      target=write_merges,
+      args=(database_url, sqlite, duration, writer_results))
+  latencies = []
+  errors = []
+  readers = [threading.Thread(target=read_history,
+                              args=(session_factory, duration, page_size,
+                                    latencies, errors))
+             for _ in range(num_readers)]
+  writer.start()
+  for reader in readers:
+    reader.start()
+  for reader in readers:
+    reader.join()
+  result = {'writer': writer_results.get(),
+            'readers': summarize_latencies(latencies, len(errors), duration)}
+  writer.join()
+  session_factory.kw['bind'].dispose()
+  shutil.rmtree(db_dir)
+  return result
+
+
+def benchmark_concurrency(duration=10.0, num_readers=4, history_size=10000,
+                          page_size=25):
+  """
+  Measure the latency of recording merges in one process while
+  `num_readers` threads of another read the history, for `duration` seconds,
+  with the legacy sqlite settings and with `orm.SQLITE_DEFAULTS`. Returns a
+  json-serializable dictionary.
+  """
+  results = {'duration': duration, 'num_readers': num_readers,
+             'history_size': history_size, 'page_size': page_size}
+  for key, sqlite in (('legacy', LEGACY_SQLITE), ('tuned', None)):
+    results[key] = run_concurrency_case(sqlite, duration, num_readers,
+                                        history_size, page_size)
+    logging.info('%s: %.1f merges/s (%d errors), reader p95 %.3fs'
+                 ' (%d errors)', key, results[key]['writer']['per_second'],
+                 results[key]['writer']['errors'],
+                 results[key]['readers'].get('p95_seconds', 0),
+                 results[key]['readers']['errors'])
+  return results
+
+
+def write_results(results, outpath=None):
+  """
+  Write `results` as json to `outpath`, or stdout if it is None
+  """
+  content = json.dumps(results, indent=2, sort_keys=True)
+  if outpath is None:
+    print content
+  else:
+    with open(outpath, 'w') as outfile:
+      outfile.write(content)
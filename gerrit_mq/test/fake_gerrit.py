@@ -0,0 +1,614 @@
+"""
+In-process fake of the subset of the gerrit REST api which `common.GerritRest`
+uses, backed by local bare git repositories. The queue, label histories,
+latency and errors are scripted through the `FakeGerrit` object, so polling,
+merging and webfront benchmarks can run without the docker gerrit (see
+`gerrit_docker`).
+
+Point the daemon at the fake with `gerrit.rest.url` set to `FakeGerrit.url`
+and `gerrit.clone_url` set to `FakeGerrit.get_clone_url()`.
+"""
+
+import BaseHTTPServer
+import collections
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import SocketServer
+import subprocess
+import threading
+import time
+import urllib
+import urlparse
+
+GERRIT_MAGIC_JSON_PREFIX = ")]}'\n"
+
+# Account which the merge queue authenticates as
+MQ_USERNAME = 'mergequeue'
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Fake Gerrit',
+    'GIT_AUTHOR_EMAIL': 'fake-gerrit@example.com',
+    'GIT_COMMITTER_NAME': 'Fake Gerrit',
+    'GIT_COMMITTER_EMAIL': 'fake-gerrit@example.com',
+}
+
+# Matches key:value terms of a gerrit query
+QUERY_TERM = re.compile(r'([a-z_-]+):("[^"]*"|[^\s()]+)')
+
+
+def format_time(when):
+  """
+  Format a timestamp the way gerrit does, with nanoseconds.
+  """
+  return when.strftime('%Y-%m-%d %H:%M:%S.%f') + '000'
+
+
+def parse_query(query):
+  """
+  Parse a gerrit query into a dictionary mapping each key to the list of
+  values it is compared against. This is not a real parser: a change matches
+  the query if, for every key, it matches any of the values of that key.
+  That covers the queries the merge queue makes.
+  """
+  terms = collections.defaultdict(list)
+  for key, value in QUERY_TERM.findall(query):
+    terms[key].append(value.strip('"'))
+  return terms
+
+
+class FakeChange(object):
+  """
+  State of one change on the fake server
+  """
+
+  def __init__(self, number, project, branch, change_id, subject, message,
+               revision, owner_id, feature_branch):
+    self.number = number
+    self.project = project
+    self.branch = branch
+    self.change_id = change_id
+    self.subject = subject
+    self.message = message
+    self.revision = revision
+    self.owner_id = owner_id
+    self.feature_branch = feature_branch
+    self.status = 'NEW'
+    self.topic = None
+    self.updated = datetime.datetime.utcnow()
+
+    # label name -> account id -> (value, date)
+    self.votes = collections.defaultdict(dict)
+
+    # (date, ReviewInput) of the reviews posted to this change, in order
+    self.reviews = []
+
+  def get_id(self):
+    return '{}~{}~{}'.format(urllib.quote(self.project, safe=''),
+                             urllib.quote(self.branch, safe=''),
+                             self.change_id)
+
+  def get_values(self, label):
+    return [value for value, _ in self.votes[label].itervalues()]
+
+  def matches_label(self, expr):
+    """
+    Return true if the change matches a `label:` query term like
+    "merge-queue=+1". Labels are MaxWithBlock: the lowest value blocks.
+    """
+    name, _, value = expr.partition('=')
+    value = int(value)
+    for label in self.votes:
+      if label.lower() != name.lower():
+        continue
+      values = self.get_values(label)
+      if not values or min(values) < 0 < value:
+        return False
+      return value in values
+    return False
+
+  def matches(self, terms):
+    checks = {
+        'status': lambda value: (self.status == value.upper()
+                                 or (value == 'open' and self.status == 'NEW')),
+        'project': lambda value: self.project == value,
+        'branch': lambda value: (re.match(value, self.branch) is not None
+                                 if value.startswith('^')
+                                 else self.branch == value),
+        'change': lambda value: value in (self.change_id, str(self.number)),
+        'topic': lambda value: self.topic == value,
+        'label': self.matches_label,
+    }
+    for key, values in terms.iteritems():
+      if key in checks and not any(checks[key](value) for value in values):
+        return False
+    return True
+
+  def as_json(self, accounts, options):
+    result = {
+        'id': self.get_id(),
+        '_number': self.number,
+        'project': self.project,
+        'branch': self.branch,
+        'change_id': self.change_id,
+        'subject': self.subject,
+        'status': self.status,
+        'updated': format_time(self.updated),
+        'owner': accounts[self.owner_id],
+        'current_revision': self.revision,
+    }
+    if self.topic is not None:
+      result['topic'] = self.topic
+    if 'MESSAGES' in options:
+      result['messages'] = [
+          {'id': '{}_{}'.format(self.number, idx),
+           'date': format_time(date),
+           'message': 'Patch Set 1:\n\n{}'.format(review['message'])}
+          for idx, (date, review) in enumerate(self.reviews)
+          if review.get('message', None)]
+    if 'LABELS' in options or 'DETAILED_LABELS' in options:
+      labels = {}
+      for label, votes in self.votes.iteritems():
+        entries = []
+        for account_id, (value, date) in sorted(votes.iteritems()):
+          entry = {'_account_id': account_id, 'value': value}
+          # Gerrit doesn't report the date of a vote reset to 0
+          if value != 0:
+            entry['date'] = format_time(date)
+          entries.append(entry)
+        labels[label] = {'all': entries}
+      result['labels'] = labels
+    return result
+
+
+class FakeGerritHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  Translates HTTP requests into calls to `FakeGerrit.handle`
+  """
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, fmt, *args):  # pylint: disable=arguments-differ
+    logging.debug('fake gerrit: ' + fmt, *args)
+
+  def handle_request(self, method):
+    length = int(self.headers.get('Content-Length', 0) or 0)
+    body = self.rfile.read(length) if length else ''
+    status, content, headers = self.server.gerrit.handle(
+        method, self.path, self.headers, body)
+
+    if isinstance(content, (dict, list)):
+      payload = GERRIT_MAGIC_JSON_PREFIX + json.dumps(content)
+      content_type = 'application/json; charset=UTF-8'
+    else:
+      payload = content or ''
+      content_type = 'text/plain; charset=UTF-8'
+
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(payload)))
+    for key, value in headers.iteritems():
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    self.handle_request('GET')
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self.handle_request('POST')
+
+  def do_PUT(self):  # pylint: disable=invalid-name
+    self.handle_request('PUT')
+
+  def do_DELETE(self):  # pylint: disable=invalid-name
+    self.handle_request('DELETE')
+
+
+class FakeGerritServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, gerrit):
+    BaseHTTPServer.HTTPServer.__init__(self, address, FakeGerritHandler)
+    self.gerrit = gerrit
+
+
+class FakeGerrit(object):
+  """
+  Fake gerrit server. Projects are bare git repositories under
+  `<root_dir>/git`. If `require_auth` is true then requests without an
+  Authorization header are answered with a digest challenge, like gerrit
+  does (the digest itself is not checked). If `submit_whole_topic` is true
+  then submitting a change submits all open changes with the same topic.
+  """
+
+  def __init__(self, root_dir, require_auth=True, submit_whole_topic=False):
+    self.root_dir = root_dir
+    self.require_auth = require_auth
+    self.submit_whole_topic = submit_whole_topic
+    self.lock = threading.RLock()
+    # Git operations on the scratch clones are serialized
+    self.git_lock = threading.Lock()
+
+    self.accounts = {}
+    self.changes = collections.OrderedDict()
+    self.next_number = 1
+    self.mq_account_id = self.add_account(MQ_USERNAME, 'Merge Queue')
+
+    # (compiled pattern, seconds) of latency rules
+    self.latencies = []
+    # [compiled pattern, status, remaining count, message] of injected errors
+    self.faults = []
+    # (method, endpoint, status, duration) of every request served
+    self.request_log = []
+
+    self.server = None
+    self.thread = None
+    self.url = None
+
+  # --------------------------------------------------------------------------
+  # Scripting
+  # --------------------------------------------------------------------------
+
+  def add_account(self, username, name=None, email=None):
+    """
+    Add an account and return its account id
+    """
+    with self.lock:
+      account_id = 1000000 + len(self.accounts)
+      self.accounts[account_id] = {
+          '_account_id': account_id,
+          'username': username,
+          'name': name or username,
+          'email': email or '{}@example.com'.format(username),
+      }
+      return account_id
+
+  def get_account_id(self, username):
+    for account_id, account in self.accounts.iteritems():
+      if account['username'] == username:
+        return account_id
+    return None
+
+  def get_repo_path(self, project):
+    return os.path.join(self.root_dir, 'git', project + '.git')
+
+  def get_scratch_path(self, project):
+    return os.path.join(self.root_dir, 'scratch', project)
+
+  def get_clone_url(self, project='{project}'):
+    """
+    Return the clone url of `project`. The default is a template suitable for
+    the `gerrit.clone_url` config of the daemon.
+    """
+    return 'file://' + self.get_repo_path(project)
+
+  def git(self, project, *args):
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    return subprocess.check_output(('git',) + args,
+                                   cwd=self.get_scratch_path(project),
+                                   env=env, stderr=subprocess.STDOUT).strip()
+
+  def add_project(self, project, files=None):
+    """
+    Create a project with a master branch containing `files`, a dictionary
+    mapping path to content.
+    """
+    repo_path = self.get_repo_path(project)
+    scratch_path = self.get_scratch_path(project)
+    for path in (repo_path, scratch_path):
+      if os.path.exists(path):
+        shutil.rmtree(path)
+      os.makedirs(path)
+
+    subprocess.check_call(['git', 'init', '-q', '--bare', repo_path])
+    subprocess.check_call(['git', 'init', '-q', scratch_path])
+    if files is None:
+      files = {'README': '{}\n'.format(project)}
+    self.write_files(project, files)
+    self.git(project, 'add', '-A')
+    self.git(project, 'commit', '-q', '-m', 'Initial commit')
+    self.git(project, 'remote', 'add', 'origin', repo_path)
+    self.git(project, 'push', '-q', 'origin', 'HEAD:refs/heads/master')
+
+  def write_files(self, project, files):
+    for relpath, content in files.iteritems():
+      fullpath = os.path.join(self.get_scratch_path(project), relpath)
+      if not os.path.exists(os.path.dirname(fullpath)):
+        os.makedirs(os.path.dirname(fullpath))
+      with open(fullpath, 'w') as outfile:
+        outfile.write(content)
+
+  def create_change(self, project, owner='test1', branch='master',
+                    subject=None, files=None, priority=None, queue=True,
+                    queue_time=None):
+    """
+    Push a feature branch off of the tip of `branch` which modifies `files`
+    and create a change for it. If `queue` is true then the change is
+    approved (Code-Review +2) and queued (Merge-Queue +1) at `queue_time`.
+    Returns the change id.
+    """
+    owner_id = self.get_account_id(owner)
+    if owner_id is None:
+      owner_id = self.add_account(owner)
+
+    with self.lock:
+      number = self.next_number
+      self.next_number += 1
+
+    feature_branch = 'feature_{:06d}'.format(number)
+    change_id = 'I' + hashlib.sha1('{}/{}'.format(project, number)).hexdigest()
+    if subject is None:
+      subject = 'Change {} to {}'.format(number, project)
+    if files is None:
+      files = {'changes/{:06d}.txt'.format(number): '{}\n'.format(subject)}
+
+    message = '{}\n\nFeature-Branch: {}\n'.format(subject, feature_branch)
+    if priority is not None:
+      message += 'Priority: {}\n'.format(priority)
+    message += 'Change-Id: {}\n'.format(change_id)
+
+    with self.git_lock:
+      self.git(project, 'fetch', '-q', 'origin')
+      self.git(project, 'checkout', '-q', '-B', feature_branch,
+               'origin/' + branch)
+      self.write_files(project, files)
+      self.git(project, 'add', '-A')
+      self.git(project, 'commit', '-q', '-m', message)
+      self.git(project, 'push', '-q', '-f', 'origin', feature_branch)
+      revision = self.git(project, 'rev-parse', 'HEAD')
+
+    change = FakeChange(number, project, branch, change_id, subject, message,
+                        revision, owner_id, feature_branch)
+    with self.lock:
+      self.changes[change_id] = change
+    if queue:
+      self.vote(change_id, 'Code-Review', 2, owner, queue_time)
+      self.vote(change_id, 'Merge-Queue', 1, owner, queue_time)
+    return change_id
+
+  def vote(self, change_id, label, value, username='test1', when=None):
+    """
+    Set the vote of `username` on `label` of a change
+    """
+    account_id = self.get_account_id(username)
+    if account_id is None:
+      account_id = self.add_account(username)
+    if when is None:
+      when = datetime.datetime.utcnow()
+    with self.lock:
+      change = self.changes[change_id]
+      change.votes[label][account_id] = (value, when)
+      change.updated = when
+
+  def abandon(self, change_id):
+    with self.lock:
+      self.changes[change_id].status = 'ABANDONED'
+
+  def set_latency(self, seconds, pattern='.*'):
+    """
+    Delay the response to requests matching `pattern` (a regex matched
+    against "METHOD endpoint", e.g. "POST changes/.*/submit") by `seconds`.
+    Later rules take precedence.
+    """
+    with self.lock:
+      self.latencies.insert(0, (re.compile(pattern), seconds))
+
+  def inject_error(self, pattern, status=500, count=1,
+                   message='Injected error'):
+    """
+    Fail the next `count` requests (all of them if None) which match
+    `pattern` (see `set_latency`) with HTTP `status`.
+    """
+    with self.lock:
+      self.faults.append([re.compile(pattern), status, count, message])
+
+  def get_change(self, change_id):
+    with self.lock:
+      return self.changes[change_id]
+
+  def get_stats(self):
+    """
+    Return the number of requests and total time spent serving them, by
+    "METHOD endpoint-pattern".
+    """
+    stats = collections.defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+    with self.lock:
+      for method, endpoint, _, duration in self.request_log:
+        key = '{} {}'.format(method, re.sub(r'/I[0-9a-f]{40}|/[0-9a-f]{40}',
+                                            '/*', endpoint))
+        stats[key]['count'] += 1
+        stats[key]['seconds'] += duration
+    return dict(stats)
+
+  # --------------------------------------------------------------------------
+  # Server
+  # --------------------------------------------------------------------------
+
+  def start(self, host='127.0.0.1', port=0):
+    """
+    Start serving in a background thread. Returns the base url.
+    """
+    self.server = FakeGerritServer((host, port), self)
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   name='fake-gerrit')
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://{}:{}'.format(*self.server.server_address[:2])
+    logging.info('Fake gerrit listening at %s', self.url)
+    return self.url
+
+  def stop(self):
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+      self.thread.join()
+      self.server = None
+
+  def handle(self, method, path, headers, body):
+    """
+    Serve one request. Returns (status, content, headers) where content is
+    either a json-serializable object or a string.
+    """
+    start_time = time.time()
+    parsed = urlparse.urlparse(path)
+    endpoint = parsed.path.lstrip('/')
+    if endpoint.startswith('a/'):
+      endpoint = endpoint[2:]
+    query = urlparse.parse_qs(parsed.query)
+
+    if self.require_auth and 'digest' not in headers.get('Authorization',
+                                                         '').lower():
+      status, content = 401, 'Unauthorized'
+      challenge = ('Digest realm="Gerrit Code Review", domain="/", qop="auth",'
+                   ' nonce="{}"'.format(hashlib.sha1(str(time.time()))
+                                        .hexdigest()))
+      self.log_request(method, endpoint, status, start_time)
+      return status, content, {'WWW-Authenticate': challenge}
+
+    request_key = '{} {}'.format(method, endpoint)
+    with self.lock:
+      delay = 0.0
+      for pattern, seconds in self.latencies:
+        if pattern.match(request_key):
+          delay = seconds
+          break
+
+      fault = None
+      for entry in self.faults:
+        if entry[0].match(request_key) and entry[2] != 0:
+          if entry[2] is not None:
+            entry[2] -= 1
+          fault = entry
+          break
+
+    if delay > 0:
+      time.sleep(delay)
+
+    if fault is not None:
+      status, content = fault[1], fault[3]
+    else:
+      try:
+        data = json.loads(body) if body else {}
+        status, content = self.route(method, endpoint, query, data)
+      except KeyError as ex:
+        status, content = 404, 'Not found: {}'.format(ex)
+      except ValueError as ex:
+        status, content = 400, str(ex)
+    self.log_request(method, endpoint, status, start_time)
+    return status, content, {}
+
+  def log_request(self, method, endpoint, status, start_time):
+    with self.lock:
+      self.request_log.append((method, endpoint, status,
+                               time.time() - start_time))
+
+  def route(self, method, endpoint, query, data):
+    parts = [urllib.unquote(part) for part in endpoint.rstrip('/').split('/')]
+    if parts[0] == 'changes':
+      if len(parts) == 1 and method == 'GET':
+        return self.query_changes(query)
+      change = self.resolve_change(parts[1])
+      rest = parts[2:]
+      if not rest and method == 'GET':
+        return 200, change.as_json(self.accounts, query.get('o', []))
+      if rest == ['topic'] and method == 'PUT':
+        with self.lock:
+          change.topic = data.get('topic', None) or None
+        return 200, change.topic or ''
+      if rest == ['submit'] and method == 'POST':
+        return self.submit(change)
+      if (len(rest) == 3 and rest[0] == 'revisions' and rest[2] == 'commit'
+          and method == 'GET'):
+        return 200, {'commit': change.revision, 'subject': change.subject,
+                     'message': change.message}
+      if (len(rest) == 3 and rest[0] == 'revisions' and rest[2] == 'review'
+          and method == 'POST'):
+        return self.review(change, data)
+    elif parts[0] == 'accounts' and method == 'GET':
+      if len(parts) == 1:
+        start = int(query.get('start', ['0'])[0])
+        limit = int(query.get('n', ['25'])[0])
+        with self.lock:
+          accounts = [self.accounts[key] for key in sorted(self.accounts)]
+        return 200, accounts[start:start + limit]
+      with self.lock:
+        for account in self.accounts.itervalues():
+          if parts[1] in (account['username'], account['email'],
+                          str(account['_account_id'])):
+            return 200, account
+        if parts[1] == 'self':
+          return 200, self.accounts[self.mq_account_id]
+      return 404, 'Account not found: {}'.format(parts[1])
+    return 404, 'Not found'
+
+  def resolve_change(self, identifier):
+    with self.lock:
+      for change in self.changes.itervalues():
+        if identifier in (change.change_id, str(change.number),
+                          change.get_id(), urllib.unquote(change.get_id())):
+          return change
+    raise KeyError(identifier)
+
+  def query_changes(self, query):
+    terms = parse_query(query.get('q', [''])[0])
+    options = query.get('o', [])
+    start = int(query.get('start', ['0'])[0])
+    limit = int(query.get('n', ['500'])[0])
+    with self.lock:
+      matches = [change for change in self.changes.itervalues()
+                 if change.matches(terms)]
+      # Gerrit returns the most recently updated changes first
+      matches.sort(key=lambda change: change.updated, reverse=True)
+      return 200, [change.as_json(self.accounts, options)
+                   for change in matches[start:start + limit]]
+
+  def review(self, change, data):
+    with self.lock:
+      now = datetime.datetime.utcnow()
+      for label, value in data.get('labels', {}).iteritems():
+        change.votes[label][self.mq_account_id] = (int(value), now)
+      change.reviews.append((now, data))
+      change.updated = now
+    return 200, {'labels': data.get('labels', {})}
+
+  def submit(self, change):
+    with self.lock:
+      if change.status != 'NEW':
+        return 409, 'change is {}'.format(change.status.lower())
+      if not change.matches_label('code-review=+2'):
+        return 409, 'change is new but not submittable: needs Code-Review'
+      batch = [change]
+      if self.submit_whole_topic and change.topic is not None:
+        batch = [other for other in self.changes.itervalues()
+                 if other.topic == change.topic and other.status == 'NEW']
+
+    with self.git_lock:
+      for other in batch:
+        try:
+          self.git(other.project, 'fetch', '-q', 'origin')
+          self.git(other.project, 'checkout', '-q', '-B', other.branch,
+                   'origin/' + other.branch)
+          self.git(other.project, 'merge', '-q', '--no-ff', '-m',
+                   'Merge "{}"'.format(other.subject), other.revision)
+          self.git(other.project, 'push', '-q', 'origin', other.branch)
+        except subprocess.CalledProcessError as ex:
+          logging.warn('Fake gerrit failed to merge %s: %s', other.change_id,
+                       ex.output)
+          self.git(other.project, 'reset', '-q', '--hard')
+          return 409, 'Failed to submit 1 change due to the following ' \
+                      'problems:\nChange {}: Problems with integrating this ' \
+                      'change'.format(other.number)
+
+    with self.lock:
+      now = datetime.datetime.utcnow()
+      for other in batch:
+        other.status = 'MERGED'
+        other.updated = now
+    return 200, change.as_json(self.accounts, [])
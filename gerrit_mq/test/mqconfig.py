@@ -177,3 +177,61 @@ daemon = {
     # steps[-1] should not submit the change.
     'silent' : False,
 }
+
+
+# configuration for the builder fleet master
+# ------------------------------------------------------
+master = {
+    # Listen on this address and port
+    'listen' : {
+        'host' : '127.0.0.1',
+        'port' : 8083,
+    },
+
+    # Builders must renew their lease on a merge this often (seconds)
+    'lease_ttl' : 30,
+
+    # Poll gerrit at most this often (seconds)
+    'poll_period' : 10,
+}
+
+# configuration shared by builder processes
+# ------------------------------------------------------
+worker = {
+    # Where to find the master
+    'master_url' : 'http://127.0.0.1:8083',
+
+    # How long to wait (in seconds) between requests for a job when there is
+    # nothing in the queue
+    'poll_period' : 5,
+}
+
+# configuration for each builder
+# ------------------------------------------------------
+builders = [{
+    'name' : 'local1',
+    'auth_key' : 'ojAbvoapIcvia4Knoj5orn',
+    'queues' : [
+        ('mq_test', 'master'),
+        ('mq_test', 'release-candidate'),
+        ('mq_test', 'build'),
+    ],
+    'workspace_path' : os.path.join(DATA_ROOT, 'workspace', 'local1'),
+}, {
+    'name' : 'local2',
+    'auth_key' : 'Krewtyoc2OmEjIbcymDakni',
+    'queues' : [
+        ('mq_test', 'master'),
+        ('mq_test', 'release-candidate'),
+        ('mq_test', 'build'),
+    ],
+    'workspace_path' : os.path.join(DATA_ROOT, 'workspace', 'local2'),
+}, {
+    'name' : 'local3',
+    'auth_key' : 'JeitOokTevmerm3drobIt',
+    'queues' : [
+        ('mq_test', 'release-candidate'),
+        ('mq_test', 'build'),
+    ],
+    'workspace_path' : os.path.join(DATA_ROOT, 'workspace', 'local3'),
+}]
@@ -0,0 +1,270 @@
+"""
+Index advisor for the merge queue database.
+
+Runs the queries of `functions`, the webfront endpoints and the daemon's
+bookkeeping against a generated database, records every statement that is
+executed, and runs `EXPLAIN QUERY PLAN` on each of them. Statements which
+scan a whole table that grows with the history (rather than searching it
+through an index or the row id) are flagged, as are statements which need a
+temporary b-tree to sort its rows.
+"""
+
+import datetime
+import logging
+import os
+import random
+import re
+import shutil
+import tempfile
+
+import sqlalchemy
+
+from gerrit_mq import common
+from gerrit_mq import daemon
+from gerrit_mq import functions
+from gerrit_mq import orm
+from gerrit_mq import webfront
+from gerrit_mq.test import benchmark
+
+# Tables whose size is bounded by the number of projects/branches or of
+# pending changes, rather than growing with the history, so a full scan of
+# them is fine.
+SMALL_TABLES = frozenset(['builders', 'change_queue', 'leader_leases',
+                          'merge_counts', 'queue_spec'])
+
+# (regex, reason) of statements whose flagged plans are expected. Their
+# problems are reported as notes instead.
+ALLOWED_STATEMENTS = [
+    (re.compile(r'^SELECT .* FROM flake_events (?:WHERE .* )?GROUP BY '),
+     'the flaky step report aggregates every flake event, and sorts the '
+     'groups by their count'),
+]
+
+# Matches the `detail` of a plan step which scans or searches a table (sqlite
+# < 3.36 prints `SCAN TABLE <name>`)
+TABLE_STEP_REGEX = re.compile(r'^(SCAN|SEARCH) (?:TABLE )?(\w+)')
+
+
+class StatementRecorder(object):
+  """
+  Records the distinct statements executed on an engine, along with the
+  parameters of their first execution
+  """
+
+  def __init__(self, engine):
+    self.statements = {}
+    sqlalchemy.event.listen(engine, 'before_cursor_execute', self.record)
+
+  def record(self, conn, cursor, statement, parameters, context,
+             executemany):  # pylint: disable=unused-argument,too-many-arguments
+    if executemany:
+      parameters = parameters[0]
+    self.statements.setdefault(statement, parameters)
+
+
+def classify_plan(statement, plan):
+  """
+  Return the (problems, notes) of the query plan of `statement`, where `plan`
+  is the list of `detail` strings of its `EXPLAIN QUERY PLAN`. Problems are
+  full scans of tables which grow with the history and sorts of their rows.
+  Notes are filtered scans which stop after LIMIT rows, whose cost depends
+  on how many rows match the filter.
+  """
+  problems = []
+  notes = []
+  steps = [TABLE_STEP_REGEX.match(detail) for detail in plan]
+  tables = [match.group(2) for match in steps if match is not None]
+  sorted_rows = any('TEMP B-TREE' in detail for detail in plan)
+  limited = re.search(r'\bLIMIT\b', statement) is not None
+  filtered = re.search(r'\bWHERE\b', statement) is not None
+
+  for detail, match in zip(plan, steps):
+    if match is not None and match.group(1) == 'SCAN':
+      table = match.group(2)
+      # `anon_N` are subqueries, whose tables are reported on
+      # their own
+      if table in SMALL_TABLES or table.startswith('anon_'):
+        continue
+      # A scan in row id (or index) order which stops after
+      # LIMIT rows is how the most recent rows are read, and isn't a problem
+      # unless the rows also have to be sorted.
+      if limited and not sorted_rows:
+        if filtered:
+          notes.append('scan of {} until LIMIT rows match'.format(table))
+        continue
+      problems.append('full scan of {}'.format(table))
+    elif detail.startswith('USE TEMP B-TREE'):
+      if tables and tables[0] in SMALL_TABLES:
+        continue
+      problems.append(detail.lower())
+  return problems, notes
+
+
+def get_allowed_reason(statement):
+  """
+  Return the reason why the flagged plan of `statement` is expected, or None
+  if it isn't (see `ALLOWED_STATEMENTS`).
+  """
+  for regex, reason in ALLOWED_STATEMENTS:
+    if regex.match(' '.join(statement.split())):
+      return reason
+  return None
+
+
+def explain_statements(engine, statements):
+  """
+  Run `EXPLAIN QUERY PLAN` on each of `statements` (a dictionary of statement
+  to parameters). Returns a list of dictionaries with the `statement`, its
+  `plan`, its `problems` and `notes` (see `classify_plan`). The problems of
+  allowed statements (see `ALLOWED_STATEMENTS`) are moved to their notes.
+  """
+  results = []
+  conn = engine.raw_connection()
+  try:
+    cursor = conn.cursor()
+    for statement, parameters in sorted(statements.iteritems()):
+      if not statement.lstrip().upper().startswith(
+          ('SELECT', 'UPDATE', 'DELETE', 'INSERT')):
+        continue
+      cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+      plan = [row[-1] for row in cursor.fetchall()]
+      problems, notes = classify_plan(statement, plan)
+      reason = get_allowed_reason(statement)
+      if problems and reason is not None:
+        notes.extend('{} ({})'.format(problem, reason) for problem in problems)
+        problems = []
+      results.append({'statement': ' '.join(statement.split()),
+                      'plan': plan, 'problems': problems, 'notes': notes})
+  finally:
+    conn.close()
+  return results
+
+
+def abbreviate(statement):
+  """
+  Replace the column lists of the SELECTs in `statement` with `...`
+  """
+  return re.sub(r'SELECT (?:(?!SELECT\b).)*? FROM', 'SELECT ... FROM',
+                statement)
+
+
+def fill_database(sql, num_merges):
+  """
+  Fill the database with a history of `num_merges` merges, a queue, step
+  timings and flakes
+  """
+  benchmark.fill_history(sql, 0, num_merges, num_owners=20,
+                         changes_per_merge=2)
+  # The queue reuses the accounts of the history
+  benchmark.fill_queue(sql, queue_size=100, num_owners=20)
+  for merge_id in range(1, num_merges + 1, 10):
+    for step in ('configure', 'build', 'test'):
+      functions.record_step_timing(
+          sql, merge_id, 'project{}'.format(merge_id % 5), 'master', step,
+          random.uniform(10, 100), orm.StatusKey.SUCCESS.value)
+    if merge_id % 7 == 0:
+      functions.record_flake(sql, merge_id, 'project{}'.format(merge_id % 5),
+                             'master', 'test', 2)
+  sql.add(orm.MergeStatus(project='project0', branch='master',
+                          start_time=datetime.datetime.utcnow(),
+                          end_time=datetime.datetime.utcnow(),
+                          status=orm.StatusKey.IN_PROGRESS.value))
+  sql.commit()
+
+
+def make_config(tmp_dir):
+  """
+  Return a minimal webfront/daemon config for the generated database
+  """
+  return common.ConfigDict({
+      'db_url': 'sqlite:///{}/db.sqlite'.format(tmp_dir),
+      'log_path': os.path.join(tmp_dir, 'logs'),
+      'webfront': {
+          'flask_debug': False,
+          'secret_key': 'query-plans',
+      },
+      'daemon': {
+          'pidfile_path': os.path.join(tmp_dir, 'pid'),
+          'offline_sentinel_path': os.path.join(tmp_dir, 'offline'),
+      },
+      'queues': [{'project': 'project{}'.format(idx), 'branch': 'master',
+                  'build_env': {}, 'build_steps': []} for idx in range(5)],
+  })
+
+
+# Requests made to the webfront
+WEBFRONT_REQUESTS = [
+    '/gmq/get_queue',
+    '/gmq/get_queue?project=project1&branch=master&offset=10&limit=10',
+    '/gmq/get_history',
+    '/gmq/get_history?offset=500&limit=25',
+    '/gmq/get_history?project=project1&branch=master&offset=50&limit=25',
+    '/gmq/get_history?project=Project1&branch=mast_r&offset=50&limit=25',
+    '/gmq/get_history?cursor=',
+    '/gmq/get_history?project=project1&branch=master&cursor=',
+    '/gmq/get_history?project=project1&branch=MASTER&cursor=',
+    '/gmq/get_history?project=project%25&cursor=',
+    '/gmq/get_history?cursor={}'.format(
+        functions.encode_history_cursor('next', 500)),
+    '/gmq/get_history?cursor={}'.format(
+        functions.encode_history_cursor('prev', 500)),
+    '/gmq/get_merge_status',
+    '/gmq/get_merge_status?rid=10',
+    '/gmq/get_active_merge_status',
+    '/gmq/get_flaky_steps',
+    '/gmq/get_flaky_steps?project=project1',
+    '/gmq/get_daemon_status',
+    '/gmq/cancel_merge?rid=10',
+]
+
+
+def run_workload(config, session_factory, num_merges):
+  """
+  Execute the queries of `functions`, the webfront and the daemon
+  """
+  sql = session_factory()
+  functions.get_queue(sql)
+  functions.get_queue(sql, 'project1', 'master', 10, 10)
+  functions.get_history(sql, None, None, 100, 25, include_changes=True)
+  functions.get_history_page(sql, 'project1', 'master', '', 25,
+                             include_changes=True)
+  functions.get_step_durations(sql, 'project1', 'master', 'build')
+  functions.get_flaky_steps(sql)
+  functions.get_dirty_change_ids(
+      sql, ['I{:032x}{:08x}'.format(rid, 0) for rid in range(1, 100)])
+  functions.acquire_leader_lease(sql, 'daemon', 'host:1', ttl=60)
+  functions.set_leader_merge(sql, 'daemon', 'host:1', num_merges)
+  functions.release_leader_lease(sql, 'daemon', 'host:1')
+  daemon.mark_old_changes_as_failed(sql, keep_ids=[num_merges + 1])
+  sql.close()
+
+  app = webfront.Webfront(config, None, session_factory)
+  client = app.test_client()
+  for url in WEBFRONT_REQUESTS:
+    response = client.get(url)
+    if response.status_code != 200:
+      logging.warn('%s returned %d', url, response.status_code)
+
+
+def check_query_plans(num_merges=2000, seed=0):
+  """
+  Generate a database of `num_merges` merges, execute the workload on it and
+  return the query plan of every statement that was executed (see
+  `explain_statements`).
+  """
+  random.seed(seed)
+  tmp_dir = tempfile.mkdtemp(prefix='gerrit-mq-query-plans-')
+  try:
+    config = make_config(tmp_dir)
+    session_factory = orm.init_sql(config['db_url'])
+    engine = session_factory.kw['bind']
+    sql = session_factory()
+    fill_database(sql, num_merges)
+    sql.close()
+    engine.execute('ANALYZE')
+
+    recorder = StatementRecorder(engine)
+    run_workload(config, session_factory, num_merges)
+    return explain_statements(engine, recorder.statements)
+  finally:
+    shutil.rmtree(tmp_dir)
@@ -58,10 +58,20 @@ ZIP_MANIFEST = [
     'gerrit_mq/__main__.py',
     'gerrit_mq/common.py',
     'gerrit_mq/daemon.py',
+    'gerrit_mq/eta.py',
     'gerrit_mq/functions.py',
     'gerrit_mq/master.py',
+    'gerrit_mq/metrics.py',
+    'gerrit_mq/migrations.py',
     'gerrit_mq/orm.py',
+    'gerrit_mq/outbox.py',
+    'gerrit_mq/polling.py',
+    'gerrit_mq/scheduler.py',
+    'gerrit_mq/simulator.py',
+    'gerrit_mq/supervisor.py',
+    'gerrit_mq/watcher.py',
     'gerrit_mq/webfront.py',
+    'gerrit_mq/worker.py',
     'gerrit_mq/templates/daemon.html.tpl',
     'gerrit_mq/templates/detail.html.tpl',
     'gerrit_mq/templates/detail_body.html.tpl',
@@ -0,0 +1,204 @@
+"""
+Watches the files of the watch manifest (see `functions.get_watch_manifest`)
+for modification. Uses inotify on the directories containing those files if it
+is available, otherwise falls back to periodically polling their mtimes.
+"""
+
+import ctypes
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+# Constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_ONLYDIR)
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len;}
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def get_changelist(manifest):
+  """
+  Like `functions.get_changelist` but tolerates files which are missing, as
+  they may be in the middle of being replaced. Returns None if any file is
+  missing.
+  """
+
+  changelist = []
+  for fullpath, mtime in manifest:
+    try:
+      if os.path.getmtime(fullpath) - mtime > 0.1:
+        changelist.append(fullpath)
+    except OSError:
+      logging.info('Watched file %s is missing', fullpath)
+      return None
+  return changelist
+
+
+class Inotify(object):
+  """
+  Minimal ctypes binding of the linux inotify api
+  """
+
+  def __init__(self):
+    self.libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    self.inotify_fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if self.inotify_fd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+
+  def add_watch(self, path, mask):
+    watch_desc = self.libc.inotify_add_watch(self.inotify_fd, path, mask)
+    if watch_desc < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return watch_desc
+
+  def wait(self, timeout):
+    """
+    Wait up to `timeout` seconds for events to be available. Returns true if
+    there are events to read.
+    """
+    try:
+      readable, _, _ = select.select([self.inotify_fd], [], [], timeout)
+    except select.error as err:
+      if err.args[0] == errno.EINTR:
+        return False
+      raise
+    return bool(readable)
+
+  def read_events(self):
+    """
+    Return a list of (watch_desc, mask, name) for all of the events that are
+    available
+    """
+    try:
+      buf = os.read(self.inotify_fd, 64 * 1024)
+    except OSError as err:
+      if err.errno in (errno.EAGAIN, errno.EINTR):
+        return []
+      raise
+
+    events = []
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(buf):
+      watch_desc, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+      offset += EVENT_HEADER.size
+      name = buf[offset:offset + length].rstrip('\0')
+      offset += length
+      events.append((watch_desc, mask, name))
+    return events
+
+  def close(self):
+    os.close(self.inotify_fd)
+
+
+class SourceWatcher(threading.Thread):
+  """
+  Background thread which sets `changed` once any file in `manifest` (a list of
+  (path, mtime)) is modified, and records the modified files in `changelist`.
+
+  Writes come in bursts during a deploy, so the watcher waits until there has
+  been no activity for `debounce` seconds (but at most `max_delay` seconds)
+  before checking mtimes. If inotify is unavailable, then mtimes are polled
+  every `poll_period` seconds.
+  """
+
+  def __init__(self, manifest, debounce=2.0, max_delay=60.0, poll_period=5.0):
+    super(SourceWatcher, self).__init__(name='source-watcher')
+    self.daemon = True
+    self.manifest = list(manifest)
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.poll_period = poll_period
+    self.changed = threading.Event()
+    self.changelist = []
+    self.stop_event = threading.Event()
+
+    self.watched_paths = set(path for path, _ in self.manifest)
+    self.inotify = None
+    self.watch_dirs = {}
+    try:
+      self.inotify = Inotify()
+      for dirpath in sorted(set(os.path.dirname(path)
+                                for path in self.watched_paths)):
+        self.watch_dirs[self.inotify.add_watch(dirpath, WATCH_MASK)] = dirpath
+    except (OSError, AttributeError):
+      logging.warn('inotify is not available, polling for source changes'
+                   ' every %.1f seconds', poll_period, exc_info=True)
+      if self.inotify is not None:
+        self.inotify.close()
+      self.inotify = None
+      self.watch_dirs = {}
+
+  def is_relevant(self, events):
+    for watch_desc, mask, name in events:
+      if mask & IN_Q_OVERFLOW:
+        return True
+      dirpath = self.watch_dirs.get(watch_desc, None)
+      if dirpath is None:
+        continue
+      if os.path.join(dirpath, name) in self.watched_paths:
+        return True
+    return False
+
+  def check(self):
+    """
+    Set `changed` if any of the files were modified. Returns the list of
+    modified files, or None if they can't be checked right now.
+    """
+    changelist = get_changelist(self.manifest)
+    if changelist:
+      self.changelist = changelist
+      self.changed.set()
+    return changelist
+
+  def run_inotify(self):
+    # time of the first relevant event which hasn't been checked yet
+    pending_since = None
+    while not self.stop_event.is_set() and not self.changed.is_set():
+      timeout = 1.0 if pending_since is None else self.debounce
+      if self.inotify.wait(timeout):
+        if (self.is_relevant(self.inotify.read_events())
+            and pending_since is None):
+          pending_since = time.time()
+        # Wait for the burst of writes to settle down
+        if (pending_since is None
+            or time.time() - pending_since < self.max_delay):
+          continue
+
+      if pending_since is not None and self.check() is not None:
+        pending_since = None
+
+  def run_polling(self):
+    while (not self.stop_event.wait(self.poll_period)
+           and not self.changed.is_set()):
+      self.check()
+
+  def run(self):
+    if self.inotify is None:
+      self.run_polling()
+    else:
+      self.run_inotify()
+
+  def stop(self):
+    self.stop_event.set()
+    self.join()
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
@@ -7,6 +7,7 @@ import os
 
 import flask
 
+from gerrit_mq import eta
 from gerrit_mq import orm
 from gerrit_mq import functions
 
@@ -86,6 +87,7 @@ class Webfront(flask.Flask):
     self.sql_factory = sql_factory
     self.mq_config = mq_config
     self.secret_key = mq_config['webfront.secret_key']
+    self.eta = eta.EtaEngine(mq_config)
 
     self.add_url_rule('/gmq/cancel_merge', 'cancel_merge', self.cancel_merge)
     self.add_url_rule('/gmq/get_active_merge_status', 'get_active_merge_status',
@@ -98,12 +100,18 @@ class Webfront(flask.Flask):
                       self.get_daemon_status)
     self.add_url_rule('/gmq/set_daemon_pause', 'set_daemon_pause',
                       self.set_daemon_pause)
+    self.add_url_rule('/gmq/get_flaky_steps', 'get_flaky_steps',
+                      self.get_flaky_steps)
+    self.add_url_rule('/gmq/get_metrics', 'get_metrics', self.get_metrics)
 
     logging.info('Initialized webfront app')
 
   def get_queue(self):
     """
     Return json-encoded list of ChangeInfo objects for the current queue.
+    Each item includes the estimated start and finish time of its
+    verification (`eta_start`, `eta_finish`), which are null if they can't be
+    estimated.
 
     Query params:
     `project` : SQL `LIKE` expression for projects to match
@@ -116,11 +124,27 @@ class Webfront(flask.Flask):
         = extract_common_args(flask.request.args)
 
     sql = self.sql_factory()
-    count, result_list = functions.get_queue(sql, project_filter, branch_filter,
-                                             offset, limit)
+    # The estimates need the whole queue, which is also the result if it isn't
+    # filtered.
+    _, queue = functions.get_queue(sql)
+    if project_filter is None and branch_filter is None:
+      count = len(queue)
+      result_list = queue[offset:]
+      if limit > 0:
+        result_list = result_list[:limit]
+    else:
+      count, result_list = functions.get_queue(sql, project_filter,
+                                               branch_filter, offset, limit)
+    etas = self.eta.get_etas(sql, queue)
     sql.close()
-    return flask.jsonify(count=count,
-                         result=[ci.as_dict() for ci in result_list])
+
+    result = []
+    for changeinfo in result_list:
+      change_json = changeinfo.as_dict()
+      change_json.update(etas.get(changeinfo.change_id,
+                                  {'eta_start': None, 'eta_finish': None}))
+      result.append(change_json)
+    return flask.jsonify(count=count, result=result)
 
     # request_queue = [ci.as_dict() for ci in self.gerrit.get_merge_requests()]
     # return flask.jsonify(count=len(request_queue), result=request_queue)
@@ -134,42 +158,62 @@ class Webfront(flask.Flask):
       `branch` : SQL `LIKE` expression for branches to match
       `offset` : start offset for pagination
       `limit` : maximum number of records to return
+      `cursor` : paginate by cursor instead of offset. Empty for the first
+                 page, or the `next_cursor`, `prev_cursor` or `last_cursor`
+                 of a previous result.
     """
     project_filter, branch_filter, offset, limit \
         = extract_common_args(flask.request.args)
 
     sql = self.sql_factory()
-    query = sql.query(orm.MergeStatus)
-
-    if project_filter is not None:
-      query = query.filter(orm.MergeStatus.project.like(project_filter))
-    if branch_filter is not None:
-      query = query.filter(orm.MergeStatus.branch.like(branch_filter))
+    if 'cursor' in flask.request.args:
+      try:
+        result = functions.get_history_page(
+            sql, project_filter, branch_filter, flask.request.args['cursor'],
+            limit, include_changes=True)
+      except ValueError:
+        sql.close()
+        response = flask.jsonify({'status': 'ERROR',
+                                  'reason': 'invalid cursor'})
+        response.status_code = 400
+        return response
+      sql.close()
+      return flask.jsonify(result)
 
-    query = query.order_by(orm.MergeStatus.rid.desc())
-    count = query.count()
+    result = functions.get_history(sql, project_filter, branch_filter, offset,
+                                   limit, include_changes=True)
+    response = flask.jsonify(result)
+    sql.close()
+    return response
 
-    if offset > 0:
-      query = query.offset(offset)
+  def get_flaky_steps(self):
+    """
+    Return json-encoded list of the flakiest build steps, most flaky first.
 
-    if limit > 0:
-      query = query.limit(limit)
+    Query params:
+      `project` : SQL `LIKE` expression for projects to match
+      `queue` : SQL `LIKE` expression for queue names to match
+      `limit` : maximum number of records to return
+    """
+    project_filter, _, _, limit = extract_common_args(flask.request.args)
+    queue_filter = flask.request.args.get('queue', None)
 
-    result = []
-    for merge_sql in list(query):
-      merge_json = merge_sql.as_dict()
-      query = (sql.query(orm.MergeChange)
-               .join(orm.MergeChange.owner)
-               .filter(orm.MergeChange.merge_id == merge_sql.rid))
-      merge_json['changes'] = []
-      for change_sql in query:
-        merge_json['changes'].append(change_sql.as_dict())
-      result.append(merge_json)
-
-    response = flask.jsonify(dict(count=count,
-                                  result=result))
+    sql = self.sql_factory()
+    result = functions.get_flaky_steps(sql, project_filter, queue_filter,
+                                       limit)
     sql.close()
-    return response
+    return flask.jsonify(result=result)
+
+  def get_metrics(self):
+    """
+    Return the most recent json metrics snapshot written by the daemon.
+    """
+    metrics_path = self.mq_config.get('daemon.metrics_path', None)
+    if metrics_path is None or not os.path.exists(metrics_path):
+      return flask.jsonify({})
+
+    with open(metrics_path, 'r') as infile:
+      return flask.Response(infile.read(), mimetype='application/json')
 
   def get_merge_status(self):
     """
@@ -209,7 +253,7 @@ class Webfront(flask.Flask):
     record_json['changes'] = []
 
     query = (sql.query(orm.MergeChange)
-             .filter(orm.MergeChange.merge_id == query_rid)
+             .filter(orm.MergeChange.merge_id == record_sql.rid)
              .order_by(orm.MergeChange.request_time))
     for change_sql in query:
       record_json['changes'].append(change_sql.as_dict())
@@ -0,0 +1,205 @@
+"""
+Builder process for a fleet of merge-queue builders. Repeatedly leases a merge
+from the master, verifies (and submits) it, and reports the result back to
+the master.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import requests
+import sqlalchemy
+
+from gerrit_mq import common
+from gerrit_mq import daemon
+from gerrit_mq import orm
+from gerrit_mq import outbox
+
+
+class LeaseKeeper(threading.Thread):
+  """
+  Background thread which periodically renews the lease on a merge for as long
+  as the merge is being worked on.
+  """
+
+  def __init__(self, worker, merge_id, period):
+    super(LeaseKeeper, self).__init__(name='lease-{}'.format(merge_id))
+    self.daemon = True
+    self.worker = worker
+    self.merge_id = merge_id
+    self.period = period
+    self.stop_event = threading.Event()
+    self.lost = False
+
+  def run(self):
+    while not self.stop_event.wait(self.period):
+      if not self.worker.renew_lease(self.merge_id):
+        self.lost = True
+        return
+
+  def is_held(self):
+    return not self.lost
+
+  def stop(self):
+    self.stop_event.set()
+    self.join()
+
+
+class Worker(object):
+
+  def __init__(self, config, gerrit, sql_session, builder_name):
+    self.config = config
+    self.gerrit = gerrit
+    self.sql_session = sql_session
+
+    self.builder = None
+    for builder_config in config['builders']:
+      if builder_config['name'] == builder_name:
+        self.builder = builder_config
+        break
+    if self.builder is None:
+      raise ValueError('Builder {} is not configured'.format(builder_name))
+
+    self.master_url = config['worker.master_url'].rstrip('/')
+    self.poll_period = config.get('worker.poll_period', 10)
+    # How long to wait for the reviews of a merge to be posted before
+    # reporting its result to the master
+    self.outbox_timeout = config.get('worker.outbox_timeout', 60)
+
+    # Each builder needs its own workspace so that several
+    # builders may run on the same host.
+    self.workspace_path = self.builder.get(
+        'workspace_path',
+        os.path.join(config['daemon.workspace_path'], builder_name))
+    try:
+      os.makedirs(self.workspace_path)
+    except OSError:
+      pass
+
+    self.queue_index = {}
+    for spec_dict in config['queues']:
+      spec = daemon.QueueSpec(**spec_dict)
+      self.queue_index[(spec.project, spec.name)] = spec
+
+    daemon.setup_ccache(config)
+
+  def call_master(self, endpoint, **params):
+    """
+    Make an authenticated request to the master and return the decoded json
+    response.
+    """
+    response = requests.post('{}/gmq/{}'.format(self.master_url, endpoint),
+                             data=params, timeout=30,
+                             auth=(self.builder['name'],
+                                   self.builder['auth_key']))
+    response.raise_for_status()
+    return response.json()
+
+  def renew_lease(self, merge_id):
+    """
+    Renew the lease on `merge_id`. Return False if the master says that we no
+    longer hold the lease.
+    """
+    try:
+      self.call_master('renew_lease', merge_id=merge_id)
+    except requests.HTTPError as err:
+      if err.response is not None and err.response.status_code == 409:
+        return False
+      logging.exception('Failed to renew lease on merge %d', merge_id)
+    except requests.RequestException:
+      # The master may be restarting, keep trying until the lease
+      # actually expires.
+      logging.exception('Failed to renew lease on merge %d', merge_id)
+    return True
+
+  def post_result(self, merge_id, status, attempts=5):
+    """
+    Report the result of a merge to the master, retrying if the master is
+    unreachable.
+    """
+    for attempt in range(attempts):
+      try:
+        self.call_master('post_result', merge_id=merge_id, status=status)
+        return True
+      except requests.HTTPError as err:
+        if err.response is not None and err.response.status_code == 409:
+          logging.warn('Lease on merge %d was lost, result discarded',
+                       merge_id)
+          return False
+        logging.exception('Failed to post result of merge %d', merge_id)
+      except requests.RequestException:
+        logging.exception('Failed to post result of merge %d', merge_id)
+      time.sleep(2 ** attempt)
+    return False
+
+  def run_job(self, job):
+    """
+    Verify and submit the merge described by `job`. Returns the status of the
+    merge.
+    """
+    merge_id = job['merge_id']
+    queue_spec = self.queue_index.get((job['project'], job['queue']), None)
+    if queue_spec is None:
+      logging.error('Merge %d is for unknown queue %s/%s', merge_id,
+                    job['project'], job['queue'])
+      self.post_result(merge_id, orm.StatusKey.STEP_FAILED.value)
+      return orm.StatusKey.STEP_FAILED.value
+
+    change_queue = [common.ChangeInfo(queue_score=None, **changeinfo)
+                    for changeinfo in job['changes']]
+
+    keeper = LeaseKeeper(self, merge_id, max(job['lease_ttl'] / 3.0, 1))
+    keeper.start()
+    try:
+      status = daemon.verify_and_submit(
+          self.config, self.gerrit, self.sql_session, queue_spec,
+          change_queue, merge_id, self.workspace_path,
+          checks=daemon.MergeChecks(lease_check=keeper.is_held))
+    finally:
+      keeper.stop()
+
+    # The master may dispatch these changes again as soon as it
+    # has the result, so gerrit must show the result (e.g. Merge-Queue -1)
+    # by then.
+    if not outbox.flush(self.sql_session,
+                        daemon.get_review_dedup_keys(merge_id, change_queue),
+                        self.outbox_timeout):
+      logging.warn('Reviews of merge %d are still in the outbox', merge_id)
+
+    if status != orm.StatusKey.ABANDONED.value:
+      self.post_result(merge_id, status)
+    return status
+
+  def run(self):
+    logging.info('Builder %s requesting jobs from %s', self.builder['name'],
+                 self.master_url)
+    session_factory = sqlalchemy.orm.sessionmaker(
+        bind=self.sql_session.get_bind())
+    sender = outbox.OutboxSender(self.gerrit, session_factory,
+                                 **self.config.get('daemon.outbox', {}))
+    sender.start()
+
+    while True:
+      try:
+        try:
+          job = self.call_master('get_job')
+        except (requests.RequestException, ValueError):
+          logging.exception('Failed to get a job from the master')
+          job = {}
+
+        if not job:
+          time.sleep(self.poll_period)
+          continue
+
+        logging.info('Leased merge %d of %s/%s', job['merge_id'],
+                     job['project'], job['branch'])
+        self.run_job(job)
+
+      except KeyboardInterrupt:
+        break
+
+    sender.stop()
+    logging.info('Exiting main loop')
+    return 0